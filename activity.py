@@ -0,0 +1,89 @@
+import datetime
+import logging
+import threading
+
+from .db import fetch_light_action_counts_by_hour
+
+log = logging.getLogger('modules')
+
+
+class ActivityProfile():
+    """
+    How busy the lights usually are at each hour of the day, learned from the light actions the
+    module has already saved and topped up with every change the monitor sees.
+
+    `activity` returns a weight from 0 for an hour without any changes to 1 for the busiest
+    hour. An `AdaptivePoller` uses it to keep polling fast through the evening and back off
+    further at night.
+
+    Parameters
+    ----------
+    `smoothing <float>`
+    How much of each neighbouring hour counts towards an hour, so polling speeds up a little
+    before a busy hour starts and doesn't drop the moment it ends
+    """
+    HOURS = 24
+
+    def __init__(self, smoothing=0.5):
+        self.smoothing = smoothing
+        self.counts = [0] * self.HOURS
+
+        self._weights = None
+        self._lock = threading.Lock()
+
+    def __bool__(self):
+        return any(self.counts)
+
+    def load(self, conn, days=28):
+        """
+        Learns the profile from the light actions saved in the last `days` days.
+
+        Returns
+        ----------
+        `actions <int>`
+        The number of actions counted
+        """
+        since = datetime.datetime.now() - datetime.timedelta(days=days)
+        rows = fetch_light_action_counts_by_hour(conn, since)
+
+        with self._lock:
+            for hour, count in rows:
+                self.counts[int(hour) % self.HOURS] += count
+            self._weights = None
+
+        total = sum(count for _, count in rows)
+        log.debug("[INFO]: Learned the light activity profile from %d actions over %d days", total, days)
+        return total
+
+    def observe(self, when, count=1):
+        """
+        Counts `count` light changes at `when`.
+        """
+        with self._lock:
+            self.counts[when.hour] += count
+            self._weights = None
+
+    def activity(self, when):
+        """
+        Returns how busy the hour of `when` usually is, from 0 to 1. 0 for every hour until
+        anything has been counted.
+        """
+        weights = self._weights
+
+        if weights is None:
+            weights = self._weights = self._smoothed()
+
+        return weights[when.hour]
+
+    def _smoothed(self):
+        with self._lock:
+            counts = list(self.counts)
+
+        hours = self.HOURS
+        smoothed = [counts[hour] + self.smoothing * (counts[hour - 1] + counts[(hour + 1) % hours]) for hour in range(hours)]
+        peak = max(smoothed)
+
+        if not peak:
+            return [0.0] * hours
+
+        return [value / peak for value in smoothed]
@@ -0,0 +1,554 @@
+"""
+Benchmarks for the Phillips Hue Bridge module. The micro-benchmarks run against synthetic
+data, and the monitor benchmark runs the real monitor loop against a `FakeHueBridge` and a
+stub database, so none of them need a bridge or Postgres.
+
+Run with `python -m <package>.benchmark` from the directory above this module.
+"""
+import bisect
+import copy
+import datetime
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+import timeit
+import tracemalloc
+
+from .diff import diff_lights
+from .fake_bridge import FakeHueBridge, synthetic_lights
+from .state import snapshot
+
+
+def mutate_lights(lights, ratio, seed=1):
+    """
+    Returns a copy of the light object with `ratio` of the lights toggled and dimmed.
+    """
+    rng = random.Random(seed)
+    new_lights = copy.deepcopy(lights)
+
+    for key in rng.sample(sorted(new_lights), int(len(new_lights) * ratio)):
+        state = new_lights[key]["state"]
+        state["on"] = not state["on"]
+        state["bri"] = rng.randint(1, 254)
+
+    return new_lights
+
+
+def _nested_loop_diff(old_state, lights):
+    # The comparison `_determine_changed_lights` used before the uniqueid index,
+    # kept here as the baseline the diff engine is measured against.
+    lights_array = []
+
+    for new_key, new_light in lights.items():
+        for old_key, old_light in old_state.items():
+            if new_light["uniqueid"] == old_light["uniqueid"]:
+                if (new_light["state"]["on"] != old_light["state"]["on"] or new_light["state"]["reachable"] != old_light["state"]["reachable"]):
+                    lights_array.append({"uniqueid": new_light["name"], "on": new_light["state"]["on"], "reachable": new_light["state"]["reachable"]})
+                    break
+
+    return lights_array
+
+
+def bench_diff(sizes=(10, 100, 1000), ratio=0.1, repeat=5):
+    """
+    Times `diff_lights` on compact snapshots against the old nested loop on the raw bridge
+    objects, for each snapshot size.
+
+    Returns
+    ----------
+    `results <array>`
+    An array of (size, nested loop seconds per diff, diff engine seconds per diff)
+    """
+    results = []
+
+    for size in sizes:
+        old_lights = synthetic_lights(size)
+        new_lights = mutate_lights(old_lights, ratio)
+        old_state, new_state = snapshot(old_lights), snapshot(new_lights)
+        number = max(1, 10000 // size)
+
+        nested = min(timeit.repeat(lambda: _nested_loop_diff(old_lights, new_lights), number=number, repeat=repeat)) / number
+        indexed = min(timeit.repeat(lambda: diff_lights(old_state, new_state), number=number, repeat=repeat)) / number
+        results.append((size, nested, indexed))
+
+    return results
+
+
+def _traced(func):
+    # Returns (result, bytes still allocated by func, peak bytes allocated during func)
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        result = func()
+        current, peak = tracemalloc.get_traced_memory()
+        return result, current - before, peak - before
+    finally:
+        tracemalloc.stop()
+
+
+def bench_snapshot_memory(size=1000, repeat=5):
+    """
+    Measures what one tick costs for `size` lights: the memory retained as `old_state` as a
+    raw bridge object vs a compact snapshot, the allocations to parse and convert a response,
+    and the time to convert it.
+
+    Returns
+    ----------
+    `results <dictionary>`
+    Byte and second counts keyed by measurement
+    """
+    response = json.dumps(synthetic_lights(size))
+
+    raw, raw_retained, raw_peak = _traced(lambda: json.loads(response))
+    compact, compact_retained, _ = _traced(lambda: snapshot(raw))
+    _, _, tick_peak = _traced(lambda: snapshot(json.loads(response)))
+    number = max(1, 10000 // size)
+    convert = min(timeit.repeat(lambda: snapshot(raw), number=number, repeat=repeat)) / number
+
+    return {
+        "raw_retained": raw_retained,
+        "compact_retained": compact_retained,
+        "parse_peak": raw_peak,
+        "tick_peak": tick_peak,
+        "convert_seconds": convert,
+    }
+
+
+class _StubCursor():
+    def __init__(self, db):
+        self.db = db
+        self.connection = db
+        self._result = []
+        self._rows = []
+
+    def execute(self, sql, args=None):
+        if isinstance(sql, bytes):
+            sql = sql.decode()
+        self._result = self.db.answer(sql, args, self._rows)
+        self._rows = []
+
+    def mogrify(self, template, args):
+        # execute_values mogrifies every row before its one execute; keep the rows themselves
+        self._rows.append(args)
+        return b""
+
+    def fetchone(self):
+        return self._result[0] if self._result else None
+
+    def fetchall(self):
+        return list(self._result)
+
+    def close(self):
+        pass
+
+
+class StubDatabase():
+    """
+    Answers the queries the monitor makes, as a plain connection would, without Postgres.
+    Light items are the fake bridge's lights with their bridge key as item id, and inserted
+    actions are kept in memory.
+
+    Parameters
+    ----------
+    `bridge <FakeHueBridge>`
+    The bridge to report as the active bridge
+
+    Attributes
+    ----------
+    `actions <array>`
+    Every inserted action row, (event_time, has_value, is_on, is_reachable, item_id, value)
+
+    `inserts <array>`
+    (time.monotonic(), item_id) for every inserted action
+    """
+    encoding = "UTF8"
+    closed = 0
+
+    def __init__(self, bridge):
+        self.bridge = bridge
+        self.actions = []
+        self.inserts = []
+        self.latest = {}
+        self.statements = 0
+        self._lock = threading.Lock()
+
+        with bridge.lock:
+            self.items = [(int(key), light["uniqueid"], light["name"]) for key, light in bridge.lights.items()]
+
+    def cursor(self):
+        return _StubCursor(self)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+    def answer(self, sql, args, rows):
+        with self._lock:
+            self.statements += 1
+
+            if sql.lstrip().startswith("INSERT INTO \"eranaAPI_action\""):
+                now = time.monotonic()
+                self.actions.extend(rows)
+                self.inserts.extend((now, row[4]) for row in rows)
+                for row in rows:
+                    self.latest[row[4]] = (row[2], row[3], row[5])
+                return []
+
+            if "DISTINCT ON (item_id)" in sql:
+                return [(item_id,) + self.latest[item_id] for item_id in args[0] if item_id in self.latest]
+
+        if "information_schema.columns" in sql:
+            return [(1,)]
+        if "SELECT access_token, ip_address" in sql:
+            return [(self.bridge.access_token, self.bridge.ip)]
+        if '"id" = ANY' in sql:
+            return [item for item in self.items if item[0] in args[0]]
+        if "= ANY" in sql:
+            return [item for item in self.items if item[1] in args[0] or item[2] in args[0]]
+        if "'phillips_hue_bridge_light'" in sql:
+            return list(self.items)
+        if "RETURNING id" in sql:
+            return [(1,)]
+        return []
+
+
+def _percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def _change_latencies(changes, inserts, since):
+    # Matches every bridge change to the first action saved for that light at or after it.
+    # Changes that were never saved are returned as missed.
+    saved = {}
+    for saved_at, item_id in inserts:
+        saved.setdefault(str(item_id), []).append(saved_at)
+
+    latencies = []
+    missed = 0
+
+    for changed_at, key in changes:
+        if changed_at < since:
+            continue
+        times = saved.get(key, [])
+        index = bisect.bisect_left(times, changed_at)
+        if index < len(times):
+            latencies.append(times[index] - changed_at)
+        else:
+            missed += 1
+
+    return latencies, missed
+
+
+def bench_monitor(light_count=100, change_rate=20, duration=10, latency=0, failure_rate=0, failure_mode="error", mode="poll"):
+    """
+    Runs the `PhillipsHueBridgeLight` monitor loop against a `FakeHueBridge` that changes
+    lights on its own, saving actions to a `StubDatabase`.
+
+    Parameters
+    ----------
+    `light_count <int>`
+    Lights on the fake bridge
+
+    `change_rate <float>`
+    Light changes per second made by the fake bridge
+
+    `duration <float>`
+    Seconds to monitor for
+
+    `latency <float>`
+    Seconds the fake bridge adds to every response
+
+    `failure_rate <float>`
+    Fraction of bridge requests that fail, see `FakeHueBridge`
+
+    `failure_mode <string>`
+    `"error"` or `"drop"`, see `FakeHueBridge`
+
+    `mode <string>`
+    `"poll"` or `"stream"`, as in `PhillipsHueBridgeLight.run`
+
+    Returns
+    ----------
+    `results <dictionary>`
+    Events saved per second, end-to-end change latencies (from the bridge changing a light to
+    its action being inserted), reader and diff stage CPU per poll and request counts
+    """
+    # Imported here since it needs the shared db utils; the micro-benchmarks don't
+    from .events import AdaptivePoller
+    from .main import PhillipsHueBridgeLight
+
+    bridge = FakeHueBridge(light_count=light_count, change_rate=change_rate, latency=latency,
+                           failure_rate=failure_rate, failure_mode=failure_mode)
+    db = StubDatabase(bridge)
+    bridge.start()
+
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            light_control = PhillipsHueBridgeLight(db, journal_path=os.path.join(directory, "actions.journal"),
+                                                   cache_path=os.path.join(directory, "startup_cache.json"))
+            light_control.stream_scheme = "http"
+            light_control.item_ids.preload()
+            light_control.state = snapshot(light_control.get_lights(light_control.bridge_connect()))
+
+            started = time.monotonic()
+            cpu = time.thread_time() - light_control.pipeline.cpu_seconds
+
+            if mode == "stream":
+                # Closing the bridge's streams makes _follow_event_stream return
+                timer = threading.Timer(duration, bridge.close_streams)
+                timer.start()
+                try:
+                    light_control._follow_event_stream()
+                finally:
+                    timer.cancel()
+            else:
+                light_control._poll_for_changes(AdaptivePoller(), duration=duration)
+
+            # One last check so changes made since the last poll are counted as saved, not missed
+            elapsed = time.monotonic() - started
+            light_control.pipeline.drain()
+            light_control._check_for_changes()
+            light_control.pipeline.stop()
+            # The reader and the diff stage run on separate threads
+            cpu = time.thread_time() + light_control.pipeline.cpu_seconds - cpu
+            bridge.stop()
+
+            # The final flush counts: anything detected should reach the database
+            light_control.writer.stop()
+            light_control.journal.close()
+            light_control.startup_cache.flush()
+            light_control.connections.invalidate("benchmark finished")
+    finally:
+        bridge.stop()
+
+    polls = light_control.metrics.counters["polls"]
+    changes = [change for change in bridge.changes if change[0] <= started + elapsed]
+    latencies, missed = _change_latencies(changes, db.inserts, started)
+
+    return {
+        "mode": mode,
+        "lights": light_count,
+        "seconds": elapsed,
+        "changes": len(latencies) + missed,
+        "events": len(db.actions),
+        "events_per_second": len(db.actions) / elapsed,
+        "polls": polls,
+        "cpu_per_poll": cpu / polls if polls else None,
+        "latency_p50": _percentile(latencies, 0.5),
+        "latency_p95": _percentile(latencies, 0.95),
+        "latency_max": max(latencies) if latencies else None,
+        "missed": missed,
+        "requests": sum(bridge.requests.values()),
+        "failures": bridge.failures,
+    }
+
+
+# Share of the peak change rate in each hour of a simulated day: a morning bump, a busy
+# evening and a quiet night
+DAILY_ACTIVITY = (0.02, 0.01, 0.01, 0.01, 0.01, 0.02, 0.2, 0.5, 0.4, 0.15, 0.1, 0.1,
+                  0.15, 0.1, 0.1, 0.1, 0.2, 0.5, 0.8, 1.0, 1.0, 0.8, 0.5, 0.15)
+
+
+def simulated_changes(days, peak_rate=120, seed=1):
+    """
+    Returns light change times for `days` simulated days, in seconds from the first midnight,
+    drawn as a Poisson process whose hourly rate follows `DAILY_ACTIVITY`.
+
+    Parameters
+    ----------
+    `peak_rate <float>`
+    Changes per hour in the busiest hours
+    """
+    rng = random.Random(seed)
+    changes = []
+
+    for hour in range(days * 24):
+        rate = peak_rate * DAILY_ACTIVITY[hour % 24] / 3600
+
+        if rate <= 0:
+            continue
+
+        t = hour * 3600 + rng.expovariate(rate)
+        while t < (hour + 1) * 3600:
+            changes.append(t)
+            t += rng.expovariate(rate)
+
+    return changes
+
+
+def _simulate_polling(poller, changes, start, end, midnight):
+    # Replays `changes` against `poller` in simulated time between `start` and `end` seconds
+    now = start
+    poller.clock = lambda: midnight + datetime.timedelta(seconds=now)
+    index = bisect.bisect_left(changes, start)
+    latencies = []
+    requests = 0
+
+    while now < end:
+        requests += 1
+        changed = False
+
+        while index < len(changes) and changes[index] <= now:
+            latencies.append(now - changes[index])
+            index += 1
+            changed = True
+
+        now += poller.next_interval(changed)
+
+    return latencies, requests
+
+
+def bench_polling(days=7, peak_rate=120, seed=1):
+    """
+    Simulates the poll loop over `days` days of light changes (see `simulated_changes`) and
+    compares how many requests each poll strategy sends with how late it sees changes. Runs in
+    simulated time, so it takes a second or two.
+
+    The time of day strategy learns its `ActivityProfile` from one extra day of changes
+    before the simulated days start.
+
+    Returns
+    ----------
+    `results <array>`
+    An object per strategy with "strategy", "requests_per_day", "latency_p50", "latency_p95",
+    "latency_max" and "changes"
+    """
+    from .activity import ActivityProfile
+    from .events import AdaptivePoller
+
+    midnight = datetime.datetime(2024, 1, 1)
+    changes = simulated_changes(days + 1, peak_rate, seed)
+    training_end = bisect.bisect_left(changes, 86400)
+
+    profile = ActivityProfile()
+    for change in changes[:training_end]:
+        profile.observe(midnight + datetime.timedelta(seconds=change))
+
+    strategies = (
+        ("fixed 1 s", AdaptivePoller(min_interval=1, max_interval=1)),
+        ("adaptive 0.5-5 s", AdaptivePoller()),
+        ("adaptive 0.5-10 s", AdaptivePoller(max_interval=10)),
+        ("time of day 0.5-2-10 s", AdaptivePoller(max_interval=10, active_interval=2, profile=profile)),
+    )
+    results = []
+
+    for name, poller in strategies:
+        latencies, requests = _simulate_polling(poller, changes, 86400, (days + 1) * 86400, midnight)
+        latencies.sort()
+        results.append({
+            "strategy": name,
+            "changes": len(latencies),
+            "requests_per_day": requests / days,
+            "latency_p50": _percentile(latencies, 0.5),
+            "latency_p95": _percentile(latencies, 0.95),
+            "latency_max": latencies[-1] if latencies else None,
+        })
+
+    return results
+
+
+def bench_outage(outage=600, timeout=3, seed=1):
+    """
+    Simulates the poll loop through a bridge outage of `outage` seconds, with and without a
+    `CircuitBreaker`, in simulated time. Every request to the bridge while it's down waits
+    out the `timeout`.
+
+    Returns
+    ----------
+    `results <array>`
+    An object per setup with "setup", "requests" (sent during the outage), "blocked" (seconds
+    spent waiting on timeouts) and "recovery" (seconds from the bridge coming back to the
+    first good response)
+    """
+    from .breaker import CircuitBreaker
+    from .events import AdaptivePoller
+
+    results = []
+
+    for name, make_breaker in (("no breaker", None),
+                               ("breaker 2-30 s", lambda clock: CircuitBreaker(clock=clock, rng=random.Random(seed)))):
+        now = [0.0]
+        breaker = make_breaker(lambda: now[0]) if make_breaker is not None else None
+        poller = AdaptivePoller()
+        down, up = 60, 60 + outage
+        requests = 0
+        blocked = 0
+        recovery = None
+
+        while recovery is None:
+            if breaker is None or breaker.allow():
+                if down <= now[0] < up:
+                    requests += 1
+                    blocked += timeout
+                    now[0] += timeout
+                    if breaker is not None:
+                        breaker.failure()
+                else:
+                    if now[0] >= up:
+                        recovery = now[0] - up
+                    if breaker is not None:
+                        breaker.success()
+
+            now[0] += poller.next_interval(False)
+
+        results.append({"setup": name, "requests": requests, "blocked": blocked, "recovery": recovery})
+
+    return results
+
+
+def _format_seconds(seconds):
+    return "n/a" if seconds is None else f"{seconds * 1e3:.1f} ms"
+
+
+def main():
+    print("diff_lights: nested loop vs uniqueid index (per diff)")
+
+    for size, nested, indexed in bench_diff():
+        print(f"  {size:>5} lights  nested {nested * 1e6:>10.1f} us  indexed {indexed * 1e6:>8.1f} us  ({nested / indexed:.1f}x)")
+
+    memory = bench_snapshot_memory()
+    print("old_state footprint for 1000 lights")
+    print(f"  raw bridge object  {memory['raw_retained'] / 1024:>8.1f} KiB retained")
+    print(f"  compact snapshot   {memory['compact_retained'] / 1024:>8.1f} KiB retained")
+    print(f"  per tick peak      {memory['tick_peak'] / 1024:>8.1f} KiB allocated (parse {memory['parse_peak'] / 1024:.1f} KiB)")
+    print(f"  convert            {memory['convert_seconds'] * 1e3:>8.2f} ms")
+
+    print("monitor loop against a fake bridge (100 lights, 20 changes/s, 10 s)")
+    for mode, failure_rate in (("poll", 0), ("poll", 0.05), ("stream", 0)):
+        try:
+            result = bench_monitor(mode=mode, failure_rate=failure_rate)
+        except ImportError as err:
+            print(f"  skipped, the monitor can't be imported here: {err}")
+            break
+
+        print(f"  {mode:<6} failures {failure_rate:>4.0%}  {result['events_per_second']:>6.1f} events/s  "
+              f"latency p50 {_format_seconds(result['latency_p50'])} p95 {_format_seconds(result['latency_p95'])}  "
+              f"cpu/poll {_format_seconds(result['cpu_per_poll'])}  {result['polls']} polls  "
+              f"{result['requests']} requests  {result['missed']} missed")
+
+    print("poll strategies over 7 simulated days (120 changes/h at the evening peak)")
+    for result in bench_polling():
+        print(f"  {result['strategy']:<24} {result['requests_per_day']:>8.0f} requests/day  "
+              f"latency p50 {_format_seconds(result['latency_p50'])} p95 {_format_seconds(result['latency_p95'])} "
+              f"max {_format_seconds(result['latency_max'])}")
+
+    print("poll loop through a 10 minute bridge outage (3 s request timeout)")
+    for result in bench_outage():
+        print(f"  {result['setup']:<16} {result['requests']:>4} requests  {result['blocked']:>5.0f} s blocked  "
+              f"recovered in {result['recovery']:.1f} s")
+
+
+if __name__ == "__main__":
+    main()
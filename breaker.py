@@ -0,0 +1,202 @@
+import logging
+import random
+import threading
+import time
+
+log = logging.getLogger('modules')
+
+
+class CircuitOpen(Exception):
+    """
+    Raised by `CircuitBreaker.call` instead of calling the bridge while the circuit is open.
+    """
+
+
+class CircuitBreaker():
+    """
+    Stops sending requests to a bridge that keeps failing, and finds out when it's back with
+    one request at a time.
+
+    While closed every request goes through. After `failure_threshold` failures in a row the
+    circuit opens and requests are refused without touching the network. Once `reset_timeout`
+    seconds have passed it goes half-open and lets a single probe through: if the probe
+    succeeds the circuit closes, if it fails the circuit opens again for `backoff` times as
+    long, up to `max_reset_timeout`. Each open period is shortened by up to `jitter` of itself
+    so monitors that lost the bridge together don't probe it in step.
+
+    An outage therefore costs `failure_threshold` requests plus one probe per open period, and
+    recovery is noticed within `max_reset_timeout` seconds.
+
+    Parameters
+    ----------
+    `failure_threshold <int>`
+    Failures in a row before the circuit opens
+
+    `reset_timeout <float>`
+    Seconds the circuit stays open the first time it opens
+
+    `max_reset_timeout <float>`
+    Upper bound on the seconds between probes
+
+    `backoff <float>`
+    Multiplier applied to the open period after each failed probe
+
+    `jitter <float>`
+    Fraction of each open period that's randomised
+
+    `on_change <function>`
+    Called as on_change(old_state, new_state) after every state change
+
+    `clock <function>`
+    Returns the current time in seconds. Defaults to `time.monotonic`
+
+    `rng <random.Random>`
+    Source of the jitter
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, failure_threshold=3, reset_timeout=2, max_reset_timeout=30, backoff=2, jitter=0.2,
+                 on_change=None, clock=None, rng=None):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max(reset_timeout, max_reset_timeout)
+        self.backoff = backoff
+        self.jitter = jitter
+        self.on_change = on_change
+        self.clock = clock or time.monotonic
+        self.rng = rng or random.Random()
+
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened = 0
+        self.rejected = 0
+
+        self._outage_since = None
+        self._open_for = reset_timeout
+        self._retry_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f"<CircuitBreaker {self.state} failures={self.failures}>"
+
+    def allow(self):
+        """
+        Whether a request may go to the bridge now. In the half-open state only the first
+        caller gets through; it must report back with `success` or `failure`.
+        """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+
+            change = None
+
+            if self.state == self.OPEN and self.clock() >= self._retry_at:
+                change = self._set(self.HALF_OPEN)
+
+            allowed = self.state == self.HALF_OPEN and not self._probing
+
+            if allowed:
+                self._probing = True
+            else:
+                self.rejected += 1
+
+        self._notify(change)
+        return allowed
+
+    def success(self):
+        """
+        Reports a request that worked. Closes the circuit.
+        """
+        with self._lock:
+            self.failures = 0
+            self._probing = False
+            self._outage_since = None
+            self._open_for = self.reset_timeout
+            change = self._set(self.CLOSED)
+
+        self._notify(change)
+
+    def failure(self):
+        """
+        Reports a request that failed. Opens the circuit after `failure_threshold` failures in
+        a row, or straight away if it was a half-open probe.
+        """
+        with self._lock:
+            self.failures += 1
+            change = None
+
+            if self.state == self.HALF_OPEN:
+                self._probing = False
+                self._open_for = min(self._open_for * self.backoff, self.max_reset_timeout)
+                change = self._open()
+            elif self.state == self.CLOSED and self.failures >= self.failure_threshold:
+                self._outage_since = self.clock()
+                change = self._open()
+
+        self._notify(change)
+
+    def reset(self):
+        """
+        Closes the circuit, e.g. once discovery has found the bridge again.
+        """
+        self.success()
+
+    def call(self, func, *args, **kwargs):
+        """
+        Calls `func` through the breaker. Raises `CircuitOpen` without calling it while the
+        circuit is open, and re-raises anything `func` raises after counting it as a failure.
+        """
+        if not self.allow():
+            raise CircuitOpen(f"Circuit open, next probe in {self.retry_in():.1f}s")
+
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            self.failure()
+            raise
+
+        self.success()
+        return result
+
+    def outage(self):
+        """
+        Seconds since the circuit first opened in the current outage. 0 while closed.
+        """
+        since = self._outage_since
+        return 0 if since is None else self.clock() - since
+
+    def retry_in(self):
+        """
+        Seconds until the next probe is allowed. 0 unless the circuit is open.
+        """
+        with self._lock:
+            if self.state != self.OPEN:
+                return 0
+            return max(0, self._retry_at - self.clock())
+
+    def _open(self):
+        period = self._open_for * (1 - self.jitter * self.rng.random())
+        self._retry_at = self.clock() + period
+        self.opened += 1
+        return self._set(self.OPEN)
+
+    def _set(self, state):
+        if state == self.state:
+            return None
+        old, self.state = self.state, state
+        return old, state
+
+    def _notify(self, change):
+        if change is None:
+            return
+
+        log.debug("[INFO]: Bridge circuit %s -> %s", *change)
+
+        if self.on_change is not None:
+            try:
+                self.on_change(*change)
+            except Exception as err:
+                log.error(f"[ERROR]: Error handling bridge circuit change: {err}")
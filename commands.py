@@ -0,0 +1,235 @@
+import logging
+import threading
+import time
+
+log = logging.getLogger('modules')
+
+# The bridge handles about 10 light commands a second, but only about 1 group command
+LIGHT_COMMAND_RATE = 10
+GROUP_COMMAND_RATE = 1
+
+
+class TokenBucket():
+    """
+    Paces requests to `rate` per second, allowing bursts of up to `capacity`.
+
+    Parameters
+    ----------
+    `rate <float>`
+    Tokens added per second
+
+    `capacity <float>`
+    Most tokens the bucket holds. Defaults to `rate`
+    """
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        """
+        Takes a token, sleeping until one is available.
+
+        Returns
+        ----------
+        `waited <float>`
+        Seconds spent waiting
+        """
+        waited = 0.0
+
+        while True:
+            with self._lock:
+                self._refill(time.monotonic())
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                delay = (1 - self.tokens) / self.rate
+
+            time.sleep(delay)
+            waited += delay
+
+
+def _state_key(state):
+    return tuple(sorted((k, tuple(v) if isinstance(v, list) else v) for k, v in state.items()))
+
+
+class LightCommander():
+    """
+    Sends light commands in bulk. Lights are resolved through the monitor's snapshot instead
+    of a fresh light dump, lights that get the same state are collapsed into group actions
+    where a bridge group covers them, and whatever is left is sent light by light, paced under
+    the bridge's rate limits.
+
+    Parameters
+    ----------
+    `get_bridge <function>`
+    Returns the `BridgeClient` to send commands to
+
+    `get_lights <function>`
+    Returns the current light snapshot, {uniqueid: LightState}
+
+    `min_group_size <int>`
+    Smallest group worth a group action. Group actions are rate limited harder than light
+    commands, so small groups are cheaper sent light by light.
+
+    `group_ttl <float>`
+    Seconds to cache the bridge's group list
+    """
+    def __init__(self, get_bridge, get_lights, min_group_size=3, group_ttl=300):
+        self.get_bridge = get_bridge
+        self.get_lights = get_lights
+        self.min_group_size = min_group_size
+        self.group_ttl = group_ttl
+
+        self.light_bucket = TokenBucket(LIGHT_COMMAND_RATE)
+        self.group_bucket = TokenBucket(GROUP_COMMAND_RATE)
+
+        self._groups = None
+        self._groups_at = None
+
+    def groups(self, bridge, all_keys):
+        """
+        Returns the bridge groups as {group id: frozenset of light keys}, including group "0"
+        (every light). Cached for `group_ttl` seconds.
+        """
+        now = time.monotonic()
+
+        if self._groups is None or now - self._groups_at > self.group_ttl:
+            try:
+                groups = bridge.get("groups")
+                self._groups = {group_id: frozenset(group.get("lights", [])) for group_id, group in groups.items()}
+            except Exception as err:
+                log.error(f"[ERROR]: Error fetching bridge groups: {err}")
+                self._groups = {}
+            self._groups_at = now
+
+        groups = dict(self._groups)
+        groups["0"] = frozenset(all_keys)
+        return groups
+
+    def invalidate_groups(self):
+        self._groups = None
+
+    def resolve(self, lights, identifiers):
+        """
+        Maps uniqueids or names to bridge light keys.
+
+        Returns
+        ----------
+        `keys <dictionary>`
+        An object in the form {identifier: key}. Unknown identifiers are left out.
+        """
+        by_name = None
+        keys = {}
+
+        for identifier in identifiers:
+            light = lights.get(identifier)
+
+            if light is None:
+                if by_name is None:
+                    by_name = {light.name: light for light in lights.values()}
+                light = by_name.get(identifier)
+
+            if light is not None:
+                keys[identifier] = light.key
+
+        return keys
+
+    def plan(self, targets, lights, groups):
+        """
+        Works out the requests for a set of targets without sending them.
+
+        Parameters
+        ----------
+        `targets <dictionary>`
+        An object in the form {uniqueid or name: state}, where state is a dictionary like
+        {"on": True, "bri": 200} or a boolean for just "on"
+
+        Returns
+        ----------
+        `requests <array>`
+        (path, body) pairs, group actions first
+        """
+        keys = self.resolve(lights, targets)
+
+        for identifier in targets:
+            if identifier not in keys:
+                log.error(f"[ERROR]: Light {identifier} isn't on the bridge, skipping it")
+
+        # Lights that end up in the same state can share a group action
+        by_state = {}
+        for identifier, key in keys.items():
+            state = targets[identifier]
+            if not isinstance(state, dict):
+                state = {"on": bool(state)}
+            by_state.setdefault(_state_key(state), (state, set()))[1].add(key)
+
+        group_requests = []
+        light_requests = []
+        candidates = sorted(groups.items(), key=lambda item: len(item[1]), reverse=True)
+
+        for state, remaining in by_state.values():
+            for group_id, members in candidates:
+                if len(members) >= self.min_group_size and members <= remaining:
+                    group_requests.append((f"groups/{group_id}/action", state))
+                    remaining -= members
+
+            for key in sorted(remaining, key=lambda key: (len(key), key)):
+                light_requests.append((f"lights/{key}/state", state))
+
+        return group_requests + light_requests
+
+    def apply(self, targets):
+        """
+        Sets many lights at once.
+
+        Parameters
+        ----------
+        `targets <dictionary>`
+        An object in the form {uniqueid or name: state}, as for `plan`
+
+        Returns
+        ----------
+        `results <array>`
+        An object per request in the form {"path": ..., "body": ..., "ok": bool, "latency": seconds}
+        """
+        bridge = self.get_bridge()
+
+        if bridge is None:
+            log.error("[ERROR]: No bridge connection, can't send light commands")
+            return []
+
+        lights = self.get_lights()
+        requests = self.plan(targets, lights, self.groups(bridge, [light.key for light in lights.values()]))
+        results = []
+
+        for path, body in requests:
+            bucket = self.group_bucket if path.startswith("groups/") else self.light_bucket
+            bucket.acquire()
+            started = time.monotonic()
+
+            try:
+                bridge.put(path, body)
+                ok = True
+            except Exception as err:
+                log.error(f"[ERROR]: Error sending {body} to {path}: {err}")
+                ok = False
+
+            results.append({"path": path, "body": body, "ok": ok, "latency": time.monotonic() - started})
+
+        log.debug(f"[INFO]: Sent {len(targets)} light targets as {len(requests)} requests")
+        return results
+
+    def recall_scene(self, scene_id, group_id="0"):
+        """
+        Recalls a bridge scene with one group action.
+        """
+        bridge = self.get_bridge()
+        self.group_bucket.acquire()
+        return bridge.put(f"groups/{group_id}/action", {"scene": scene_id})
@@ -0,0 +1,236 @@
+import logging
+import threading
+import time
+
+from .db import fetch_phillips_active_bridge
+
+log = logging.getLogger('modules')
+
+
+class BridgeError(Exception):
+    """
+    An error response from the bridge, e.g. [{"error": {"type": 1, ...}}]
+    """
+    def __init__(self, message, type_id=None, address=None):
+        super().__init__(message)
+        self.type_id = type_id
+        self.address = address
+
+
+def create_session(pool_connections=1, pool_maxsize=4):
+    """
+    Returns a keep-alive `requests.Session` for talking to bridges.
+
+    Parameters
+    ----------
+    `pool_connections <int>`
+    Number of bridges (hosts) to keep connection pools for
+
+    `pool_maxsize <int>`
+    Connections kept open per bridge
+    """
+    # Imported here so importing the module doesn't load requests before the first request
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    session = requests.Session()
+    session.mount("http://", HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize))
+    session.headers.update({'content-type': 'application/json'})
+    return session
+
+
+class BridgeClient():
+    """
+    A minimal Hue v1 API client that sends every request over one keep-alive session
+
+    Parameters
+    ----------
+    `ip <string>`
+    The bridge IP, optionally with a port
+
+    `access_token <string>`
+    The username token for the bridge
+
+    `timeout <float>`
+    Seconds to wait for each request
+
+    `session <requests.Session>`
+    A session to share with other clients. The client makes and owns one if not given
+    """
+    def __init__(self, ip, access_token, timeout=5, session=None):
+        self.ip = ip
+        self.access_token = access_token
+        self.timeout = timeout
+        self.url = f"http://{ip}/api/{access_token}"
+        self.owns_session = session is None
+
+        if session is None:
+            session = create_session()
+        self.session = session
+
+    def __repr__(self):
+        return f"<BridgeClient {self.ip}>"
+
+    def _check(self, response):
+        response.raise_for_status()
+        body = response.json()
+
+        if type(body) == list:
+            errors = [item["error"] for item in body if "error" in item]
+            if errors:
+                raise BridgeError(
+                    ",".join(e["description"] for e in errors),
+                    type_id=",".join(str(e["type"]) for e in errors),
+                    address=errors[0]["address"]
+                )
+        return body
+
+    def get(self, path=""):
+        return self._check(self.session.get(f"{self.url}/{path}", timeout=self.timeout))
+
+    def put(self, path, body):
+        return self._check(self.session.put(f"{self.url}/{path}", json=body, timeout=self.timeout))
+
+    def lights(self):
+        """
+        Returns the bridge light object in the form {1: {data}, 2: {data}, etc...}
+        """
+        return self.get("lights")
+
+    def close(self):
+        if self.owns_session:
+            self.session.close()
+
+
+def is_connection_failure(err):
+    """
+    Whether an error means the cached bridge connection is no good anymore: the bridge
+    rejected the token, or it couldn't be reached at all.
+    """
+    if isinstance(err, BridgeError):
+        return "1" in str(err.type_id).split(",")
+    import requests
+    return isinstance(err, (requests.ConnectionError, requests.Timeout))
+
+
+class BridgeConnectionManager():
+    """
+    Caches the active bridge's token, IP and HTTP session so that a poll costs one request
+    to the bridge instead of a DB round-trip plus a new connection.
+
+    The bridge row is re-read every `check_interval` seconds, and the cache is dropped if the
+    row changed or is gone, or when `report_failure` sees an auth or network failure. If the
+    row can't be read because the database is down, the cached client is kept and the row is
+    checked again after another `check_interval`.
+
+    Parameters
+    ----------
+    `conn <database connection>`
+    The connection to the main Postgres database
+
+    `check_interval <float>`
+    Seconds between checks of the `eranaAPI_item` bridge row
+
+    `metrics <MonitorMetrics>`
+    Optional, counts "reconnects" every time a connection is dropped
+
+    `timeout <float>`
+    Seconds each bridge request may take
+    """
+    def __init__(self, conn, check_interval=60, metrics=None, timeout=5):
+        self.conn = conn
+        self.check_interval = check_interval
+        self.metrics = metrics
+        self.timeout = timeout
+        self.client = None
+        self._row = None
+        self._checked_at = None
+
+        # The error from the last failed bridge row read, `None` once a read succeeds
+        self.row_error = None
+        self._lock = threading.RLock()
+
+    def seed(self, ip, access_token):
+        """
+        Connects to a bridge known from somewhere other than the database, e.g. the startup
+        cache, so the first `get` doesn't wait for the bridge row. The row is still checked
+        after `check_interval`, or straight away with `get(refresh=True)`.
+        """
+        with self._lock:
+            if self.client is not None:
+                self.client.close()
+            self.client = BridgeClient(ip, access_token, timeout=self.timeout)
+            self._row = (access_token, ip)
+            self._checked_at = time.monotonic()
+            log.debug(f"[INFO]: Connected to cached Phillips Hue Bridge at {ip}")
+
+    def get(self, refresh=False):
+        """
+        Returns the cached `BridgeClient`, connecting first if needed.
+
+        Parameters
+        ----------
+        `refresh <boolean>`
+        Re-read the bridge row even if it was checked less than `check_interval` seconds ago
+
+        Returns
+        ----------
+        `client <BridgeClient>`
+        A client for the active bridge, or `None` if there isn't one or the database couldn't
+        be read (see `row_error`)
+        """
+        now = time.monotonic()
+        client, checked_at = self.client, self._checked_at
+
+        if client is not None and checked_at is not None and not refresh and now - checked_at < self.check_interval:
+            return client
+
+        # Read outside the lock, so a slow database doesn't hold up threads using the cached client
+        try:
+            access_token, ip = fetch_phillips_active_bridge(self.conn)
+        except Exception as err:
+            # A database outage says nothing about the bridge; keep using the cached client
+            with self._lock:
+                self.row_error = err
+                if self.client is not None:
+                    self._checked_at = now
+                return self.client
+
+        with self._lock:
+            self.row_error = None
+
+            if access_token is None or ip is None:
+                self.invalidate("no active bridge in the database")
+                return None
+
+            if (access_token, ip) != self._row:
+                if self.client is not None:
+                    self.invalidate("bridge row changed")
+                self.client = BridgeClient(ip, access_token, timeout=self.timeout)
+                self._row = (access_token, ip)
+                log.debug(f"[INFO]: Connected to Phillips Hue Bridge at {ip}")
+
+            self._checked_at = now
+            return self.client
+
+    def invalidate(self, reason=""):
+        """
+        Drops the cached connection so the next `get` re-reads the bridge row.
+        """
+        with self._lock:
+            if self.client is not None:
+                log.debug(f"[INFO]: Dropping Phillips Hue Bridge connection: {reason}")
+                self.client.close()
+                if self.metrics is not None:
+                    self.metrics.inc("reconnects")
+
+            self.client = None
+            self._row = None
+            self._checked_at = None
+
+    def report_failure(self, err):
+        """
+        Drops the cached connection if `err` was an auth or network failure.
+        """
+        if is_connection_failure(err):
+            self.invalidate(str(err))
@@ -1,9 +1,186 @@
+import contextlib
 import datetime
-from django.db import transaction, DatabaseError
+import threading
+import time
+from psycopg2 import DataError, DatabaseError, IntegrityError, InterfaceError, OperationalError
+from psycopg2.extras import execute_values
 import logging
 
 log = logging.getLogger('modules')
 
+
+class PoolExhausted(Exception):
+    pass
+
+
+class ConnectionPool():
+    """
+    A thread-safe pool of Postgres connections, so the monitor, the scheduler and the daily
+    snapshot can each write on their own connection instead of sharing one.
+
+    Connections are checked before they're handed out if they've sat idle for a while, and
+    replaced if they've been closed or fail the check. A connection that breaks while in use
+    is thrown away instead of going back into the pool. Every function in this module takes
+    either a pool or a plain connection.
+
+    Parameters
+    ----------
+    `factory <function>`
+    Opens a new connection, e.g. `create_connection_from_file`
+
+    `maxconn <int>`
+    Most connections open at once. `connection` blocks while they're all in use
+
+    `health_check_interval <float>`
+    Seconds a connection can sit idle before it's checked with `SELECT 1`
+
+    `timeout <float>`
+    Seconds to wait for a free connection before raising `PoolExhausted`
+    """
+    def __init__(self, factory, maxconn=4, health_check_interval=30, timeout=30):
+        self.factory = factory
+        self.maxconn = maxconn
+        self.health_check_interval = health_check_interval
+        self.timeout = timeout
+
+        self._idle = []
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._lock = threading.Lock()
+        self._closed = False
+        self.reconnects = 0
+
+    def _healthy(self, conn, idle_since):
+        if conn.closed:
+            return False
+        if time.monotonic() - idle_since < self.health_check_interval:
+            return True
+
+        try:
+            cur = conn.cursor()
+            try:
+                cur.execute("SELECT 1")
+            finally:
+                cur.close()
+            conn.rollback()
+            return True
+        except (OperationalError, InterfaceError) as e:
+            log.error(f"[ERROR]: Postgres connection failed its health check - {e}")
+            return False
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def getconn(self):
+        """
+        Takes a healthy connection out of the pool, opening one if none are idle.
+        Hand it back with `putconn`.
+        """
+        if self._closed:
+            raise PoolExhausted("Connection pool is closed")
+        if not self._slots.acquire(timeout=self.timeout):
+            raise PoolExhausted(f"No free Postgres connection after {self.timeout}s")
+
+        try:
+            while True:
+                with self._lock:
+                    conn, idle_since = self._idle.pop() if self._idle else (None, None)
+
+                if conn is None:
+                    return self.factory()
+                if self._healthy(conn, idle_since):
+                    return conn
+
+                self._discard(conn)
+                self.reconnects += 1
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def putconn(self, conn, broken=False):
+        """
+        Returns a connection to the pool. Broken or closed connections are closed instead and
+        replaced on the next `getconn`.
+        """
+        try:
+            if broken or conn.closed or self._closed:
+                self._discard(conn)
+                return
+
+            with self._lock:
+                self._idle.append((conn, time.monotonic()))
+        finally:
+            self._slots.release()
+
+    @contextlib.contextmanager
+    def connection(self):
+        """
+        Borrows a connection for the length of a with block. Anything left uncommitted is
+        rolled back when the block ends.
+        """
+        conn = self.getconn()
+        broken = False
+
+        try:
+            yield conn
+        except (OperationalError, InterfaceError):
+            broken = True
+            raise
+        finally:
+            # Anything the rollback raises marks the connection broken, so its slot is always
+            # given back
+            if not broken:
+                try:
+                    conn.rollback()
+                except Exception:
+                    broken = True
+            self.putconn(conn, broken)
+
+    def close(self):
+        self._closed = True
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            self._discard(conn)
+
+
+@contextlib.contextmanager
+def borrow(conn):
+    """
+    Yields a plain connection from a `ConnectionPool`, or `conn` itself if it already is one.
+    For code that needs a real connection, like the shared db utils.
+    """
+    if isinstance(conn, ConnectionPool):
+        with conn.connection() as pooled:
+            yield pooled
+    else:
+        yield conn
+
+
+@contextlib.contextmanager
+def cursor(conn, commit=False):
+    """
+    Opens a cursor on a pooled or plain connection and always closes it. Commits at the end of
+    the block if `commit`, and rolls back if it raises so one failed statement doesn't poison
+    the connection for everyone after it.
+    """
+    with borrow(conn) as db:
+        cur = db.cursor()
+        try:
+            yield cur
+            if commit:
+                db.commit()
+        except Exception:
+            try:
+                db.rollback()
+            except (OperationalError, InterfaceError):
+                pass
+            raise
+        finally:
+            cur.close()
+
 def fetch_phillips_bridges(conn):
     """
     Fetch all bridges
@@ -15,9 +192,9 @@ def fetch_phillips_bridges(conn):
     sql = ''' SELECT * FROM "eranaAPI_item" WHERE "item_type" = 'phillips_hue_bridge' ORDER BY item_type ; '''
 
     try:
-        cur = conn.cursor()
-        cur.execute(sql)
-        return cur.fetchall()
+        with cursor(conn) as cur:
+            cur.execute(sql)
+            return cur.fetchall()
     except Exception as e:
         log.error(f"[ERROR]: Fetch phillips hue bridges - {e}")
 
@@ -25,20 +202,87 @@ def fetch_phillips_active_bridge(conn):
     """
     Fetch active bridge
     :param conn:
-    :return:
+    :return: (access_token, ip_address), or (None, None) if there is no active bridge. Raises if the
+             query fails, so callers can tell a database error from a missing bridge
     """
     
     sql = ''' SELECT access_token, ip_address FROM "eranaAPI_item" WHERE "item_type" = 'phillips_hue_bridge' AND "is_active" = 'true' ; '''
     
     try:
-        cur = conn.cursor()
-        cur.execute(sql, ())
-        access_token, ip_address = cur.fetchone()
-        return access_token, ip_address
+        with cursor(conn) as cur:
+            cur.execute(sql, ())
+            row = cur.fetchone()
     except Exception as e:
         log.error(f"[ERROR]: Fetch active bridge - {e}")
+        raise
+
+    if row is None:
         return None, None
 
+    access_token, ip_address = row
+    return access_token, ip_address
+
+def fetch_phillips_bridge(conn, unique_id):
+    """
+    Fetch one active bridge by its bridge id
+    :param conn:
+    :param unique_id: the bridge id the bridge reports, e.g. from SSDP or /api/config
+    :return: (access_token, ip_address), or (None, None) if that bridge isn't saved. Raises if the
+             query fails
+    """
+
+    sql = ''' SELECT access_token, ip_address FROM "eranaAPI_item" WHERE "item_type" = 'phillips_hue_bridge' AND "is_active" = 'true' AND UPPER("unique_id") = UPPER(%s) ; '''
+
+    try:
+        with cursor(conn) as cur:
+            cur.execute(sql, (unique_id,))
+            row = cur.fetchone()
+    except Exception as e:
+        log.error(f"[ERROR]: Fetch bridge {unique_id} - {e}")
+        raise
+
+    if row is None:
+        return None, None
+
+    access_token, ip_address = row
+    return access_token, ip_address
+
+def fetch_phillips_active_bridges(conn):
+    """
+    Fetch every active bridge
+    :param conn:
+    :return: [(id, access_token, ip_address), ...]. Raises if the query fails, so a database error
+             isn't taken for every bridge being removed
+    """
+
+    sql = ''' SELECT id, access_token, ip_address FROM "eranaAPI_item" WHERE "item_type" = 'phillips_hue_bridge' AND "is_active" = 'true' ORDER BY id ; '''
+
+    try:
+        with cursor(conn) as cur:
+            cur.execute(sql, ())
+            return cur.fetchall()
+    except Exception as e:
+        log.error(f"[ERROR]: Fetch active bridges - {e}")
+        raise
+
+def fetch_phillips_last_bridge_ip(conn):
+    """
+    Fetch the IP of the active bridge, or of any bridge if none is active
+    :param conn:
+    :return:
+    """
+
+    sql = ''' SELECT ip_address FROM "eranaAPI_item" WHERE "item_type" = 'phillips_hue_bridge' ORDER BY is_active DESC LIMIT 1 ; '''
+
+    try:
+        with cursor(conn) as cur:
+            cur.execute(sql, ())
+            row = cur.fetchone()
+        return row[0] if row is not None else None
+    except Exception as e:
+        log.error(f"[ERROR]: Fetch last bridge ip - {e}")
+        return None
+
 def save_phillips_active_bridge_state(conn, username, value):
     """
     Create a new bridge is_active state
@@ -54,14 +298,12 @@ def save_phillips_active_bridge_state(conn, username, value):
               VALUES(%s, %s) RETURNING id ; '''
 
     try:
-        cur = conn.cursor()
-        cur.execute(sql, data_tuple)
-        conn.commit()
-        data = cur.fetchone()[0]
+        with cursor(conn, commit=True) as cur:
+            cur.execute(sql, data_tuple)
+            data = cur.fetchone()[0]
         return data
     except DatabaseError as d:
         log.error(f"[ERROR]: Save phillips active bridge state DB Error - {d}")
-        transaction.rollback()
     except Exception as e:
         log.error(f"[ERROR]: Save phillips active bridge active state - {e}")
 
@@ -78,17 +320,36 @@ def save_phillips_bridge_ip(conn, ip, username):
     sql = ''' UPDATE "eranaAPI_item" SET ip = %s WHERE "username" = %s AND "item_type" = 'phillips_hue_bridge' RETURNING id ;'''
 
     try:
-        cur = conn.cursor()
-        cur.execute(sql, data_tuple)
-        conn.commit()
-        data = cur.fetchone()[0]
+        with cursor(conn, commit=True) as cur:
+            cur.execute(sql, data_tuple)
+            data = cur.fetchone()[0]
         return data
     except DatabaseError as d:
         log.error(f"[ERROR]: Save phillips active bridge ip DB Error - {d}")
-        transaction.rollback()
     except Exception as e:
         log.error(f"[ERROR]: Save phillips bridge ip - {e}")
 
+def save_phillips_active_bridge_ip(conn, ip, unique_id):
+    """
+    Update the IP of one active bridge
+    :param conn:
+    :param ip:
+    :param unique_id: the bridge id, so the other bridges keep their IPs
+    :return:
+    """
+
+    sql = ''' UPDATE "eranaAPI_item" SET ip_address = %s WHERE "item_type" = 'phillips_hue_bridge' AND "is_active" = 'true' AND UPPER("unique_id") = UPPER(%s) RETURNING id ; '''
+
+    try:
+        with cursor(conn, commit=True) as cur:
+            cur.execute(sql, (ip, unique_id))
+            data = cur.fetchone()[0]
+        return data
+    except DatabaseError as d:
+        log.error(f"[ERROR]: Save phillips active bridge ip DB Error - {d}")
+    except Exception as e:
+        log.error(f"[ERROR]: Save phillips active bridge ip - {e}")
+
 def save_brain_status_hue_bridge(conn, status):
     """
     Save the hue_bridge status in the brain status table
@@ -102,29 +363,249 @@ def save_brain_status_hue_bridge(conn, status):
     sql = ''' UPDATE "eranaAPI_brain_ability" SET status = %s WHERE "ability" = %s RETURNING id; '''
 
     try:
-        cur = conn.cursor()
-        cur.execute(sql, data_tuple)
-        conn.commit()
-        data = cur.fetchone()[0]
+        with cursor(conn, commit=True) as cur:
+            cur.execute(sql, data_tuple)
+            data = cur.fetchone()[0]
         return data
     except DatabaseError as d:
         log.error(f"[ERROR]: Save phillips brain_status DB Error - {d}")
-        transaction.rollback()
     except Exception as e:
         log.error(f"[ERROR]: Save brain status for hue bridge - {e}")
 
-def delete_phillips_hue_bridge(conn):
+def delete_phillips_hue_bridge(conn, unique_id):
     """
-    delete bridge information
+    delete one bridge's information
     :param conn:
+    :param unique_id: the bridge id. Other bridges are kept
     :return:
     """
 
-    sql = ''' DELETE * FROM "eranaAPI_item" WHERE "item_type" = 'phillips_hue_bridge'; '''
+    sql = ''' DELETE FROM "eranaAPI_item" WHERE "item_type" = 'phillips_hue_bridge' AND UPPER("unique_id") = UPPER(%s); '''
 
     try:
-        cur = conn.cursor()
-        cur.execute(sql, ())
+        with cursor(conn, commit=True) as cur:
+            cur.execute(sql, (unique_id,))
         return None
     except Exception as e:
-        log.error(f"[ERROR]: Delete hue bridges - {e}")
\ No newline at end of file
+        log.error(f"[ERROR]: Delete hue bridge {unique_id} - {e}")
+
+def replace_phillips_hue_bridge(conn, ip, access_token, unique_id):
+    """
+    Replace one bridge's row with a freshly paired one. The delete and the insert commit
+    together, so a failed insert leaves the old row in place
+    :param conn:
+    :param ip:
+    :param access_token:
+    :param unique_id: the bridge id. Other bridges are kept
+    :return: the new item id, or None if nothing was saved
+    """
+    delete_sql = ''' DELETE FROM "eranaAPI_item" WHERE "item_type" = 'phillips_hue_bridge' AND UPPER("unique_id") = UPPER(%s); '''
+    insert_sql = ''' INSERT INTO "eranaAPI_item" (ip_address, access_token, is_active, item_type, manufacturer, name, energy_watts, unique_id)
+                      VALUES (%s, %s, true, 'phillips_hue_bridge', 'Phillips Manufacturing', 'Phillips Hue Bridge', 1.6792, %s) RETURNING id ; '''
+
+    try:
+        with cursor(conn, commit=True) as cur:
+            cur.execute(delete_sql, (unique_id,))
+            cur.execute(insert_sql, (ip, access_token, unique_id))
+            data = cur.fetchone()[0]
+        return data
+    except DatabaseError as d:
+        log.error(f"[ERROR]: Replace hue bridge {unique_id} DB Error - {d}")
+    except Exception as e:
+        log.error(f"[ERROR]: Replace hue bridge {unique_id} - {e}")
+
+def fetch_light_items(conn, keys=None):
+    """
+    Fetch light items, either all of them or the ones whose unique_id or name is in keys
+    :param conn:
+    :param keys:
+    :return: [(id, unique_id, name), ...]. Raises if the query fails, so a database outage isn't
+             mistaken for lights that don't exist
+    """
+
+    if keys is None:
+        sql = ''' SELECT id, unique_id, name FROM "eranaAPI_item" WHERE "item_type" = 'phillips_hue_bridge_light' ; '''
+        data_tuple = ()
+    else:
+        sql = ''' SELECT id, unique_id, name FROM "eranaAPI_item" WHERE "item_type" = 'phillips_hue_bridge_light' AND ("unique_id" = ANY(%s) OR "name" = ANY(%s)) ; '''
+        data_tuple = (list(keys), list(keys))
+
+    try:
+        with cursor(conn) as cur:
+            cur.execute(sql, data_tuple)
+            return cur.fetchall()
+    except Exception as e:
+        log.error(f"[ERROR]: Fetch light items - {e}")
+        raise
+
+def fetch_light_items_by_id(conn, item_ids):
+    """
+    Fetch light items by item id. Ids of other kinds of items are left out
+    :param conn:
+    :param item_ids:
+    :return: [(id, unique_id, name), ...]. Raises if the query fails
+    """
+
+    sql = ''' SELECT id, unique_id, name FROM "eranaAPI_item" WHERE "item_type" = 'phillips_hue_bridge_light' AND "id" = ANY(%s) ; '''
+
+    try:
+        with cursor(conn) as cur:
+            cur.execute(sql, (list(item_ids),))
+            return cur.fetchall()
+    except Exception as e:
+        log.error(f"[ERROR]: Fetch light items by id - {e}")
+        raise
+
+def fetch_scheduled_light_predictions_after(conn, last_id):
+    """
+    Fetch the light predictions added since last_id, in the same (id, time, status, light_id)
+    form as fetch_scheduled_light_predictions
+    :param conn:
+    :param last_id:
+    :return:
+    """
+
+    sql = ''' SELECT id, time, status, light_id FROM "eranaAPI_light_prediction" WHERE "id" > %s ORDER BY id ; '''
+
+    try:
+        with cursor(conn) as cur:
+            cur.execute(sql, (last_id,))
+            return cur.fetchall()
+    except Exception as e:
+        log.error(f"[ERROR]: Fetch scheduled light predictions after {last_id} - {e}")
+        return []
+
+# Whether "eranaAPI_action" has the value column, once action_values_supported has checked
+_action_value_column = None
+
+def action_values_supported(conn):
+    """
+    Check whether "eranaAPI_action" has the value column for the encoded extra light fields. It is
+    added by the Django app's migration, so older databases may not have it yet. Checked once per
+    process
+    :param conn:
+    :return: True if the column exists. Raises if the check fails
+    """
+    global _action_value_column
+
+    if _action_value_column is None:
+        sql = ''' SELECT 1 FROM information_schema.columns WHERE table_name = 'eranaAPI_action' AND column_name = 'value' ; '''
+
+        try:
+            with cursor(conn) as cur:
+                cur.execute(sql, ())
+                found = cur.fetchone() is not None
+        except Exception as e:
+            log.error(f"[ERROR]: Check action value column - {e}")
+            raise
+
+        if not found:
+            log.error('[ERROR]: "eranaAPI_action" has no value column, only on/reachable are saved. Add it with '
+                      'ALTER TABLE "eranaAPI_action" ADD COLUMN value varchar(96) NULL ;')
+        _action_value_column = found
+
+    return _action_value_column
+
+def fetch_latest_light_actions(conn, item_ids):
+    """
+    Fetch the most recent action saved for each of the given light items
+    :param conn:
+    :param item_ids:
+    :return: [(item_id, is_on, is_reachable, value), ...], one row per item that has any actions. value
+             is None if the table has no value column. Raises if the query fails
+    """
+
+    if action_values_supported(conn):
+        sql = ''' SELECT DISTINCT ON (item_id) item_id, is_on, is_reachable, value FROM "eranaAPI_action" WHERE "item_id" = ANY(%s) ORDER BY item_id, event_time DESC ; '''
+    else:
+        sql = ''' SELECT DISTINCT ON (item_id) item_id, is_on, is_reachable, NULL FROM "eranaAPI_action" WHERE "item_id" = ANY(%s) ORDER BY item_id, event_time DESC ; '''
+
+    try:
+        with cursor(conn) as cur:
+            cur.execute(sql, (list(item_ids),))
+            return cur.fetchall()
+    except Exception as e:
+        log.error(f"[ERROR]: Fetch latest light actions - {e}")
+        raise
+
+def fetch_light_action_counts_by_hour(conn, since):
+    """
+    Count the light actions saved since a given time by the hour of the day they happened in
+    :param conn:
+    :param since:
+    :return: [(hour, count), ...], only hours that have any actions
+    """
+
+    sql = ''' SELECT EXTRACT(HOUR FROM a.event_time)::int, COUNT(*) FROM "eranaAPI_action" a JOIN "eranaAPI_item" i ON i.id = a.item_id WHERE i.item_type = 'phillips_hue_bridge_light' AND a.event_time >= %s GROUP BY 1 ; '''
+
+    try:
+        with cursor(conn) as cur:
+            cur.execute(sql, (since,))
+            return cur.fetchall()
+    except Exception as e:
+        log.error(f"[ERROR]: Fetch light action counts by hour - {e}")
+        return []
+
+def create_actions(conn, actions):
+    """
+    Create many actions with a single multi-row insert, committed in one transaction
+    :param conn:
+    :param actions: [(event_time, has_value, is_on, is_reachable, item_id, value), ...], value being the
+                    encoded extra light fields from tracking.encode_values, or None. The values are
+                    left out if the table has no value column
+    :return: the number of actions inserted
+    """
+
+    if action_values_supported(conn):
+        sql = ''' INSERT INTO "eranaAPI_action" (event_time, has_value, is_on, is_reachable, item_id, value) VALUES %s ; '''
+    else:
+        sql = ''' INSERT INTO "eranaAPI_action" (event_time, has_value, is_on, is_reachable, item_id) VALUES %s ; '''
+        actions = [action[:5] for action in actions]
+
+    try:
+        with cursor(conn, commit=True) as cur:
+            execute_values(cur, sql, actions, page_size=len(actions) or 1)
+        return len(actions)
+    except Exception as e:
+        log.error(f"[ERROR]: Create actions - {e}")
+        raise
+
+def create_actions_row_by_row(conn, actions):
+    """
+    Create actions one row at a time in a single transaction, setting aside the rows the
+    database rejects (e.g. an item id whose item was deleted, or a value that doesn't fit)
+    instead of failing them all. Each row gets a savepoint, so a rejected row is rolled back
+    on its own and the rest still commit together.
+    :param conn:
+    :param actions: as in create_actions
+    :return: (inserted, [rejected actions]). Raises on anything other than a rejected row, in which
+             case nothing is saved
+    """
+
+    if action_values_supported(conn):
+        sql = ''' INSERT INTO "eranaAPI_action" (event_time, has_value, is_on, is_reachable, item_id, value) VALUES %s ; '''
+        width = 6
+    else:
+        sql = ''' INSERT INTO "eranaAPI_action" (event_time, has_value, is_on, is_reachable, item_id) VALUES %s ; '''
+        width = 5
+
+    inserted = 0
+    rejected = []
+
+    try:
+        with cursor(conn, commit=True) as cur:
+            for action in actions:
+                cur.execute("SAVEPOINT action_row ;")
+                try:
+                    execute_values(cur, sql, [action[:width]])
+                except (IntegrityError, DataError) as e:
+                    cur.execute("ROLLBACK TO SAVEPOINT action_row ;")
+                    log.error(f"[ERROR]: Rejected action {action} - {e}")
+                    rejected.append(action)
+                else:
+                    cur.execute("RELEASE SAVEPOINT action_row ;")
+                    inserted += 1
+        return inserted, rejected
+    except Exception as e:
+        log.error(f"[ERROR]: Create actions row by row - {e}")
+        raise
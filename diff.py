@@ -0,0 +1,128 @@
+import operator
+
+from .state import STATE_FIELDS
+
+# State fields compared between two snapshots of the same light
+TRACKED_FIELDS = STATE_FIELDS
+
+
+class LightChanges():
+    """
+    The result of comparing two light snapshots
+
+    Attributes
+    ----------
+    `added <list>`
+    Change records for lights that only exist in the new snapshot
+
+    `removed <list>`
+    Change records for lights that only exist in the old snapshot
+
+    `changed <list>`
+    Change records for lights where at least one tracked field differs
+
+    `state <dictionary>`
+    The snapshot to diff the next one against. With thresholds, lights that only moved by less
+    than their threshold keep their old values, so slow drifts add up until they count.
+    """
+    __slots__ = ("added", "removed", "changed", "state")
+
+    def __init__(self):
+        self.added = []
+        self.removed = []
+        self.changed = []
+        self.state = None
+
+    def __len__(self):
+        return len(self.added) + len(self.removed) + len(self.changed)
+
+    def __bool__(self):
+        return len(self) > 0
+
+    def __repr__(self):
+        return f"<LightChanges added={len(self.added)} removed={len(self.removed)} changed={len(self.changed)}>"
+
+
+def _change_record(light, fields, changed_fields):
+    # We changed this to name because the iOS ability to grab
+    # by serial number is now deprecated. After all, why would Apple
+    # allow you to make useful things?
+    record = {"id": light.key, "uniqueid": light.name, "changed": changed_fields}
+
+    for field in fields:
+        record[field] = getattr(light, field)
+
+    return record
+
+
+def _moved(old, new, threshold):
+    # Whether a field moved by at least its threshold. Strings, booleans and missing values
+    # count any change.
+    if threshold is None or isinstance(new, (bool, str)) or old is None or new is None:
+        return old != new
+    if isinstance(new, tuple):
+        return len(old) != len(new) or any(abs(a - b) >= threshold for a, b in zip(old, new))
+    return abs(new - old) >= threshold
+
+
+def diff_lights(old_state, new_state, fields=TRACKED_FIELDS, thresholds=None):
+    """
+    Compares two light snapshots in a single pass over each. Lights are matched by uniqueid,
+    since snapshots are keyed on it, instead of comparing every light against every other.
+    The cost is one tuple comparison per light whatever the number of fields; fields are only
+    looked at one by one for lights that differ.
+
+    Parameters
+    ----------
+    `old_state <dictionary>`
+    The previous snapshot, from `state.snapshot`
+
+    `new_state <dictionary>`
+    The current snapshot, from `state.snapshot`
+
+    `fields <tuple>`
+    The state fields to compare. Defaults to `TRACKED_FIELDS`
+
+    `thresholds <dictionary>`
+    Optional, the smallest change that counts for numeric fields, e.g. {"bri": 5}. For `xy`
+    it applies to each coordinate
+
+    Returns
+    ----------
+    `changes <LightChanges>`
+    The added, removed and changed lights. Each record is in the form
+    {"id": bridge key, "uniqueid": name, "changed": [fields], "on": ..., "reachable": ..., etc...}
+    """
+    changes = LightChanges()
+    values = operator.attrgetter(*fields)
+    thresholds = thresholds or {}
+    held = None
+
+    for unique_id, new_light in new_state.items():
+        old_light = old_state.get(unique_id)
+
+        if old_light is None:
+            changes.added.append(_change_record(new_light, fields, list(fields)))
+            continue
+
+        # One tuple comparison per light; only work out which fields changed when something did
+        if values(new_light) != values(old_light):
+            changed_fields = [field for field in fields
+                              if _moved(getattr(old_light, field), getattr(new_light, field), thresholds.get(field))]
+
+            if changed_fields:
+                changes.changed.append(_change_record(new_light, fields, changed_fields))
+            else:
+                # Below every threshold: keep comparing against the old values
+                if held is None:
+                    held = {}
+                held[unique_id] = old_light
+
+    changes.state = new_state if held is None else {unique_id: held.get(unique_id, light) for unique_id, light in new_state.items()}
+
+    if len(old_state) > len(new_state) - len(changes.added):
+        for unique_id, old_light in old_state.items():
+            if unique_id not in new_state:
+                changes.removed.append(_change_record(old_light, fields, []))
+
+    return changes
@@ -0,0 +1,394 @@
+import concurrent.futures
+import logging
+import random
+import socket
+import struct
+import threading
+import time
+
+from .db import (fetch_phillips_bridge, fetch_phillips_last_bridge_ip, replace_phillips_hue_bridge,
+                 save_phillips_active_bridge_ip)
+from .status import BrainStatusTracker
+
+log = logging.getLogger('modules')
+
+SSDP_GROUP = ("239.255.255.250", 1900)
+MDNS_GROUP = ("224.0.0.251", 5353)
+MDNS_SERVICE = "_hue._tcp.local"
+
+
+def probe_ssdp(timeout):
+    """
+    Looks for a bridge answering an SSDP M-SEARCH with a `hue-bridgeid` header.
+
+    Returns
+    ----------
+    `bridge <tuple>`
+    (ip, bridge id) or `None`
+    """
+    # Asks responders to answer within MX seconds, which has to fit inside the timeout
+    search = (
+        "M-SEARCH * HTTP/1.1\r\n"
+        f"HOST: {SSDP_GROUP[0]}:{SSDP_GROUP[1]}\r\n"
+        'MAN: "ssdp:discover"\r\n'
+        f"MX: {max(1, min(5, int(timeout)))}\r\n"
+        "ST: ssdp:all\r\n\r\n"
+    )
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 2)
+    deadline = time.monotonic() + timeout
+
+    try:
+        sock.sendto(search.encode(), SSDP_GROUP)
+
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+
+            sock.settimeout(remaining)
+            try:
+                data, (ip, port) = sock.recvfrom(9000)
+            except socket.timeout:
+                return None
+
+            for line in data.decode(errors="ignore").split("\r\n"):
+                name, _, value = line.partition(":")
+                if name.strip().lower() == "hue-bridgeid" and value.strip():
+                    return ip, value.strip().upper()
+    finally:
+        sock.close()
+
+
+def _mdns_query(name):
+    # One PTR question with the unicast-response bit set, so the answer comes back to our
+    # socket rather than to the multicast group
+    qname = b"".join(bytes([len(label)]) + label.encode() for label in name.split(".")) + b"\x00"
+    return struct.pack("!HHHHHH", 0, 0, 1, 0, 0, 0) + qname + struct.pack("!HH", 12, 0x8001)
+
+
+def probe_mdns(timeout):
+    """
+    Looks for a bridge advertising `_hue._tcp` over mDNS.
+
+    Returns
+    ----------
+    `bridge <tuple>`
+    (ip, bridge id) or `None`. The bridge id is `None` if the answer didn't carry one.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 255)
+    deadline = time.monotonic() + timeout
+
+    try:
+        sock.sendto(_mdns_query(MDNS_SERVICE), MDNS_GROUP)
+
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+
+            sock.settimeout(remaining)
+            try:
+                data, (ip, port) = sock.recvfrom(9000)
+            except socket.timeout:
+                return None
+
+            if b"\x04_hue" not in data:
+                continue
+
+            bridge_id = None
+            marker = data.find(b"bridgeid=")
+            if marker != -1:
+                bridge_id = data[marker + 9:marker + 25].decode(errors="ignore").upper()
+
+            return ip, bridge_id
+    finally:
+        sock.close()
+
+
+def probe_ip(ip, timeout):
+    """
+    Checks whether a bridge still answers at a known IP.
+
+    Returns
+    ----------
+    `bridge <tuple>`
+    (ip, bridge id) or `None`
+    """
+    if not ip:
+        return None
+
+    import requests
+
+    response = requests.get(f'http://{ip}/api/config', timeout=timeout)
+    response.raise_for_status()
+    config = response.json()
+
+    if "bridgeid" not in config:
+        return None
+
+    return ip, config["bridgeid"]
+
+
+class BridgeDiscovery():
+    """
+    Finds and pairs with a Phillips Hue Bridge on a background thread, so nothing that needs
+    the bridge has to block while it's missing.
+
+    Each round probes SSDP, mDNS and the last known IP in parallel and takes whichever answers
+    first. If the token saved for that bridge id works at that IP, the bridge's IP is updated.
+    Otherwise it asks the bridge for a new token until the link button is pressed or
+    `pair_timeout` runs out, then saves the bridge in place of its old row. Other bridges'
+    rows are never touched. Failed rounds back off exponentially up to `max_backoff`.
+
+    Progress goes to the brain status table as it happens: "Discovery", "Not Found",
+    "Not Authorized" and finally "Connected".
+
+    Parameters
+    ----------
+    `conn <database connection>`
+    The connection to the main Postgres database
+
+    `status <BrainStatusTracker>`
+    Where progress is published. A new one is made if not given
+
+    `on_found <function>`
+    Called with no arguments once a bridge is saved, e.g. to drop cached connections
+
+    `probe_timeout <float>`
+    Seconds to wait for any probe to answer
+
+    `pair_timeout <float>`
+    Seconds to keep asking for a token before giving up on the round
+
+    `max_backoff <float>`
+    Upper bound on the seconds between failed rounds
+    """
+    IDLE = "idle"
+    DISCOVERING = "discovering"
+    PAIRING = "pairing"
+    CONNECTED = "connected"
+    BACKING_OFF = "backing off"
+
+    def __init__(self, conn, status=None, on_found=None, probe_timeout=5, pair_timeout=60, max_backoff=300):
+        self.conn = conn
+        self.status = status if status is not None else BrainStatusTracker(conn)
+        self.on_found = on_found
+        self.probe_timeout = probe_timeout
+        self.pair_timeout = pair_timeout
+        self.max_backoff = max_backoff
+
+        self.state = self.IDLE
+        self.attempts = 0
+        self.bridge = None
+
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._done = threading.Event()
+        self._thread = None
+
+    def _set_state(self, state, status=None):
+        self.state = state
+        log.debug(f"[INFO]: Bridge discovery {state}")
+        if status is not None:
+            self.status.set(status)
+
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        """
+        Starts discovering in the background. Does nothing if discovery is already running.
+        """
+        with self._lock:
+            if self.running():
+                return self
+
+            self._stopped.clear()
+            self._done.clear()
+            self._thread = threading.Thread(target=self._run, name="hue-bridge-discovery", daemon=True)
+            self._thread.start()
+
+        return self
+
+    def stop(self):
+        self._stopped.set()
+
+    def wait(self, timeout=None):
+        """
+        Blocks until a bridge is connected or discovery stops.
+
+        Returns
+        ----------
+        `bridge <tuple>`
+        (ip, bridge id) of the connected bridge, or `None`
+        """
+        self._done.wait(timeout)
+        return self.bridge if self.state == self.CONNECTED else None
+
+    def find(self):
+        """
+        Runs the probes in parallel and returns the first answer.
+
+        Returns
+        ----------
+        `bridge <tuple>`
+        (ip, bridge id) or `None` if nothing answered within `probe_timeout`
+        """
+        last_ip = fetch_phillips_last_bridge_ip(self.conn)
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=3, thread_name_prefix="hue-probe")
+        probes = {
+            executor.submit(probe_ip, last_ip, self.probe_timeout): "last known ip",
+            executor.submit(probe_mdns, self.probe_timeout): "mDNS",
+            executor.submit(probe_ssdp, self.probe_timeout): "SSDP",
+        }
+
+        try:
+            for future in concurrent.futures.as_completed(probes, timeout=self.probe_timeout):
+                try:
+                    found = future.result()
+                except Exception as err:
+                    log.debug(f"[INFO]: {probes[future]} probe failed: {err}")
+                    continue
+
+                if found is not None:
+                    log.debug(f"[INFO]: Found Phillips Hue Bridge at {found[0]} over {probes[future]}")
+                    return found
+        except concurrent.futures.TimeoutError:
+            pass
+        finally:
+            # Every probe gives up on its own within probe_timeout, so nothing is left hanging
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        return None
+
+    def pair(self, ip):
+        """
+        Asks the bridge for a token once.
+
+        Returns
+        ----------
+        `Username <string>`
+        A username token if the link button was pressed, else `None`
+        """
+        import requests
+
+        payload = {"devicetype": "erana-engine#local_user"}
+        response = requests.post(f'http://{ip}/api', json=payload, timeout=self.probe_timeout)
+        response.raise_for_status()
+
+        for item in response.json():
+            if 'success' in item:
+                log.debug("[INFO]: Successfully authorized and received token")
+                return item['success']['username']
+
+        return None
+
+    def _token_works(self, ip, access_token):
+        if access_token is None:
+            return False
+
+        import requests
+
+        try:
+            response = requests.get(f'http://{ip}/api/{access_token}/config', timeout=self.probe_timeout)
+            # Unauthorized tokens only get the short public config back
+            return "whitelist" in response.json()
+        except Exception:
+            return False
+
+    def _wait_for_token(self, ip):
+        deadline = time.monotonic() + self.pair_timeout
+        delay = 1
+
+        while not self._stopped.is_set() and time.monotonic() < deadline:
+            try:
+                token = self.pair(ip)
+            except Exception as err:
+                log.error(f'[ERROR]: Pairing with bridge at {ip} failed: {err}')
+                return None
+
+            if token is not None:
+                return token
+
+            self._set_state(self.PAIRING, "Not Authorized")
+            self._stopped.wait(delay)
+            delay = min(delay * 2, 5)
+
+        return None
+
+    def _save_bridge(self, ip, token, bridge_id):
+        # Replace this bridge's old row, if it has one, and leave every other bridge alone
+        if replace_phillips_hue_bridge(self.conn, ip, token, bridge_id) is None:
+            raise RuntimeError(f"Couldn't save bridge {bridge_id}")
+
+    def run_once(self):
+        """
+        One discovery and pairing round.
+
+        Returns
+        ----------
+        `bridge <tuple>`
+        (ip, bridge id) if a bridge was connected, else `None`
+        """
+        self._set_state(self.DISCOVERING, "Discovery")
+        found = self.find()
+
+        if found is None:
+            self._set_state(self.DISCOVERING, "Not Found")
+            return None
+
+        ip, bridge_id = found
+
+        # Every save is keyed on the bridge id, so it has to be known before anything is saved
+        if bridge_id is None:
+            found = probe_ip(ip, self.probe_timeout)
+            if found is None:
+                log.error(f"[ERROR]: Bridge at {ip} didn't report its bridge id")
+                self._set_state(self.DISCOVERING, "Not Found")
+                return None
+            ip, bridge_id = found
+
+        access_token, _ = fetch_phillips_bridge(self.conn, bridge_id)
+
+        if self._token_works(ip, access_token):
+            save_phillips_active_bridge_ip(self.conn, ip, bridge_id)
+        else:
+            self._set_state(self.PAIRING)
+            token = self._wait_for_token(ip)
+            if token is None:
+                return None
+
+            self._save_bridge(ip, token, bridge_id)
+
+        self.bridge = found
+        self._set_state(self.CONNECTED, "Connected")
+
+        if self.on_found is not None:
+            self.on_found()
+
+        return found
+
+    def _run(self):
+        self.attempts = 0
+
+        try:
+            while not self._stopped.is_set():
+                self.attempts += 1
+
+                try:
+                    if self.run_once() is not None:
+                        return
+                except Exception as err:
+                    log.error(f"[ERROR]: Bridge discovery round {self.attempts} failed: {err}")
+                    self.status.set("Not Found")
+
+                delay = min(self.max_backoff, 5 * 2 ** (self.attempts - 1)) * random.uniform(0.5, 1.0)
+                self._set_state(self.BACKING_OFF)
+                self._stopped.wait(delay)
+
+            self.state = self.IDLE
+        finally:
+            self._done.set()
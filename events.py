@@ -0,0 +1,210 @@
+import datetime
+import json
+import logging
+import time
+
+
+log = logging.getLogger('modules')
+
+
+def parse_sse(lines):
+    """
+    Parses a server-sent event stream into events.
+
+    Parameters
+    ----------
+    `lines <iterable>`
+    The decoded lines of the stream, without line endings
+
+    Returns
+    ----------
+    `events <generator>`
+    Yields an object in the form {"event": name, "id": id, "data": string} for every
+    complete event. Comments (keep-alives) are skipped.
+    """
+    event = {}
+    data = []
+
+    for line in lines:
+        if line == "":
+            if data:
+                event["data"] = "\n".join(data)
+                event.setdefault("event", "message")
+                yield event
+            event = {}
+            data = []
+            continue
+
+        if line.startswith(":"):
+            continue
+
+        field, _, value = line.partition(":")
+        if value.startswith(" "):
+            value = value[1:]
+
+        if field == "data":
+            data.append(value)
+        elif field in ("event", "id"):
+            event[field] = value
+
+
+def changed_resource_keys(event):
+    """
+    Returns the v1 resources touched by a bridge event.
+
+    Parameters
+    ----------
+    `event <dictionary>`
+    An event as returned by `parse_sse`
+
+    Returns
+    ----------
+    `keys <set>`
+    (resource, key) pairs in the form {("lights", "1"), ("sensors", "12"), ("groups", "3"), etc...}
+    """
+    try:
+        containers = json.loads(event["data"])
+    except (KeyError, ValueError):
+        return set()
+
+    keys = set()
+
+    for container in containers:
+        for resource in container.get("data", []):
+            # v2 resources (light, motion, button, zigbee_connectivity, grouped_light, etc)
+            # point back to the v1 light, sensor or group they belong to
+            resource_type, _, key = (resource.get("id_v1") or "").strip("/").partition("/")
+            if key and resource_type in ("lights", "sensors", "groups"):
+                keys.add((resource_type, key))
+
+    return keys
+
+
+class BridgeEventStream():
+    """
+    Consumes the bridge's server-sent event stream (`/eventstream/clip/v2`)
+
+    Parameters
+    ----------
+    `ip <string>`
+    The bridge IP, optionally with a port
+
+    `access_token <string>`
+    The username token for the bridge
+
+    `scheme <string>`
+    The bridge only serves the stream over `https` with a self-signed certificate
+
+    `timeout <tuple>`
+    (connect, read) timeouts in seconds. The bridge sends a keep-alive at least every
+    minute, so a read timeout longer than that means the stream is dead.
+    """
+    def __init__(self, ip, access_token, scheme="https", timeout=(5, 90)):
+        self.url = f"{scheme}://{ip}/eventstream/clip/v2"
+        self.access_token = access_token
+        self.timeout = timeout
+        self.response = None
+
+    def changes(self, resources=("lights", "sensors", "groups")):
+        """
+        Blocks on the stream and yields every time one of `resources` changes.
+
+        Returns
+        ----------
+        `keys <generator>`
+        Yields the set of (resource, key) pairs changed by each event, e.g. {("sensors", "12")}
+
+        Raises the underlying `requests` exception if the stream can't be opened or drops.
+        """
+        import requests
+
+        headers = {"hue-application-key": self.access_token, "Accept": "text/event-stream"}
+
+        self.response = requests.get(self.url, headers=headers, stream=True, verify=False, timeout=self.timeout)
+        self.response.raise_for_status()
+        log.debug("[INFO]: Opened Phillips Hue event stream at %s", self.url)
+
+        try:
+            # A larger chunk size would hold events back until the buffer fills
+            lines = self.response.iter_lines(chunk_size=1, decode_unicode=True)
+            for event in parse_sse(lines):
+                keys = {(resource_type, key) for resource_type, key in changed_resource_keys(event) if resource_type in resources}
+                if keys:
+                    yield keys
+        finally:
+            self.close()
+
+    def close(self):
+        if self.response is not None:
+            self.response.close()
+            self.response = None
+
+
+class AdaptivePoller():
+    """
+    Works out how long to wait between polls. Polls at `min_interval` right after a change
+    and backs off by `backoff` on every quiet poll, up to `max_interval`.
+
+    With an `ActivityProfile` the idle ceiling follows the time of day instead: in the busiest
+    hour the interval backs off no further than `active_interval`, in an hour without any
+    history all the way to `max_interval`, and in between it scales geometrically with the
+    hour's activity. Until the profile has learned anything every hour counts as half busy.
+
+    Parameters
+    ----------
+    `min_interval <float>`
+    Seconds between polls while lights are changing
+
+    `max_interval <float>`
+    Upper bound on the seconds between polls when idle
+
+    `backoff <float>`
+    Multiplier applied to the interval after each poll without changes
+
+    `active_interval <float>`
+    Upper bound on the seconds between polls when idle in the busiest hour. Only used with a
+    `profile`
+
+    `profile <ActivityProfile>`
+    How busy each hour of the day usually is
+
+    `clock <function>`
+    Returns the current `datetime`, for the time of day. Defaults to `datetime.datetime.now`
+    """
+    def __init__(self, min_interval=0.5, max_interval=5.0, backoff=1.5, active_interval=1.0, profile=None, clock=None):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.active_interval = max(min_interval, min(active_interval, max_interval))
+        self.profile = profile
+        self.clock = clock or datetime.datetime.now
+        self.interval = min_interval
+
+    def ceiling(self):
+        """
+        Returns the most seconds to wait between polls right now.
+        """
+        if self.profile is None:
+            return self.max_interval
+
+        activity = self.profile.activity(self.clock()) if self.profile else 0.5
+        return self.max_interval * (self.active_interval / self.max_interval) ** activity
+
+    def next_interval(self, changed):
+        """
+        Returns the number of seconds to wait before the next poll.
+
+        Parameters
+        ----------
+        `changed <boolean>`
+        Whether the last poll found changed lights
+        """
+        if changed:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval * self.backoff, self.ceiling())
+
+        return self.interval
+
+    def wait(self, changed):
+        time.sleep(self.next_interval(changed))
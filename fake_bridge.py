@@ -0,0 +1,482 @@
+"""
+A local stand-in for a Phillips Hue Bridge. It speaks enough of the v1 REST API and the v2
+event stream for the monitor to run against it without hardware:
+
+    bridge = FakeHueBridge(light_count=50).start()
+    light_control.stream_scheme = "http"
+    ...
+    bridge.set_light_state("3", on=False)
+    bridge.stop()
+
+Point the active bridge row at `bridge.ip` and `bridge.access_token`.
+
+For load testing it can also change lights on its own, answer slowly and fail requests:
+
+    bridge = FakeHueBridge(light_count=500, change_rate=50, latency=0.02, failure_rate=0.01)
+"""
+import copy
+import json
+import queue
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def synthetic_lights(count, seed=0):
+    """
+    Builds a bridge light object that looks like the response from `/api/<token>/lights`.
+
+    Parameters
+    ----------
+    `count <int>`
+    The number of lights to generate
+
+    `seed <int>`
+    Seed for the random state values
+
+    Returns
+    ----------
+    `lights object <dictionary>`
+    An object of all the lights in the form {"1": {data}, "2": {data}, etc...}
+    """
+    rng = random.Random(seed)
+    lights = {}
+
+    for i in range(1, count + 1):
+        lights[str(i)] = {
+            "state": {
+                "on": rng.random() > 0.5,
+                "bri": rng.randint(1, 254),
+                "hue": rng.randint(0, 65535),
+                "sat": rng.randint(0, 254),
+                "effect": "none",
+                "xy": [round(rng.random(), 4), round(rng.random(), 4)],
+                "ct": rng.randint(153, 500),
+                "alert": "none",
+                "colormode": "xy",
+                "mode": "homeautomation",
+                "reachable": True
+            },
+            "swupdate": {"state": "noupdates", "lastinstall": "2020-07-01T10:00:00"},
+            "type": "Extended color light",
+            "name": f"Light {i}",
+            "modelid": "LCT016",
+            "manufacturername": "Signify Netherlands B.V.",
+            "productname": "Hue color lamp",
+            "capabilities": {
+                "certified": True,
+                "control": {"mindimlevel": 1000, "maxlumen": 800, "colorgamuttype": "C", "ct": {"min": 153, "max": 500}},
+                "streaming": {"renderer": True, "proxy": True}
+            },
+            "config": {"archetype": "sultanbulb", "function": "mixed", "direction": "omnidirectional"},
+            "uniqueid": "00:17:88:01:%02x:%02x:%02x:%02x-0b" % ((i >> 24) & 0xff, (i >> 16) & 0xff, (i >> 8) & 0xff, i & 0xff),
+            "swversion": "1.65.11_hB798F2B"
+        }
+
+    return lights
+
+
+def synthetic_sensors(count, seed=0):
+    """
+    Builds a bridge sensor object with `count` motion sensors, like the response from
+    `/api/<token>/sensors`.
+    """
+    rng = random.Random(seed)
+    sensors = {}
+
+    for i in range(1, count + 1):
+        sensors[str(i)] = {
+            "state": {"presence": rng.random() > 0.5, "lastupdated": "2020-07-01T10:00:00"},
+            "config": {"on": True, "battery": rng.randint(20, 100), "reachable": True, "sensitivity": 2},
+            "name": f"Motion sensor {i}",
+            "type": "ZLLPresence",
+            "modelid": "SML001",
+            "manufacturername": "Signify Netherlands B.V.",
+            "uniqueid": "00:17:88:01:%02x:%02x:%02x:%02x-02-0406" % ((i >> 24) & 0xff, (i >> 16) & 0xff, (i >> 8) & 0xff, i & 0xff),
+        }
+
+    return sensors
+
+
+def _unauthorized(address):
+    return [{"error": {"type": 1, "address": address, "description": "unauthorized user"}}]
+
+
+class _FakeBridgeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, body, status=200):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        if length == 0:
+            return {}
+        return json.loads(self.rfile.read(length))
+
+    def _route(self):
+        # Returns (token, resource path parts) for /api/<token>/..., else (None, parts)
+        parts = [part for part in self.path.split("?")[0].split("/") if part]
+        if len(parts) >= 2 and parts[0] == "api" and parts[1] != "config":
+            return parts[1], parts[2:]
+        return None, parts
+
+    def _inject_fault(self):
+        # Applies the bridge's latency and failure settings. Returns True if the request failed
+        fault = self.server.bridge.fault()
+
+        if fault == "error":
+            self._send_json([{"error": {"type": 901, "address": self.path, "description": "Internal error, 503"}}], status=503)
+            return True
+
+        if fault == "drop":
+            # Closing without a response looks like a bridge that went away mid-request
+            self.close_connection = True
+            return True
+
+        return False
+
+    def do_GET(self):
+        bridge = self.server.bridge
+        bridge.count_request("GET", self.path)
+
+        if self.path.startswith("/eventstream/clip/v2"):
+            return self._stream_events()
+
+        if self._inject_fault():
+            return
+
+        token, parts = self._route()
+
+        if token is None:
+            if parts == ["api", "config"]:
+                return self._send_json(bridge.public_config())
+            return self._send_json([], status=404)
+
+        if token != bridge.access_token:
+            return self._send_json(_unauthorized("/" + "/".join(parts)))
+
+        with bridge.lock:
+            resources = {"lights": bridge.lights, "groups": bridge.groups, "sensors": bridge.sensors}
+
+            if not parts:
+                body = copy.deepcopy(resources)
+                body["config"] = bridge.public_config()
+            elif parts == ["config"]:
+                body = bridge.public_config()
+            elif len(parts) == 1 and parts[0] in resources:
+                body = copy.deepcopy(resources[parts[0]])
+            elif len(parts) == 2 and parts[0] in resources and parts[1] in resources[parts[0]]:
+                body = copy.deepcopy(resources[parts[0]][parts[1]])
+            else:
+                body = [{"error": {"type": 3, "address": self.path, "description": "resource not available"}}]
+
+        self._send_json(body)
+
+    def do_PUT(self):
+        bridge = self.server.bridge
+        bridge.count_request("PUT", self.path)
+        token, parts = self._route()
+        body = self._read_json()
+
+        if self._inject_fault():
+            return
+
+        if token != bridge.access_token:
+            return self._send_json(_unauthorized("/" + "/".join(parts)))
+
+        if len(parts) == 3 and parts[0] == "lights" and parts[2] == "state" and parts[1] in bridge.lights:
+            bridge.set_light_state(parts[1], **body)
+            return self._send_json([{"success": {f"/lights/{parts[1]}/state/{k}": v}} for k, v in body.items()])
+
+        self._send_json([{"error": {"type": 3, "address": self.path, "description": "resource not available"}}])
+
+    def do_POST(self):
+        bridge = self.server.bridge
+        bridge.count_request("POST", self.path)
+        self._read_json()
+
+        if self.path.rstrip("/") != "/api":
+            return self._send_json([], status=404)
+
+        if not bridge.link_button:
+            return self._send_json([{"error": {"type": 101, "address": "", "description": "link button not pressed"}}])
+
+        self._send_json([{"success": {"username": bridge.access_token}}])
+
+    def _stream_events(self):
+        bridge = self.server.bridge
+
+        if self.headers.get("hue-application-key") != bridge.access_token:
+            return self._send_json([], status=403)
+
+        subscriber = bridge.subscribe()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        try:
+            self.wfile.write(b": hi\n\n")
+            self.wfile.flush()
+
+            while not bridge.stopped.is_set():
+                try:
+                    event = subscriber.get(timeout=bridge.keepalive)
+                except queue.Empty:
+                    self.wfile.write(b": hi\n\n")
+                    self.wfile.flush()
+                    continue
+
+                if event is None:
+                    break
+
+                self.wfile.write(event)
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            bridge.unsubscribe(subscriber)
+
+
+class FakeHueBridge():
+    """
+    A Phillips Hue Bridge simulated on a local HTTP server
+
+    Parameters
+    ----------
+    `lights <dictionary>`
+    The initial light object. Defaults to `synthetic_lights(light_count)`
+
+    `light_count <int>`
+    The number of synthetic lights to serve when `lights` isn't given
+
+    `access_token <string>`
+    The username token the bridge accepts
+
+    `link_button <boolean>`
+    Whether pairing requests to `/api` succeed
+
+    `change_rate <float>`
+    Random light changes made per second while the bridge runs, as if someone were flipping
+    switches. Each change toggles a light and gives it a new brightness. 0 for none
+
+    `latency <float>`
+    Seconds added to every REST response
+
+    `failure_rate <float>`
+    Fraction of REST requests that fail, from 0 to 1
+
+    `failure_mode <string>`
+    How requests fail: `"error"` answers with a 503, `"drop"` closes the connection
+    without answering
+
+    `seed <int>`
+    Seed for the simulated changes and failures
+
+    `sensors <dictionary>`
+    The initial sensor object, e.g. from `synthetic_sensors`. None by default
+
+    `groups <dictionary>`
+    The initial group object. None by default
+    """
+    def __init__(self, lights=None, light_count=10, access_token="fake-hue-token", link_button=True,
+                 change_rate=0, latency=0, failure_rate=0, failure_mode="error", seed=0, sensors=None, groups=None):
+        self.lights = lights if lights is not None else synthetic_lights(light_count)
+        self.sensors = sensors if sensors is not None else {}
+        self.groups = groups if groups is not None else {}
+        self.access_token = access_token
+        self.link_button = link_button
+        self.change_rate = change_rate
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.failure_mode = failure_mode
+        self.bridge_id = "001788FFFE000000"
+        self.keepalive = 1.0
+        self.lock = threading.RLock()
+        self.stopped = threading.Event()
+        self.requests = {}
+        self.failures = 0
+
+        # Every state change as (time.monotonic(), key), for measuring how long the monitor
+        # takes to notice it
+        self.changes = []
+
+        self._rng = random.Random(seed)
+        self._subscribers = []
+        self._event_id = 0
+        self._server = None
+        self._thread = None
+        self._simulator = None
+
+    @property
+    def ip(self):
+        host, port = self._server.server_address[:2]
+        return f"{host}:{port}"
+
+    def start(self):
+        self.stopped.clear()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), _FakeBridgeHandler)
+        self._server.daemon_threads = True
+        self._server.bridge = self
+        self._thread = threading.Thread(target=self._server.serve_forever, name="fake-hue-bridge", daemon=True)
+        self._thread.start()
+
+        if self.change_rate > 0:
+            self._simulator = threading.Thread(target=self._simulate_changes, name="fake-hue-changes", daemon=True)
+            self._simulator.start()
+
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.close_streams()
+
+        server, self._server = self._server, None
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+        if self._simulator is not None:
+            self._simulator.join()
+            self._simulator = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def public_config(self):
+        return {"name": "Fake Hue Bridge", "bridgeid": self.bridge_id, "modelid": "BSB002", "apiversion": "1.41.0"}
+
+    def count_request(self, method, path):
+        key = f"{method} {path.split('?')[0]}"
+        with self.lock:
+            self.requests[key] = self.requests.get(key, 0) + 1
+
+    def close_streams(self):
+        """
+        Ends every open event stream, as the bridge does when it restarts. The REST API keeps
+        running.
+        """
+        with self.lock:
+            for subscriber in self._subscribers:
+                subscriber.put(None)
+
+    def fault(self):
+        """
+        Sleeps for `latency` and decides whether the current request fails.
+
+        Returns
+        ----------
+        `fault <string>`
+        The `failure_mode` if the request should fail, else `None`
+        """
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+        with self.lock:
+            if self.failure_rate > 0 and self._rng.random() < self.failure_rate:
+                self.failures += 1
+                return self.failure_mode
+
+        return None
+
+    def _simulate_changes(self):
+        interval = 1.0 / self.change_rate
+        next_change = time.monotonic()
+
+        while not self.stopped.is_set():
+            next_change += interval
+            if self.stopped.wait(max(0, next_change - time.monotonic())):
+                return
+
+            with self.lock:
+                key = self._rng.choice(list(self.lights))
+                state = self.lights[key]["state"]
+                bri = self._rng.choice([bri for bri in (1, 64, 127, 190, 254) if bri != state["bri"]])
+                self.set_light_state(key, on=not state["on"], bri=bri)
+
+    def subscribe(self):
+        subscriber = queue.Queue()
+        with self.lock:
+            self._subscribers.append(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            if subscriber in self._subscribers:
+                self._subscribers.remove(subscriber)
+
+    def set_light_state(self, key, **state):
+        """
+        Changes a light's state and pushes the change to every open event stream.
+
+        Parameters
+        ----------
+        `key <string>`
+        The bridge light key, e.g. "3"
+
+        `state <kwargs>`
+        The state values to change, e.g. on=False, bri=100
+        """
+        with self.lock:
+            self.lights[key]["state"].update(state)
+            self.changes.append((time.monotonic(), key))
+            self._event_id += 1
+            event = {
+                "creationtime": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+                "id": f"fake-event-{self._event_id}",
+                "type": "update",
+                "data": [self._v2_resource(key, state)]
+            }
+            payload = f"id: {self._event_id}:0\ndata: {json.dumps([event])}\n\n".encode()
+
+            for subscriber in self._subscribers:
+                subscriber.put(payload)
+
+    def set_sensor_state(self, key, **state):
+        """
+        Changes a sensor's state, e.g. presence=True, and pushes the change to every open
+        event stream.
+        """
+        with self.lock:
+            self.sensors[key]["state"].update(state)
+            self.sensors[key]["state"]["lastupdated"] = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S")
+            self._event_id += 1
+            resource = {"id": f"fake-sensor-{key}", "id_v1": f"/sensors/{key}", "type": "motion"}
+            if "presence" in state:
+                resource["motion"] = {"motion": state["presence"]}
+            event = {
+                "creationtime": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+                "id": f"fake-event-{self._event_id}",
+                "type": "update",
+                "data": [resource]
+            }
+            payload = f"id: {self._event_id}:0\ndata: {json.dumps([event])}\n\n".encode()
+
+            for subscriber in self._subscribers:
+                subscriber.put(payload)
+
+    def _v2_resource(self, key, state):
+        resource = {"id": f"fake-light-{key}", "id_v1": f"/lights/{key}", "type": "light"}
+        if "on" in state:
+            resource["on"] = {"on": state["on"]}
+        if "bri" in state:
+            resource["dimming"] = {"brightness": round(state["bri"] / 2.54, 2)}
+        if "reachable" in state:
+            resource["type"] = "zigbee_connectivity"
+            resource["status"] = "connected" if state["reachable"] else "connectivity_issue"
+        return resource
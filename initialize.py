@@ -1,32 +1,65 @@
 import os
+import threading
 import schedule
 
-import db.pgsql_db_utils_create as dbUtils_create
-import db.pgsql_db_utils_read as dbUtils_read
-from db.pgsql_db_utils import create_connection_from_file
-
 from .main import PhillipsHueBridgeLight
+from .monitor_log import start_queue_logging
 from .db import *
 from .scheduler import PhillipsHueBridgeLightScheduler
 
+def create_connection():
+    # Imported on first use, so importing the module doesn't load the db utils
+    from db.pgsql_db_utils import create_connection_from_file
+    return create_connection_from_file()
+
+def finish_startup(light_control):
+    """
+    The startup steps that wait on the database or the bridge. Runs in the background while
+    the monitor starts from the startup cache.
+    """
+    try:
+        light_control.status.set("Discovery")
+
+        # Check the cached bridge against the bridge row. Doesn't block: if there's no working
+        # bridge yet, discovery carries on in the background and publishes its progress to the
+        # brain status
+        light_control.connections.get(refresh=True)
+        if light_control.bridge_connect() is not None:
+            light_control.status.set("Connected")
+
+        # Load every light's item id up front so the monitor doesn't look them up one at a time
+        light_control.item_ids.preload()
+
+        # Learn which hours of the day the lights are busy in, for the poll rate
+        light_control.load_activity()
+    except Exception as err:
+        light_control.log.error(f"[ERROR]: Error finishing Phillips Hue startup: {err}")
+
 def initialize_system():
-     # Load Postgres connection
-    conn = create_connection_from_file()
+    # Format and write log records on a background thread, off the monitor loop
+    log_listener = start_queue_logging()
+
+     # Pool Postgres connections so the monitor, the scheduler and the daily snapshot
+    # don't serialize on one connection, and a dropped connection gets replaced
+    conn = ConnectionPool(create_connection, maxconn=int(os.getenv("HUE_DB_POOL_SIZE", "4")))
 
-    # Confirm we have a valid Hue Bridge, config Hue 
+    # Confirm we have a valid Hue Bridge, config Hue
     # Make sure we have an initial state to compare our light status
     light_control = PhillipsHueBridgeLight(conn)
-    save_brain_status_hue_bridge(conn, "Discovery")
+    light_control.log_listener = log_listener
 
-    try:
-        light_control.bridge_connect() 
-        save_brain_status_hue_bridge(conn, "Connected")
-    except:
-        light_control.scan_for_bridge()
+    # Start from the last known bridge and lights so `run` can poll straight away, and check
+    # them against the database and the bridge in the background
+    light_control.restore_from_cache()
+    light_control.startup = threading.Thread(target=finish_startup, args=(light_control,), name="hue-startup", daemon=True)
+    light_control.startup.start()
 
     light_scheduler = PhillipsHueBridgeLightScheduler(conn)
 
+    # Fire the predicted light schedules as they come due
+    light_scheduler.start_executor(light_control)
+
     # Not sure if the scheduler picks up all schedules globally. Will have to check.
     schedule.every().day.at(os.getenv("STARTING_DAY_STATUS")).do(light_control.get_all_lights_status)
 
-    return light_control
\ No newline at end of file
+    return light_control
@@ -0,0 +1,168 @@
+import logging
+import threading
+import time
+
+from .db import fetch_light_items, fetch_light_items_by_id
+
+log = logging.getLogger('modules')
+
+
+class ItemIdCache():
+    """
+    An in-memory map from light uniqueid or name to `eranaAPI_item` id. The change loop looks
+    lights up by name and the daily snapshot by uniqueid, so every item is stored under both.
+
+    Preloaded with one query on first use, filled from the database on a miss, and cleared
+    with `invalidate`. Lookups raise if the database can't be read, so callers never take an
+    outage for lights that don't exist; a failed preload is retried on the next lookup.
+    Keys the database doesn't have are remembered for `miss_ttl` seconds, so a light that was
+    never added isn't looked up again on every change.
+
+    Parameters
+    ----------
+    `conn <database connection>`
+    The connection to the main Postgres database
+
+    `miss_ttl <float>`
+    Seconds before a key that wasn't in the database is looked up again
+
+    `clock <function>`
+    Returns the current time in seconds. Defaults to `time.monotonic`
+    """
+    def __init__(self, conn, miss_ttl=60, clock=time.monotonic):
+        self.conn = conn
+        self.miss_ttl = miss_ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.loaded = False
+
+        self._ids = {}
+        self._keys = {}
+        # {key: when to look it up again} for keys the database didn't have
+        self._absent = {}
+        self._lock = threading.Lock()
+
+    def _store(self, rows):
+        for item_id, unique_id, name in rows:
+            self._keys[item_id] = unique_id if unique_id is not None else name
+            if unique_id is not None:
+                self._ids[unique_id] = item_id
+                self._absent.pop(unique_id, None)
+            if name is not None:
+                self._ids[name] = item_id
+                self._absent.pop(name, None)
+
+    def preload(self):
+        """
+        Loads every light item in a single query, replacing what was cached. Raises, leaving
+        the cache as it was, if the query fails.
+        """
+        rows = fetch_light_items(self.conn)
+
+        with self._lock:
+            self._ids = {}
+            self._keys = {}
+            self._absent = {}
+            self._store(rows)
+            self.loaded = True
+
+        log.debug(f"[INFO]: Preloaded {len(rows)} light item ids")
+
+    def resolve(self, keys):
+        """
+        Looks up item ids, querying the database once for all the misses.
+
+        Parameters
+        ----------
+        `keys <iterable>`
+        Light uniqueids or names
+
+        Returns
+        ----------
+        `item ids <dictionary>`
+        An object in the form {key: item id}. Keys that aren't in the database are left out.
+        Raises if the database can't be read.
+        """
+        if not self.loaded:
+            self.preload()
+
+        found = {}
+        missing = []
+        now = self.clock()
+
+        with self._lock:
+            for key in keys:
+                item_id = self._ids.get(key)
+                if item_id is not None:
+                    found[key] = item_id
+                elif self._absent.get(key, now) <= now:
+                    missing.append(key)
+
+            self.hits += len(found)
+            self.misses += len(missing)
+
+        if missing:
+            rows = fetch_light_items(self.conn, missing)
+
+            with self._lock:
+                self._store(rows)
+                for key in missing:
+                    if key in self._ids:
+                        found[key] = self._ids[key]
+                    else:
+                        self._absent[key] = now + self.miss_ttl
+
+        return found
+
+    def keys_for(self, item_ids):
+        """
+        The reverse lookup: item ids to the uniqueid (or name) to address the light by.
+
+        Returns
+        ----------
+        `keys <dictionary>`
+        An object in the form {item id: uniqueid or name}. Unknown ids are left out.
+        """
+        if not self.loaded:
+            self.preload()
+
+        with self._lock:
+            found = {item_id: self._keys[item_id] for item_id in item_ids if item_id in self._keys}
+
+        missing = [item_id for item_id in item_ids if item_id not in found]
+
+        if missing:
+            rows = fetch_light_items_by_id(self.conn, missing)
+
+            with self._lock:
+                self._store(rows)
+                found.update({item_id: self._keys[item_id] for item_id in missing if item_id in self._keys})
+
+        return found
+
+    def get(self, key):
+        return self.resolve([key]).get(key)
+
+    def invalidate(self, key=None):
+        """
+        Forgets one key's item, under its uniqueid and its name, or that the key wasn't in the
+        database. Forgets everything when `key` is `None` so the next lookup preloads again.
+        """
+        with self._lock:
+            if key is None:
+                self._ids = {}
+                self._keys = {}
+                self._absent = {}
+                self.loaded = False
+                return
+
+            self._absent.pop(key, None)
+            item_id = self._ids.pop(key, None)
+            if item_id is not None:
+                self._keys.pop(item_id, None)
+                for other in [other for other, cached in self._ids.items() if cached == item_id]:
+                    del self._ids[other]
+
+    def stats(self):
+        return {"size": len(self._ids), "absent": len(self._absent), "hits": self.hits, "misses": self.misses}
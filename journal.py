@@ -0,0 +1,196 @@
+import datetime
+import logging
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+log = logging.getLogger('modules')
+
+MAGIC = b"HUEJRNL2"
+OLD_MAGICS = (b"HUEJRNL1",)
+HEADER = struct.Struct("<8sQ16x")
+# crc, generation, event time, has_value, is_on, is_reachable, key length, key, value length, value
+RECORD = struct.Struct("<IIddbbH64sH96s")
+CHECKPOINT = struct.Struct("<QQ")
+
+_BOOL_CODES = {None: -1, False: 0, True: 1}
+_BOOL_VALUES = {-1: None, 0: False, 1: True}
+
+
+class ActionJournal():
+    """
+    An append-only, memory-mapped file of light actions. Appending is a struct pack into the
+    map, so actions are captured at poll speed whether or not the database is up, and they
+    survive a restart of the process.
+
+    Actions are read back in order with `read` and marked as saved with `commit`, which
+    writes the position to a checkpoint file next to the journal. Once everything has been
+    committed the journal starts over from the top under a new generation number, so old
+    records are never replayed twice and never need to be zeroed.
+
+    Parameters
+    ----------
+    `path <string>`
+    The journal file. `<path>.ckpt` holds the checkpoint
+
+    `capacity <int>`
+    Records the file has room for at first. It doubles whenever it fills up.
+    """
+    def __init__(self, path, capacity=4096):
+        self.path = path
+        self.checkpoint_path = f"{path}.ckpt"
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+
+        new = not os.path.exists(path) or os.path.getsize(path) < HEADER.size
+        self._file = open(path, "r+b" if not new else "w+b")
+
+        if new:
+            self._file.truncate(HEADER.size + capacity * RECORD.size)
+            self._file.write(HEADER.pack(MAGIC, 1))
+            self._file.flush()
+
+        self._map = mmap.mmap(self._file.fileno(), 0)
+        magic, self.generation = HEADER.unpack_from(self._map, 0)
+
+        if magic in OLD_MAGICS:
+            # Records from an older format can't be read back; keep the file for a manual
+            # replay and start a new one
+            self._map.close()
+            self._file.close()
+            os.replace(path, f"{path}.{magic.decode().lower()}")
+            log.error(f"[ERROR]: {path} is an older journal format, moved it aside and started a new journal")
+            self.__init__(path, capacity)
+            return
+
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a light action journal")
+
+        self.read_index = self._load_checkpoint()
+        self.write_index = self._scan(self.read_index)
+
+        if self.pending():
+            log.debug(f"[INFO]: Light action journal has {self.pending()} actions to replay")
+
+    def _load_checkpoint(self):
+        try:
+            with open(self.checkpoint_path, "rb") as checkpoint:
+                generation, index = CHECKPOINT.unpack(checkpoint.read(CHECKPOINT.size))
+        except (OSError, struct.error):
+            return 0
+
+        return index if generation == self.generation else 0
+
+    def _save_checkpoint(self):
+        temporary = f"{self.checkpoint_path}.tmp"
+        with open(temporary, "wb") as checkpoint:
+            checkpoint.write(CHECKPOINT.pack(self.generation, self.read_index))
+            checkpoint.flush()
+            os.fsync(checkpoint.fileno())
+        os.replace(temporary, self.checkpoint_path)
+
+    def _capacity(self):
+        return (len(self._map) - HEADER.size) // RECORD.size
+
+    def _offset(self, index):
+        return HEADER.size + index * RECORD.size
+
+    def _valid(self, index):
+        record = self._map[self._offset(index):self._offset(index + 1)]
+        crc, generation = struct.unpack_from("<II", record)
+        return generation == self.generation and crc == zlib.crc32(record[4:])
+
+    def _scan(self, index):
+        # Torn or stale records fail the crc or generation check and end the journal
+        capacity = self._capacity()
+        while index < capacity and self._valid(index):
+            index += 1
+        return index
+
+    def _grow(self, needed):
+        capacity = self._capacity()
+        while capacity < needed:
+            capacity *= 2
+        self._map.resize(HEADER.size + capacity * RECORD.size)
+
+    def pending(self):
+        return self.write_index - self.read_index
+
+    def append(self, actions):
+        """
+        Appends actions to the journal.
+
+        Parameters
+        ----------
+        `actions <array>`
+        Actions in the form (event_time, has_value, is_on, is_reachable, unique_id, value)
+        """
+        with self._lock:
+            if self.write_index + len(actions) > self._capacity():
+                self._grow(self.write_index + len(actions))
+
+            for event_time, has_value, is_on, is_reachable, unique_id, value in actions:
+                key = str(unique_id).encode()[:64]
+                # Length 0 is no value; encoded values are never empty
+                value = value.encode()[:96] if value else b""
+                body = RECORD.pack(0, self.generation, event_time.timestamp(), has_value or 0.0,
+                                   _BOOL_CODES[is_on], _BOOL_CODES[is_reachable], len(key), key, len(value), value)
+                record = struct.pack("<I", zlib.crc32(body[4:])) + body[4:]
+                offset = self._offset(self.write_index)
+                self._map[offset:offset + RECORD.size] = record
+                self.write_index += 1
+
+    def read(self, limit=None):
+        """
+        Returns actions that haven't been committed yet, oldest first, without removing them.
+
+        Returns
+        ----------
+        `actions <array>`
+        Actions in the same form they were appended in
+        """
+        with self._lock:
+            end = self.write_index if limit is None else min(self.write_index, self.read_index + limit)
+            actions = []
+
+            for index in range(self.read_index, end):
+                _, _, event_time, has_value, is_on, is_reachable, length, key, value_length, value = RECORD.unpack_from(self._map, self._offset(index))
+                actions.append((datetime.datetime.fromtimestamp(event_time), has_value, _BOOL_VALUES[is_on],
+                                _BOOL_VALUES[is_reachable], key[:length].decode(errors="ignore"),
+                                value[:value_length].decode(errors="ignore") or None))
+
+            return actions
+
+    def commit(self, count):
+        """
+        Marks the oldest `count` pending actions as saved and checkpoints. Starts the journal
+        over once nothing is pending.
+        """
+        with self._lock:
+            self.read_index = min(self.write_index, self.read_index + count)
+
+            if self.read_index == self.write_index:
+                self.generation += 1
+                HEADER.pack_into(self._map, 0, MAGIC, self.generation)
+                self._map.flush(0, HEADER.size)
+                self.read_index = 0
+                self.write_index = 0
+
+            self._save_checkpoint()
+
+    def sync(self):
+        """
+        Flushes appended records to disk.
+        """
+        with self._lock:
+            self._map.flush()
+
+    def close(self):
+        with self._lock:
+            self._map.flush()
+            self._map.close()
+            self._file.close()
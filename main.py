@@ -1,20 +1,28 @@
 import os
-from qhue import Bridge
-from ratelimiter import RateLimiter
-from request_ssdp import request_ssdp_by_key
-import time
+import atexit
 import datetime
 import logging
-import requests 
-import json
-from requests.exceptions import HTTPError
-
-import db.pgsql_db_utils as dbUtils
-import db.pgsql_db_utils_create as dbUtils_create
-import db.pgsql_db_utils_read as dbUtils_read
-import db.pgsql_db_utils_delete as dbUtils_delete
+import threading
+import time
 
-from .db import delete_phillips_hue_bridge, save_brain_status_hue_bridge, fetch_phillips_bridges, fetch_phillips_active_bridge
+from .activity import ActivityProfile
+from .breaker import CircuitBreaker, CircuitOpen
+from .db import action_values_supported, fetch_latest_light_actions, fetch_phillips_active_bridges
+from .state import snapshot
+from .item_cache import ItemIdCache
+from .journal import ActionJournal
+from .metrics import MonitorMetrics
+from .monitor_log import SampledLogger
+from .pipeline import MonitorPipeline
+from .resources import ResourceMonitor, record_light_changes
+from .startup_cache import StartupCache
+from .tracking import encode_values, load_bridge_health, load_monitored_resources, load_poll_intervals, load_tracking
+from .writer import ActionWriter
+from .events import AdaptivePoller, BridgeEventStream
+from .commands import LightCommander
+from .connection import BridgeConnectionManager
+from .discovery import BridgeDiscovery
+from .status import BrainStatusTracker
 
 class PhillipsHueBridgeLight():
     """
@@ -23,15 +31,159 @@ class PhillipsHueBridgeLight():
     Parameters
     ----------
     `conn <database connection>`
-    The connection to the main Postgres database
+    The connection to the main Postgres database, or a `ConnectionPool` so the monitor, the
+    scheduler and the daily snapshot each write on their own connection
+
+    `journal_path <string>`
+    Where light actions are journaled so none are lost while the database is down. Defaults
+    to `HUE_JOURNAL_PATH`, or `hue_actions.journal` next to this module
+
+    `cache_path <string>`
+    Where the last bridge and light snapshot are kept for a fast restart, see
+    `restore_from_cache`. Defaults to `HUE_STARTUP_CACHE`, or `hue_startup_cache.json` next to
+    this module
     """
-    def __init__(self, conn):
+    def __init__(self, conn, journal_path=None, cache_path=None):
         self.conn = conn        
 
+        # Stage latencies and counters for the monitor loop, see `MonitorMetrics.render`
+        self.metrics = MonitorMetrics()
+
+        # uniqueid/name to item id lookups, so the db is only asked about new lights
+        self.item_ids = ItemIdCache(conn)
+
+        # Captures light actions on disk first, whatever state the database is in
+        if journal_path is None:
+            journal_path = os.getenv("HUE_JOURNAL_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "hue_actions.journal"))
+        self.journal = ActionJournal(journal_path)
+
+        # Batches light actions into multi-row inserts off the monitor thread
+        self.writer = ActionWriter(conn, item_ids=self.item_ids, metrics=self.metrics, journal=self.journal)
+
+        # Replay whatever the last run couldn't save
+        if self.journal.pending():
+            self.writer.start()
+
+        # Per-request timeout and circuit breaker settings from `bridge_health` in config.yml
+        bridge_timeout, breaker_settings = load_bridge_health()
+
+        # Cached bridge token, IP and HTTP session
+        self.connections = BridgeConnectionManager(conn, metrics=self.metrics, timeout=bridge_timeout or 5)
+
+        # Stops sending requests to a bridge that keeps failing and probes it one request at a
+        # time until it's back
+        self.breaker = CircuitBreaker(on_change=self._bridge_health_changed, **breaker_settings)
+
+        # Seconds the bridge has to be unreachable before discovery looks for it elsewhere
+        self.rediscover_after = 120
+
+        # Last bridge and light snapshot, so a restart can monitor before the database answers
+        if cache_path is None:
+            cache_path = os.getenv("HUE_STARTUP_CACHE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "hue_startup_cache.json"))
+        self.startup_cache = StartupCache(cache_path)
+        # Write a save still held back by the save interval before the process exits
+        atexit.register(self.startup_cache.flush)
+
+        # Bulk light commands, collapsed into group actions and paced under the bridge's limits
+        self.commands = LightCommander(self.bridge_connect, self._light_snapshot)
+
+        # Only writes the brain status when it changes, instead of on every poll, and off the
+        # monitor thread
+        self.status = BrainStatusTracker(conn, background=True)
+
+        # Finds and pairs with the bridge in the background when there isn't one
+        self.discovery = BridgeDiscovery(conn, status=self.status, on_found=self._bridge_found)
+
+        # Light fields recorded with each action and how far each has to move to count,
+        # from `tracked_fields` and `field_thresholds` in config.yml
+        self.tracked_fields, self.thresholds = load_tracking()
+
+        # One bridge request per poll, fanned out to the light handler and to sensor and group
+        # handlers for whatever `monitored_resources` in config.yml adds
+        self.resources = ResourceMonitor({"lights": self._process_lights})
+        for resource in load_monitored_resources():
+            if resource != "lights":
+                self.resources.watch(resource)
+
+        # Which hours of the day the lights usually change in, so polling stays fast in the
+        # evening and backs off at night. Learned from the saved actions by `load_activity`
+        self.activity = ActivityProfile()
+
+        # Poll interval bounds from `poll_intervals` in config.yml, see `AdaptivePoller`
+        self.poll_intervals = load_poll_intervals()
+
+        # Compact snapshot of the last light object seen by the monitor, {uniqueid: LightState}
+        self.state = {}
+
+        # Fetches on one thread and diffs on another, so neither waits for the other
+        self.pipeline = MonitorPipeline(self)
+
+        # The bridge serves its event stream over https only. The fake bridge uses http.
+        self.stream_scheme = "https"
+
+        # Seconds to poll for after the event stream drops before trying it again
+        self.stream_retry = 60
+
+        # Seconds between counts of the active bridges, see `check_active_bridges`. Set once
+        # there's more than one, and `run` hands over to `run_supervisor`
+        self.bridge_check_interval = 300
+        self.multiple_bridges = threading.Event()
+
+        # The event stream being followed, so a hand-over can close it
+        self._stream = None
+
+        # Monitors every bridge once `run` hands over, and routes light commands to them
+        self.supervisor = None
+
         # Set up current logging mechanism
         self.log = logging.getLogger('modules')
+
+        # Lazy, rate-limited logging for everything that runs on every poll or stream event
+        self.monitor_log = SampledLogger()
         self.log.debug("[INFO]: Initialized Phillips Hue Bridge Lights main module")
 
+    @property
+    def state(self):
+        # Kept in the resource monitor's snapshot cache next to the sensors and groups
+        return self.resources.snapshots.get("lights", {})
+
+    @state.setter
+    def state(self, lights):
+        self.resources.snapshots["lights"] = lights
+
+    def restore_from_cache(self):
+        """
+        Restores the last bridge and light snapshot from the startup cache. The bridge is used
+        without reading its row from the database first, and `run` diffs against the restored
+        lights, so anything that changed while the module was down is recorded on the first poll.
+
+        A stale cached bridge fails its first request and the connection falls back to the
+        database row as usual.
+
+        Returns
+        ----------
+        `restored <boolean>`
+        Whether a bridge was restored
+        """
+        bridge, lights = self.startup_cache.load()
+
+        if lights:
+            self.state = lights
+
+        if bridge is None:
+            return False
+
+        self.connections.seed(*bridge)
+        self.log.debug(f"[INFO]: Restored Phillips Hue Bridge at {bridge[0]} and {len(lights)} lights from the startup cache")
+        return True
+
+    def load_activity(self, days=28):
+        """
+        Learns which hours of the day are busy from the light actions saved in the last `days`
+        days. See `ActivityProfile`.
+        """
+        return self.activity.load(self.conn, days)
+
     def authorize_bridge(self, ip):
         """
         Gets the authorization token from the bridge if the button is pressed. If the button is not
@@ -42,147 +194,61 @@ class PhillipsHueBridgeLight():
         `Username <string>`
         A username token if authorized, else `None`
         """
-
-        save_brain_status_hue_bridge(self.conn, "Discovery")
-
-        url = f'http://{ip}/api'
-        payload = {"devicetype": "erana-engine#local_user"}
-        headers = {'content-type': 'application/json'}
-
         try:
-            response = requests.post(url, data=json.dumps(payload), headers=headers)
-            response.raise_for_status()
-        except HTTPError as http_err:
-            self.log.critical(f'[ERROR]: HTTP error occurred: {http_err}')
-            save_brain_status_hue_bridge(self.conn, "Not Found")
-            return
+            token = self.discovery.pair(ip)
         except Exception as err:
-            self.log.error(f'[ERROR]: Other error occurred: {err}')
-            save_brain_status_hue_bridge(self.conn, "Not Found")
+            self.log.error(f'[ERROR]: Error authorizing bridge at {ip}: {err}')
+            self.status.set("Not Found")
             return
-        
-        response_object = response.json()
-
-        for item in response_object:
-            for key, value in item.items():
-                if key == 'error':
-                    # Is user ends up here, they can access the bridge, but it's sending back
-                    # an error that the button is not pressed. Let's tell the user
-                    # about our unauthorized state
-                    save_brain_status_hue_bridge(self.conn, "Not Authorized")
-                    time.sleep(5)
-                    return
-                elif key == 'success':
-                    # The button is pushed and we got a value
-                    self.log.debug("[INFO]: Successfully authorized and received token")
-                    username = value['username']
-                    return username
 
-    
-    def scan_for_bridge(self):
+        if token is None:
+            self.status.set("Not Authorized")
+
+        return token
+
+    def scan_for_bridge(self, timeout=None):
         """
-        Searches for Phillips Hue bridges via SSDP. If it finds one, it will take the bridge IP, 
-        check if the bridge previously existed at another IP, and update it. If it did not exist,
-        it will go through checks and update old bridges to active_state:False, and create a new 
-        active Phillips Hue Bridge. It returns a connection to the proper bridge.
+        Searches for a Phillips Hue bridge over SSDP, mDNS and the last known IP, pairs with it
+        and saves it as the active bridge. See `BridgeDiscovery`.
 
-        Note that if the system can NOT find a Hue Bridge via SSDP, it will continuously loop.
+        This waits for discovery to finish; `bridge_connect` starts it in the background instead.
 
-        Returns
+        Parameters
         ----------
-        `Phillips Hue Bridge <bridge>`
-        A valid Phillips Hue Bridge object
-
-        If there is an error, it restarts the function. 
+        `timeout <float>`
+        Seconds to wait. Waits until a bridge is connected if `None`
 
+        Returns
+        ----------
+        `bridge <tuple>`
+        (ip, bridge id) of the connected bridge, or `None`
         """
-        save_brain_status_hue_bridge(self.conn, "Not Found")
-
-        try:
-            # Get the real ip and bridge id by passing in the key we locate it with, port, and any extra
-            # keys to return besides the IP
-            real_ip, unique_bridge_id_array = request_ssdp_by_key("hue-bridgeid", "80", ["hue-bridgeid"])
-        except Exception as err:
-            self.log.error(f'[ERROR]: Error on SSDP request: {err}')
-            save_brain_status_hue_bridge(self.conn, "Not Found")
-            time.sleep(5)
-            return
-        
-        # Let's also add this here in case there is no error, just a null value return
-        if real_ip == None or real_ip == '':
-            self.log.error(f'[ERROR]: No error, and no return value on SSDP request')
-            save_brain_status_hue_bridge(self.conn, "Not Found")
-            time.sleep(5)
-            return
-
-        # Let's try getting any info first to see if the connection exists
-        try:
-            testing_url = f'http://{real_ip}/api/v1/'
-            testing_response = requests.get(testing_url)
-            testing_response_object = testing_response.json()
-
-            # if we got an error reponse, we know the device is on
-            # and we can't access it. If we get an unauthorized user
-            # return, we know to request a button push from the user
-            if testing_response_object is not None:
-                # Otherwise, if we can't just restart, then we need to authorize
-                token = self.authorize_bridge(real_ip)
-
-                if token is not None:
-                    # Check if other bridges exist.
-                    try:
-                        bridge_list = fetch_phillips_bridges(self.conn)
-                    except:
-                        bridge_list = []
-
-                    # If there are old bridges in the DB, delete them for now
-                    if(len(bridge_list) > 0):
-                        for bridge in bridge_list:
-                            delete_phillips_hue_bridge(self.conn)
-                    
-                    # Let's create the new bridge
-                    try:
-                        # Ok, let's connect to the new bridge and save brain status
-                        dbUtils_create.create_item(
-                            self.conn,
-                            ip_address=real_ip,
-                            access_token=token,
-                            is_active=True,
-                            item_type="phillips_hue_bridge",
-                            manufacturer = "Phillips Manufacturing",
-                            name = "Phillips Hue Bridge",
-                            energy_watts = 1.6792,
-                            unique_id = unique_bridge_id_array[0]['hue-bridgeid']
-                        )
-                        return
-                    except:
-                        log.warning("[ERROR]: Challenge saving states in lights.py")
-        except:
-            self.log.error("[ERROR]: Scan for bridge completely failed. Let's sleep.")
-            # We're not able to connect to it at all
-            time.sleep(5)
-            raise
+        return self.discovery.start().wait(timeout)
 
     def bridge_connect(self):
         """
-        Connects to the Hue Bridge
+        Connects to the Hue Bridge. The connection is cached by `self.connections` and reused
+        until it fails or the bridge row changes.
+
+        Returns
+        ----------
+        `bridge <BridgeClient>`
+        A client for the active bridge, or `None` while discovery looks for one
         """
 
-        access_token, ip = fetch_phillips_active_bridge(self.conn)
+        b = self.connections.get()
 
-        if access_token and ip is not None:
-            try:
-                b = Bridge(ip, access_token)
-                return b
-            except:
-                raise
+        if b is not None:
+            return b
+        elif self.connections.row_error is not None:
+            # The database is down, not the bridge; discovery couldn't save a bridge anyway
+            self.monitor_log.error("[ERROR]: Couldn't read the Phillips Hue Bridge row: %s", self.connections.row_error)
+            return
         else:
-            self.log.error(f"[ERROR]: Error connecting to Phillips Bridge")
-            try:
-                self.scan_for_bridge()
-                return
-            except:
-                raise
+            if not self.discovery.running():
+                self.log.error("[ERROR]: Error connecting to Phillips Bridge, starting discovery")
+                self.discovery.start()
+            return
             
     def get_lights(self, bridge):
         """
@@ -196,17 +262,99 @@ class PhillipsHueBridgeLight():
         If there is an error, it returns an empty object {}
         
         """
+        return self.get_resources(bridge, ("lights",)).get("lights", {})
+
+    def get_resources(self, bridge, resources=None):
+        """
+        Fetches the monitored resources (lights, sensors, groups) with one request.
+
+        Parameters
+        ----------
+        `bridge <BridgeClient>`
+        The bridge to fetch from. `None` while there's no bridge to talk to, e.g. the database
+        is down with no cached client or discovery is still looking
+
+        `resources <iterable>`
+        Only fetch these. Every monitored resource if `None`
+
+        Returns
+        ----------
+        `state <dictionary>`
+        An object in the form {"lights": {...}, "sensors": {...}, etc...}, or {} on error
+        """
+        # Nothing was asked of the bridge, so it isn't a bridge failure: no breaker, no status
+        if bridge is None:
+            return {}
+
+        # While the circuit is open nothing is sent; the bridge is probed once per open period
+        if not self.breaker.allow():
+            self.metrics.inc("short_circuited")
+            self._rediscover()
+            return {}
+
         try:
-            lights = bridge.lights
-            lights_object = lights()
-            save_brain_status_hue_bridge(self.conn, "Connected")
-            return lights_object
+            with self.metrics.time("fetch"):
+                state = self.resources.fetch(bridge, resources)
         except Exception as err:
-            self.log.error(f"[ERROR]: Error retrieving lights object from PhillipsHueBridgeLight.get_lights at {datetime.datetime.now()}")
-            save_brain_status_hue_bridge(self.conn, "Not Found")
+            self.breaker.failure()
+            self.metrics.inc("errors")
+            self.connections.report_failure(err)
+            self.monitor_log.error("[ERROR]: Error retrieving %s from the Phillips Hue Bridge: %s", "/".join(resources or self.resources.resource_types()), err)
+            self.status.set("Not Found")
             return {}
 
-    def toggle_light(self, unique_id, state, bridge):
+        self.breaker.success()
+        self.status.set("Connected")
+        return state
+
+    def _rediscover(self):
+        # The bridge may have moved, e.g. to a new DHCP address. Discovery runs one search at a
+        # time and backs off by itself, so a long outage starts it once instead of every poll
+        if self.breaker.outage() >= self.rediscover_after and not self.discovery.running():
+            self.monitor_log.warning("[WARNING]: Phillips Hue Bridge unreachable for %.0fs, looking for it", self.breaker.outage())
+            self.discovery.start()
+
+    def _bridge_found(self):
+        self.connections.invalidate("bridge discovered")
+        self.breaker.reset()
+
+    def _bridge_health_changed(self, old, new):
+        if new == CircuitBreaker.OPEN and old == CircuitBreaker.CLOSED:
+            self.monitor_log.warning("[WARNING]: Phillips Hue Bridge failed %d requests in a row, probing it until it's back", self.breaker.failures)
+        elif new == CircuitBreaker.CLOSED:
+            self.log.debug("[INFO]: Phillips Hue Bridge is reachable again")
+            # The bridge answered where it was, so there's nothing left to look for
+            if self.discovery.running():
+                self.discovery.stop()
+
+    def _light_snapshot(self):
+        # The monitor's snapshot, or a fresh one if the monitor hasn't run yet
+        if self.state:
+            return self.state
+        return snapshot(self.get_lights(self.bridge_connect()))
+
+    def set_lights(self, targets):
+        """
+        Sets many lights at once, using group actions where a bridge group covers lights that
+        get the same state. See `LightCommander`.
+
+        Parameters
+        ----------
+        `targets <dictionary>`
+        An object in the form {uniqueid or name: state}, where state is a dictionary like
+        {"on": True, "bri": 200} or a boolean for just "on"
+
+        Returns
+        ----------
+        `results <array>`
+        An object per request sent in the form {"path": ..., "body": ..., "ok": bool, "latency": seconds}
+        """
+        # With more than one bridge each light has to go to the bridge it's on
+        if self.supervisor is not None:
+            return self.supervisor.apply(targets)
+        return self.commands.apply(targets)
+
+    def toggle_light(self, unique_id, state, bridge=None):
         """
         Toggles the light to a specific state.
 
@@ -218,135 +366,279 @@ class PhillipsHueBridgeLight():
         `state <boolean>`
         The state to toggle. Either `True` or `False` for `on` or `off`
 
+        `bridge <BridgeClient>`
+        Unused, commands go through the cached connection. Kept for existing callers.
+
         Returns
         ----------
         Void
         """
-        lights = self.get_lights()
+        results = self.set_lights({unique_id: {"on": state}})
 
-        try:
-            for key, value in lights.items():
-                if value["uniqueid"] == unique_id:
-                    bridge.lights[key].state(on=state)
-                    self.log.debug(f"[INFO]: Light {key} \"on\" status is now {state}")
-                    break
-        except:
+        if results and all(result["ok"] for result in results):
+            self.log.debug(f"[INFO]: Light {unique_id} \"on\" status is now {state}")
+        else:
             self.log.error(f"[ERROR]: Error changing state of light {unique_id} to {state}")
     
-    @RateLimiter(max_calls=1, period=1)
-    def _determine_changed_lights(self, old_state):
-        b = self.bridge_connect()
-        lights = self.get_lights(b)
-        
-        # If this is the startup, then simply return the lights so it can be put in old state
-        lights_array = []
-
-        # Probably should be changed to a recursive loop for speed
-        if bool(lights) is True:
-            for new_key, new_light in lights.items():
-                for old_key, old_light in old_state.items():
-                    if new_light["uniqueid"] == old_light["uniqueid"]:
-                        if (new_light["state"]["on"] != old_light["state"]["on"] or new_light["state"]["reachable"] != old_light["state"]["reachable"]):
-                            # We changed this to name because the iOS ability to grab
-                            # by serial number is now deprecated. After all, why would Apple
-                            # allow you to make useful things?
-                            lights_array.append({ "uniqueid": new_light["name"], "on": new_light["state"]["on"], "reachable": new_light["state"]["reachable"] })
-                            break
-                    else:
-                        pass
-        
-        return lights_array, lights
+    def _fetch_resources(self, resources=None):
+        with self.metrics.time("connect"):
+            b = self.bridge_connect()
+
+        return self.get_resources(b, resources)
 
     def get_all_lights_status(self):
         """
-        saves the light status for all the current lights in the database
+        Saves the daily light status. Only lights whose on/reachable state or tracked values
+        differ from their last saved action are written, so a day without changes costs one query and no inserts.
+        Uses the monitor's snapshot when it has one instead of fetching the lights again.
 
         Returns
         ----------
-        Status<string>: Whether successful or not
+        `count <int>`
+        The number of light actions written, or `None` if the save failed
         """
         try:
-            lights = self.get_lights()
+            lights = self._light_snapshot()
             event_time = datetime.datetime.now()
 
-            if bool(lights) is True:
-                for light in lights:
-                    current_light = lights[light]
+            if not lights:
+                self.log.error(f"[ERROR]: No lights to save for the daily status at {event_time}")
+                return
+
+            # Anything the monitor still has buffered counts as saved
+            self.writer.flush()
+
+            item_ids = self.item_ids.resolve([light.uniqueid for light in lights.values()])
+            last_saved = {row[0]: row[1:] for row in fetch_latest_light_actions(self.conn, set(item_ids.values()))}
+            actions = []
+
+            # Without the value column only on/reachable are saved, so only they are compared
+            values = action_values_supported(self.conn)
+
+            for light in lights.values():
+                value = encode_values(light.as_dict(), self.tracked_fields) if values else None
+                if last_saved.get(item_ids.get(light.uniqueid)) != (light.on, light.reachable, value):
+                    actions.append((event_time, 0.0, light.on, light.reachable, light.uniqueid, value))
 
-                    try:
-                        unique_id = current_light["uniqueid"]
-                        light_id = dbUtils_read.fetch_item_by_unique_id(self.conn, unique_id)
-                        
-                        if light_id is not None:
-                            dbUtils_create.create_action(self.conn, event_time, current_light["state"]["on"], current_light["state"]["reachable"], light_id)
-                        else:
-                            self.log.error(f"[ERROR]: Daily save at {event_time}. Light {unique_id} does not exist in the current db.")
-                    except:
-                        self.log.error(f"[ERROR]: Saving daily light status for {unique_id} on {event_time}")
+            if actions:
+                self.writer.add(actions)
+                self.writer.flush()
 
-            self.log.debug(f"[INFO]: Daily save successfully completed at {event_time}")
+            self.log.debug(f"[INFO]: Daily save successfully completed at {event_time}, {len(actions)} of {len(lights)} lights changed")
+            return len(actions)
 
         except:
-            self.log.error(f"[ERROR]: Error saving daily values.")
+            self.log.error("[ERROR]: Error saving daily values.")
     
-    def run(self):
+    def _process_lights(self, lights, fetched_at=None):
+        """
+        Diffs one light response against the monitor state, saves any changes and moves the
+        state forward.
+
+        Parameters
+        ----------
+        `lights <dictionary>`
+        The bridge light object, as returned by `get_lights`
+
+        `fetched_at <datetime>`
+        When the lights were fetched
+
+        Returns
+        ----------
+        `changed <boolean>`
+        Whether any light changed
+        """
+        changes = record_light_changes(self.state, lights, self.writer, self.tracked_fields, self.thresholds, fetched_at, self.metrics)
+        self.metrics.inc("polls")
+
+        if not changes:
+            self.monitor_log.debug("[INFO]: No changed lights")
+            return False
+
+        # Removed lights leave the state too, even though they don't get an action
+        self.state = changes.state
+        self.startup_cache.save(self.connections.client, changes.state)
+        changed = len(changes.changed) + len(changes.added)
+
+        if not changed:
+            return False
+
+        self.metrics.inc("changes", changed)
+        self.activity.observe(fetched_at or datetime.datetime.now(), changed)
+        return True
+
+    def _check_for_changes(self):
+        """
+        Fetches the monitored resources once and processes them on this thread.
+
+        Returns
+        ----------
+        `changed <boolean>`
+        Whether anything changed
+        """
+        fetched_at = datetime.datetime.now()
+        return self.resources.dispatch(self._fetch_resources(), fetched_at)
+
+    def _poll_for_changes(self, poller, duration=None, until=None):
+        """
+        Polls the bridge through the `MonitorPipeline`, waiting between polls as long as the
+        `AdaptivePoller` says. Diffing and saving happen on other threads.
+
+        Parameters
+        ----------
+        `poller <AdaptivePoller>`
+        Decides the wait between polls
+
+        `duration <float>`
+        Seconds to poll for before returning. Polls forever if `None`
+
+        `until <threading.Event>`
+        Optional, stops polling as soon as it's set
+        """
+        self.pipeline.poll(poller, duration, until)
+
+    def _follow_event_stream(self):
+        """
+        Checks the monitored resources every time the bridge pushes an event for them, fetching
+        only the resources the event touched. Returns when the stream closes and raises if it
+        can't be opened.
+        """
+        b = self.bridge_connect()
+
+        if b is None:
+            raise ValueError("No active Phillips Hue Bridge to stream events from")
+
+        # Outages are probed by polling; a stream can't be opened one request at a time
+        if self.breaker.state != CircuitBreaker.CLOSED:
+            raise CircuitOpen("Phillips Hue Bridge is failing, polling until it recovers")
+
+        stream = self._stream = BridgeEventStream(b.ip, b.access_token, scheme=self.stream_scheme)
+
+        try:
+            # Catch anything that changed while the stream was down
+            self.pipeline.submit(self._fetch_resources())
+
+            for keys in stream.changes(self.resources.resource_types()):
+                self.monitor_log.debug("[INFO]: Event stream reported changes for %s", keys)
+                touched = {resource for resource, _ in keys}
+                self.pipeline.submit(self._fetch_resources(touched), resources=touched)
+        finally:
+            self._stream = None
+
+    def check_active_bridges(self):
+        """
+        Counts the active bridges and, once there's more than one, has `run` hand over to
+        `run_supervisor`. `run` calls it from a background thread every `bridge_check_interval`
+        seconds, so the count never holds up the first poll.
+
+        Returns
+        ----------
+        `multiple <boolean>`
+        Whether there's more than one active bridge. False if the database can't be read
+        """
+        try:
+            count = len(fetch_phillips_active_bridges(self.conn))
+        except Exception:
+            # Keep monitoring the bridge from the startup cache and count again later
+            return False
+
+        if count <= 1:
+            return False
+
+        if not self.multiple_bridges.is_set():
+            self.log.debug(f"[INFO]: {count} active Phillips Hue Bridges, handing over to the bridge supervisor")
+            self.multiple_bridges.set()
+
+        # The stream may still be opening; keep closing it until `run` lets go of it
+        while True:
+            stream = self._stream
+            if stream is None:
+                return True
+            stream.close()
+            time.sleep(1)
+
+    def _watch_active_bridges(self):
+        while not self.check_active_bridges():
+            time.sleep(self.bridge_check_interval)
+
+    def run_supervisor(self, mode="auto"):
+        """
+        Monitors every active bridge at once with a `BridgeSupervisor`, one coroutine per
+        bridge, saving through this module's journaled writer and counting in its metrics.
+        Runs until the process stops.
+
+        Parameters
+        ----------
+        `mode <string>`
+        As in `run`
+        """
+        # Imported here so single bridge sites never load asyncio
+        from .supervisor import BridgeSupervisor
+
+        self.log.debug(f"[INFO]: Monitoring every active Phillips Hue Bridge in {mode} mode")
+        self.supervisor = BridgeSupervisor(self.conn, writer=self.writer, mode=mode, stream_scheme=self.stream_scheme, metrics=self.metrics)
+        self.supervisor.run_forever()
+
+    def run(self, mode="auto"):
         """
         Runs the continuous scans of Phillips Hue Bridge to get light data.
 
+        Parameters
+        ----------
+        `mode <string>`
+        `"stream"` to follow the bridge event stream, `"poll"` to poll on an adaptive interval,
+        or `"auto"` to follow the stream and poll for `stream_retry` seconds whenever it drops.
+
+        Starts on the cached bridge straight away. Once `check_active_bridges` finds more than
+        one active bridge, this hands over to `run_supervisor`.
+
         Returns:
         ------
         `Void`
 
         """
+        # Counted in the background, so the first poll doesn't wait on the database
+        if not self.multiple_bridges.is_set():
+            threading.Thread(target=self._watch_active_bridges, name="hue-bridge-count", daemon=True).start()
+
         # log = logging.getLogger('modules')
         b = self.bridge_connect()
-        old_state = self.get_lights(b)
 
-        self.log.debug(f'[INFO]: Running {b}')
+        poller = AdaptivePoller(profile=self.activity, **self.poll_intervals)
 
+        self.log.debug(f'[INFO]: Running {b} in {mode} mode')
 
-        while True:
-            if b is not None:
-                changed_lights, lights_object = self._determine_changed_lights(old_state)
+        while not self.multiple_bridges.is_set():
+            if b is None:
+                poller.wait(False)
+                b = self.bridge_connect()
+                continue
 
-                if len(changed_lights) == 0:
-                    self.log.debug(f'[INFO]: No changed lights')
+            # A snapshot restored from the startup cache is kept, so changes made while the
+            # module was down are recorded on the first poll. Otherwise the first response
+            # that comes back is the baseline
+            if not self.state:
+                self.state = snapshot(self.get_lights(b))
+                if not self.state:
+                    poller.wait(False)
                     continue
-                else:
-                    # Get current time so it's same for all lights
-                    event_time = datetime.datetime.now()
-                    
-                    # Narrowing down the error states using try/except to establish failure locations
-                    for light in changed_lights:
-                        self.log.debug(f"lights {light}")
-                        try:
-                            unique_id = light["uniqueid"]
-                            light_id = dbUtils_read.fetch_item_by_unique_id(self.conn, unique_id)
-
-                        except:
-                            # transliteration doesn't work with object keys it seems
-                            on = light["on"]
-                            reachable = light["reachable"]
-                            light_id = light["id"]
-                            self.log.error(f"[ERROR]: Fetching light_id and unique id for {unique_id} at {event_time} in main.py. \n Light on: {on} \n Light reachable: {reachable} \n Light id: {light_id}")
-                            
-                        try:
-                            if light_id is not None:
-                                dbUtils_create.create_action(self.conn, event_time=event_time, has_value=0.0, is_on=light["on"], is_reachable=light["reachable"], item_id=light_id)
-                                self.log.debug(f"[INFO]: Light event recorded at {event_time} for {unique_id}")
-                            else:
-                                self.log.error(f"[Error]: Light_id is none for {unique_id}")
-                                continue
-                        except:
-                            # transliteration doesn't work with object keys it seems
-                            on = light["on"]
-                            reachable = light["reachable"]
-                            light_id = light["id"]
-                            self.log.error(f"[ERROR]: Creating light event for {unique_id} at {event_time} in main.py. \n Light on: {on} \n Light reachable: {reachable} \n Light id: {light_id}")
-
-                        try:
-                            old_state = lights_object
-                        except:
-                            self.log.error(f"[Error]: Saving new state failed at {event_time}")
+                self.startup_cache.save(self.connections.client, self.state, force=True)
+
+            if mode != "poll":
+                try:
+                    self._follow_event_stream()
+                except Exception as err:
+                    if self.multiple_bridges.is_set():
+                        break
+                    self.monitor_log.warning("[WARNING]: Phillips Hue event stream unavailable: %s", err)
+
+            if mode == "stream":
+                poller.wait(False)
+            elif mode == "poll":
+                self._poll_for_changes(poller, until=self.multiple_bridges)
             else:
-                b = self.bridge_connect()
\ No newline at end of file
+                self._poll_for_changes(poller, duration=self.stream_retry, until=self.multiple_bridges)
+
+        # Whatever this loop already fetched is saved before the supervisor takes over
+        self.pipeline.drain()
+        self.run_supervisor(mode)
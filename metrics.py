@@ -0,0 +1,169 @@
+import bisect
+import logging
+import threading
+import time
+
+log = logging.getLogger('modules')
+
+# Upper bounds in seconds, from a fast in-memory diff up to a bridge timeout
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+STAGES = ("connect", "fetch", "diff", "lookup", "insert")
+COUNTERS = ("polls", "changes", "errors", "reconnects", "dropped", "short_circuited", "rejected")
+
+
+class Histogram():
+    """
+    A fixed-bucket latency histogram. Observing is a bisect and two additions.
+
+    Parameters
+    ----------
+    `buckets <tuple>`
+    Sorted bucket upper bounds in seconds
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+    def cumulative(self):
+        """
+        Returns [(upper bound, observations <= bound), ...] ending with ("+Inf", count).
+        """
+        total = 0
+        result = []
+
+        for bound, count in zip(self.buckets + ("+Inf",), self.counts):
+            total += count
+            result.append((bound, total))
+
+        return result
+
+
+class _Timer():
+    __slots__ = ("metrics", "stage", "started")
+
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.stage, time.perf_counter() - self.started)
+        return False
+
+
+class MonitorMetrics():
+    """
+    Per-stage latency histograms and counters for the monitor loop
+
+    Stages are "connect", "fetch", "diff", "lookup" and "insert". Counters are "polls",
+    "changes", "errors", "reconnects" and "dropped". Read them with `render` (Prometheus text format),
+    `serve` them over HTTP, or pass a callback to get every value as it's recorded.
+
+    Parameters
+    ----------
+    `callback <function>`
+    Optional, called as callback(kind, name, value) with kind "histogram" or "counter"
+
+    `prefix <string>`
+    Prefix for the exported metric names
+    """
+    def __init__(self, callback=None, prefix="hue_monitor"):
+        self.callback = callback
+        self.prefix = prefix
+        self.histograms = {stage: Histogram() for stage in STAGES}
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self._server = None
+
+    def time(self, stage):
+        """
+        Returns a context manager that records how long its block took under `stage`.
+        """
+        return _Timer(self, stage)
+
+    def observe(self, stage, seconds):
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            histogram = self.histograms[stage] = Histogram()
+        histogram.observe(seconds)
+
+        if self.callback is not None:
+            self.callback("histogram", stage, seconds)
+
+    def inc(self, counter, amount=1):
+        self.counters[counter] = self.counters.get(counter, 0) + amount
+
+        if self.callback is not None:
+            self.callback("counter", counter, amount)
+
+    def render(self):
+        """
+        Returns every metric in the Prometheus text exposition format.
+        """
+        name = f"{self.prefix}_stage_seconds"
+        lines = [f"# HELP {name} Latency of each monitor stage", f"# TYPE {name} histogram"]
+
+        for stage, histogram in list(self.histograms.items()):
+            for bound, count in histogram.cumulative():
+                lines.append(f'{name}_bucket{{stage="{stage}",le="{bound}"}} {count}')
+            lines.append(f'{name}_sum{{stage="{stage}"}} {histogram.sum:.6f}')
+            lines.append(f'{name}_count{{stage="{stage}"}} {histogram.count}')
+
+        for counter, value in list(self.counters.items()):
+            counter_name = f"{self.prefix}_{counter}_total"
+            lines.append(f"# TYPE {counter_name} counter")
+            lines.append(f"{counter_name} {value}")
+
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port=9464, host="0.0.0.0"):
+        """
+        Serves `render` at `/metrics` on a background thread.
+
+        Returns
+        ----------
+        `server <ThreadingHTTPServer>`
+        The running server. Call `stop` to shut it down.
+        """
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        metrics = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self._server = ThreadingHTTPServer((host, port), MetricsHandler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name="hue-metrics", daemon=True).start()
+        log.debug(f"[INFO]: Serving monitor metrics on port {self._server.server_address[1]}")
+        return self._server
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
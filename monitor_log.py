@@ -0,0 +1,148 @@
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+
+log = logging.getLogger('modules')
+
+# The monitor loop logs through its own child of `modules`, so queueing its records never
+# changes how the host's `modules` logger is set up
+monitor_logger = logging.getLogger('modules.hue_monitor')
+
+_queue_lock = threading.Lock()
+
+
+class SampledLogger():
+    """
+    Logging for the monitor loop, which runs every poll and every stream event
+
+    Messages are %-style templates formatted lazily, so nothing is built unless the level is
+    enabled. Each template (or `key`) is logged at most once per `interval`; repeats in between
+    are counted and the count is added to the next message that gets through.
+
+        monitor_log.debug("[INFO]: Light events queued for %d lights", len(lights))
+
+    Parameters
+    ----------
+    `logger <Logger>`
+    Where messages go. Defaults to the `modules.hue_monitor` logger, which passes them on to
+    `modules`
+
+    `interval <float>`
+    Seconds between messages with the same template or key
+    """
+    def __init__(self, logger=None, interval=60):
+        self.logger = logger if logger is not None else monitor_logger
+        self.interval = interval
+        self.suppressed = 0
+
+        self._last = {}
+        self._lock = threading.Lock()
+
+    def log(self, level, msg, *args, key=None):
+        if not self.logger.isEnabledFor(level):
+            return
+
+        key = msg if key is None else key
+        now = time.monotonic()
+
+        with self._lock:
+            last = self._last.get(key)
+
+            if last is not None and now - last[0] < self.interval:
+                last[1] += 1
+                self.suppressed += 1
+                return
+
+            repeats = last[1] if last is not None else 0
+            self._last[key] = [now, 0]
+
+        if repeats:
+            msg = f"{msg} (%d similar messages suppressed)"
+            args = args + (repeats,)
+
+        self.logger.log(level, msg, *args)
+
+    def debug(self, msg, *args, key=None):
+        self.log(logging.DEBUG, msg, *args, key=key)
+
+    def info(self, msg, *args, key=None):
+        self.log(logging.INFO, msg, *args, key=key)
+
+    def warning(self, msg, *args, key=None):
+        self.log(logging.WARNING, msg, *args, key=key)
+
+    def error(self, msg, *args, key=None):
+        self.log(logging.ERROR, msg, *args, key=key)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    A `QueueHandler` that never blocks the thread that logs. Records are queued as they are
+    and formatted by the listener thread; if the queue is full the record is dropped and
+    counted instead.
+    """
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # The listener runs in this process, so the record doesn't need to be made picklable
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class _ParentHandler(logging.Handler):
+    # Hands records from the listener thread to a logger's parent, so they reach whatever
+    # handlers the host has set up there at the time
+    def __init__(self, logger):
+        super().__init__()
+        self.logger = logger
+
+    def emit(self, record):
+        self.logger.handle(record)
+
+
+def start_queue_logging(logger=None, maxsize=10000):
+    """
+    Queues a child logger's records and passes them on to its parent from a background thread,
+    so formatting and writing them happens there instead of in the monitor loop. Only the child
+    logger is changed; the parent's handlers, level and propagation stay as the host set them
+    up. Calling it again for the same logger returns the listener that's already running.
+
+    Parameters
+    ----------
+    `logger <Logger>`
+    The logger to queue. Defaults to the `modules.hue_monitor` logger the monitor loop uses
+
+    `maxsize <int>`
+    Records the queue holds before new ones are dropped
+
+    Returns
+    ----------
+    `listener <QueueListener>`
+    The running listener. Call `stop` on it to flush the queue at shutdown
+    """
+    logger = logger if logger is not None else monitor_logger
+
+    with _queue_lock:
+        for handler in logger.handlers:
+            if isinstance(handler, DroppingQueueHandler):
+                return handler.listener
+
+        log_queue = queue.Queue(maxsize)
+        handler = DroppingQueueHandler(log_queue)
+        handler.listener = logging.handlers.QueueListener(log_queue, _ParentHandler(logger.parent))
+
+        # The records reach the parent through the listener instead
+        logger.addHandler(handler)
+        logger.propagate = False
+        handler.listener.start()
+
+    return handler.listener
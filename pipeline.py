@@ -0,0 +1,190 @@
+import collections
+import datetime
+import logging
+import queue
+import threading
+import time
+
+from .monitor_log import SampledLogger
+
+log = logging.getLogger('modules')
+monitor_log = SampledLogger()
+
+
+class DropOldestQueue():
+    """
+    A bounded queue that never blocks the producer. When it's full, putting an item drops the
+    oldest one.
+
+    Parameters
+    ----------
+    `maxsize <int>`
+    Items held before the oldest are dropped
+    """
+    def __init__(self, maxsize):
+        self.dropped = 0
+
+        self._items = collections.deque(maxlen=maxsize)
+        self._ready = threading.Condition()
+
+    def __len__(self):
+        return len(self._items)
+
+    def put(self, item):
+        """
+        Returns whether an older item was dropped to make room.
+        """
+        with self._ready:
+            dropped = len(self._items) == self._items.maxlen
+            if dropped:
+                self.dropped += 1
+            self._items.append(item)
+            self._ready.notify()
+
+        return dropped
+
+    def get(self, timeout=None):
+        """
+        Takes the oldest item, waiting up to `timeout` seconds. Raises `queue.Empty` on timeout.
+        """
+        with self._ready:
+            if not self._ready.wait_for(lambda: self._items, timeout):
+                raise queue.Empty
+            return self._items.popleft()
+
+
+class MonitorPipeline():
+    """
+    Runs the monitor as separate stages so a slow stage never holds up the one before it
+
+    The reader (whichever thread calls `poll`, or `submit` from the event stream) fetches
+    the lights (and any other monitored resources) and queues the response. A diff thread
+    hands each response to the `ResourceMonitor`, whose light handler diffs it and hands the
+    changed lights to the `ActionWriter`, which saves them on its own threads. Polls go out on the `AdaptivePoller` cadence however long the diff or the
+    database take. If the diff stage falls behind, the oldest responses are dropped; the next
+    diff against a newer response still catches every light whose state ended up different.
+
+    Parameters
+    ----------
+    `light_control <PhillipsHueBridgeLight>`
+    Fetches the lights and processes the responses
+
+    `queue_size <int>`
+    Responses waiting for the diff stage before the oldest are dropped
+    """
+    def __init__(self, light_control, queue_size=4):
+        self.light_control = light_control
+        self.fetched = DropOldestQueue(queue_size)
+
+        # CPU seconds spent by the diff thread
+        self.cpu_seconds = 0.0
+
+        self._changed = threading.Event()
+        self._stopped = threading.Event()
+        self._idle = threading.Condition()
+        self._busy = False
+        self._thread = None
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, name="hue-monitor-diff", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def submit(self, state, fetched_at=None, resources=None):
+        """
+        Queues a bridge response for the diff stage. Never blocks.
+
+        Parameters
+        ----------
+        `state <dictionary>`
+        The response, as returned by `get_resources`
+
+        `fetched_at <datetime>`
+        When the response was fetched, used as the event time of its actions
+
+        `resources <iterable>`
+        The resources to diff. All the monitored ones if `None`
+        """
+        self.start()
+
+        if self.fetched.put((fetched_at or datetime.datetime.now(), state, resources)):
+            self.light_control.metrics.inc("dropped")
+            monitor_log.warning("[WARNING]: Diff stage is behind, dropped the oldest light response")
+
+    def changed(self):
+        """
+        Whether the diff stage found changes since the last call.
+        """
+        changed = self._changed.is_set()
+        self._changed.clear()
+        return changed
+
+    def poll(self, poller, duration=None, until=None):
+        """
+        Fetches the lights on the `poller` cadence and queues each response.
+
+        Parameters
+        ----------
+        `poller <AdaptivePoller>`
+        Decides the wait between polls, from whether the diff stage has been finding changes
+
+        `duration <float>`
+        Seconds to poll for before returning. Polls forever if `None`
+
+        `until <threading.Event>`
+        Optional, stops polling as soon as it's set
+        """
+        started = time.monotonic()
+        next_poll = started
+        until = until if until is not None else threading.Event()
+
+        while (duration is None or time.monotonic() - started < duration) and not until.is_set():
+            self.submit(self.light_control._fetch_resources())
+
+            # Counted from when the poll was due, so a slow fetch doesn't stretch the cadence
+            next_poll += poller.next_interval(self.changed())
+            now = time.monotonic()
+            next_poll = max(next_poll, now)
+            until.wait(next_poll - now)
+
+    def drain(self, timeout=None):
+        """
+        Waits until every queued response has been diffed.
+
+        Returns
+        ----------
+        `drained <boolean>`
+        False if `timeout` ran out first
+        """
+        with self._idle:
+            return self._idle.wait_for(lambda: not self._busy and not len(self.fetched), timeout)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                with self._idle:
+                    fetched_at, state, resources = self.fetched.get(timeout=0.5)
+                    self._busy = True
+            except queue.Empty:
+                continue
+
+            cpu = time.thread_time()
+
+            try:
+                if self.light_control.resources.dispatch(state, fetched_at, resources):
+                    self._changed.set()
+            except Exception as err:
+                monitor_log.error("[ERROR]: Error diffing bridge response: %s", err)
+            finally:
+                self.cpu_seconds += time.thread_time() - cpu
+                with self._idle:
+                    self._busy = False
+                    self._idle.notify_all()
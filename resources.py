@@ -0,0 +1,227 @@
+import contextlib
+import datetime
+import logging
+
+from .diff import diff_lights
+from .monitor_log import SampledLogger
+from .state import GROUP_FIELDS, SENSOR_FIELDS, GroupState, SensorState, resource_snapshot, snapshot
+from .tracking import encode_values
+
+log = logging.getLogger('modules')
+monitor_log = SampledLogger()
+
+# Record class and diffed fields for every resource besides lights
+RESOURCE_TYPES = {
+    "sensors": (SensorState, SENSOR_FIELDS),
+    "groups": (GroupState, GROUP_FIELDS),
+}
+
+
+def log_changes(resource, changes, fetched_at):
+    for record in changes.changed + changes.added:
+        monitor_log.debug("[INFO]: %s %s changed %s at %s", resource, record["uniqueid"], record["changed"], fetched_at,
+                          key=(resource, record["id"]))
+
+
+def record_light_changes(old_state, lights, writer, fields, thresholds=None, fetched_at=None, metrics=None):
+    """
+    Diffs a bridge light response against the last snapshot and queues an action on `writer`
+    for every changed or added light. The single bridge monitor and the supervisor's bridge
+    monitors both save lights through this, so they can't drift apart.
+
+    Parameters
+    ----------
+    `old_state <dictionary>`
+    The last snapshot, {uniqueid: LightState}
+
+    `lights <dictionary>`
+    The bridge light object
+
+    `writer <ActionWriter>`
+    Where the actions go
+
+    `fields <tuple>`
+    The tracked fields, from `load_tracking`
+
+    `thresholds <dictionary>`
+    How far each field has to move to count, from `load_tracking`
+
+    `fetched_at <datetime>`
+    When the lights were fetched, used as the event time. Defaults to now
+
+    `metrics <MonitorMetrics>`
+    Optional, records the diff time
+
+    Returns
+    ----------
+    `changes <LightChanges>`
+    The changes, with the next snapshot in `changes.state`, or `None` if the response is
+    empty. Removed lights leave the snapshot but don't get an action.
+    """
+    # An empty response means the fetch failed, not that every light was removed
+    if not lights:
+        return None
+
+    with metrics.time("diff") if metrics is not None else contextlib.nullcontext():
+        changes = diff_lights(old_state, snapshot(lights), fields, thresholds)
+
+    for light in changes.removed:
+        monitor_log.info("[INFO]: Light %s is no longer reported by the bridge", light["uniqueid"], key=("removed", light["uniqueid"]))
+
+    changed_lights = changes.changed + changes.added
+
+    if changed_lights:
+        # Same time for all lights
+        event_time = fetched_at or datetime.datetime.now()
+
+        # Handed to the write-behind buffer as one batch so the monitor never waits on the db
+        writer.add([
+            (event_time, 0.0, light["on"], light["reachable"], light["uniqueid"], encode_values(light, fields))
+            for light in changed_lights
+        ])
+        monitor_log.debug("[INFO]: Light events queued at %s for %d lights", event_time, len(changed_lights))
+
+    return changes
+
+
+class ResourceHandler():
+    """
+    Diffs one kind of bridge resource, sensors or groups, against the last snapshot in the
+    monitor's cache and passes any changes to its listeners.
+
+    Parameters
+    ----------
+    `resource <string>`
+    `"sensors"` or `"groups"`
+
+    `cache <dictionary>`
+    The `ResourceMonitor` snapshot cache, {resource: snapshot}
+    """
+    def __init__(self, resource, cache):
+        self.resource = resource
+        self.record_class, self.fields = RESOURCE_TYPES[resource]
+        self.cache = cache
+
+        # Called as listener(resource, changes <LightChanges>, fetched_at) for every change
+        self.listeners = []
+
+    def __call__(self, data, fetched_at=None):
+        # An empty response means the fetch failed, not that everything was removed
+        if not data:
+            return False
+
+        new_state = resource_snapshot(data, self.record_class)
+        old_state = self.cache.get(self.resource)
+        self.cache[self.resource] = new_state
+
+        # The first response is the baseline
+        if old_state is None:
+            return False
+
+        changes = diff_lights(old_state, new_state, self.fields)
+
+        if not changes:
+            return False
+
+        for listener in self.listeners:
+            try:
+                listener(self.resource, changes, fetched_at)
+            except Exception as err:
+                monitor_log.error("[ERROR]: Error handling %s changes: %s", self.resource, err)
+
+        return True
+
+
+class ResourceMonitor():
+    """
+    Fans one bridge response out to a handler per resource, so lights, sensors and groups are
+    watched with a single request per poll (or per stream event) and one snapshot cache.
+
+    When only one resource is wanted it's fetched on its own, e.g. `/api/<token>/lights`;
+    otherwise the full state at `/api/<token>` covers them all.
+
+    Parameters
+    ----------
+    `handlers <dictionary>`
+    An object in the form {resource: handler}, where handler(data, fetched_at) returns whether
+    anything changed
+    """
+    def __init__(self, handlers=None):
+        self.handlers = dict(handlers or {})
+
+        # {resource: snapshot} for every watched resource
+        self.snapshots = {}
+
+    def resource_types(self):
+        return tuple(self.handlers)
+
+    def watch(self, resource, listener=log_changes):
+        """
+        Starts watching sensors or groups.
+
+        Parameters
+        ----------
+        `resource <string>`
+        `"sensors"` or `"groups"`
+
+        `listener <function>`
+        Called as listener(resource, changes, fetched_at) when any of them change. Defaults to
+        logging the changes
+
+        Returns
+        ----------
+        `handler <ResourceHandler>`
+        """
+        handler = self.handlers.get(resource)
+
+        if handler is None:
+            handler = self.handlers[resource] = ResourceHandler(resource, self.snapshots)
+
+        if listener is not None and listener not in handler.listeners:
+            handler.listeners.append(listener)
+
+        return handler
+
+    def fetch(self, bridge, resources=None):
+        """
+        Fetches the watched resources, or the ones in `resources`, with one request.
+
+        Returns
+        ----------
+        `state <dictionary>`
+        An object in the form {"lights": {...}, "sensors": {...}, etc...}
+        """
+        wanted = [resource for resource in self.handlers if resources is None or resource in resources]
+
+        if len(wanted) == 1:
+            return {wanted[0]: bridge.get(wanted[0])}
+
+        return bridge.get("")
+
+    def dispatch(self, state, fetched_at=None, resources=None):
+        """
+        Hands each handler its part of a response.
+
+        Parameters
+        ----------
+        `state <dictionary>`
+        A response from `fetch`
+
+        `fetched_at <datetime>`
+        When it was fetched
+
+        `resources <iterable>`
+        Only these resources, e.g. the ones a stream event touched. All of them if `None`
+
+        Returns
+        ----------
+        `changed <boolean>`
+        Whether any handler found changes
+        """
+        changed = False
+
+        for resource, handler in self.handlers.items():
+            if resources is None or resource in resources:
+                changed = handler(state.get(resource) or {}, fetched_at) or changed
+
+        return changed
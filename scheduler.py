@@ -1,5 +1,13 @@
 import os
-import db.pgsql_db_utils_read as dbUtils_read
+import datetime
+import heapq
+import logging
+import threading
+import time
+
+from .db import borrow, fetch_scheduled_light_predictions_after
+
+log = logging.getLogger('modules')
 
 
 class PhillipsHueBridgeLightScheduler():
@@ -9,7 +17,7 @@ class PhillipsHueBridgeLightScheduler():
     Parameters
     ----------
     `conn <database connection>`
-    The connection to the main Postgres database
+    The connection to the main Postgres database, or a `ConnectionPool`
     """
     def __init__(self, conn):
         self.conn = conn        
@@ -30,11 +38,235 @@ class PhillipsHueBridgeLightScheduler():
             (4, '2020-07-27 18:05:00', 1, 1)
         ]
         """
+        import db.pgsql_db_utils_read as dbUtils_read
+
         try:
-            predictions = dbUtils_read.fetch_scheduled_light_predictions(self.conn)
+            with borrow(self.conn) as conn:
+                predictions = dbUtils_read.fetch_scheduled_light_predictions(conn)
             return predictions
         except:
             print(f"[ERROR]: Error retrieving scheduled predictions")
-            
 
-    
\ No newline at end of file
+    def start_executor(self, light_control, **kwargs):
+        """
+        Starts executing the scheduled predictions against the lights.
+
+        Parameters
+        ----------
+        `light_control <PhillipsHueBridgeLight>`
+        The light module whose commands, item id cache and metrics the executor uses
+
+        Returns
+        ----------
+        `executor <ScheduleExecutor>`
+        The running executor
+        """
+        self.executor = ScheduleExecutor(self, light_control.set_lights, light_control.item_ids, metrics=light_control.metrics, **kwargs)
+        return self.executor.start()
+
+
+def _epoch(value):
+    if isinstance(value, str):
+        value = datetime.datetime.fromisoformat(value)
+    if isinstance(value, datetime.datetime):
+        return value.timestamp()
+    return float(value)
+
+
+class ScheduleExecutor():
+    """
+    Fires scheduled light predictions when they come due
+
+    Predictions sit in a heap ordered by due time, so the thread only wakes for the next due
+    entry or the next reload. The first load reads every prediction; later reloads only fetch
+    rows with a higher id than the last one seen. When a prediction comes due, everything due
+    within the next `tick` is sent with it as one `set_lights` call, so lights switching
+    together share group actions. With several bridges, `PhillipsHueBridgeLight.set_lights`
+    sends each light to the bridge it's on.
+
+    Each fired action's lateness (fire time minus due time) goes to the "schedule" histogram.
+
+    Parameters
+    ----------
+    `scheduler <PhillipsHueBridgeLightScheduler>`
+    Reads the predictions from the database
+
+    `set_lights <function>`
+    Sends the light commands, e.g. `PhillipsHueBridgeLight.set_lights`. Called with
+    {uniqueid or name: state} and returns the results per request
+
+    `item_ids <ItemIdCache>`
+    Maps the predictions' light ids back to lights
+
+    `metrics <MonitorMetrics>`
+    Optional, records the lateness of each action
+
+    `tick <float>`
+    Seconds of predictions coalesced into one batch
+
+    `reload_interval <float>`
+    Seconds between checks for new predictions
+
+    `max_lateness <float>`
+    Predictions more than this many seconds overdue are dropped instead of fired
+    """
+    def __init__(self, scheduler, set_lights, item_ids, metrics=None, tick=1.0, reload_interval=60, max_lateness=300):
+        self.scheduler = scheduler
+        self.set_lights = set_lights
+        self.item_ids = item_ids
+        self.metrics = metrics
+        self.tick = tick
+        self.reload_interval = reload_interval
+        self.max_lateness = max_lateness
+
+        self.last_id = None
+        self.fired = 0
+        self.skipped = 0
+
+        self._heap = []
+        self._seen = set()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def __len__(self):
+        return len(self._heap)
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, name="hue-schedule-executor", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        self._wake.set()
+
+    def add(self, predictions):
+        """
+        Adds predictions to the heap, skipping ones already added.
+
+        Parameters
+        ----------
+        `predictions <array>`
+        Rows in the form (id, time, status, light_id)
+        """
+        now = time.time()
+
+        with self._lock:
+            for prediction_id, due, status, light_id in predictions:
+                if self.last_id is None or prediction_id > self.last_id:
+                    self.last_id = prediction_id
+
+                if prediction_id in self._seen:
+                    continue
+
+                due_at = _epoch(due)
+                if due_at < now - self.max_lateness:
+                    continue
+
+                self._seen.add(prediction_id)
+                heapq.heappush(self._heap, (due_at, prediction_id, bool(status), light_id))
+
+        self._wake.set()
+
+    def reload(self):
+        """
+        Fetches predictions that arrived since the last load.
+        """
+        if self.last_id is None:
+            predictions = self.scheduler.get_scheduled_lights() or []
+        else:
+            predictions = fetch_scheduled_light_predictions_after(self.scheduler.conn, self.last_id)
+
+        if predictions:
+            self.add(predictions)
+            log.debug(f"[INFO]: Loaded {len(predictions)} scheduled light predictions")
+
+    def due(self, now=None):
+        """
+        Once the earliest prediction is due, pops it along with everything else due within
+        the next `tick` seconds.
+
+        Returns
+        ----------
+        `due <array>`
+        (due time, id, status, light_id) tuples in due order
+        """
+        now = time.time() if now is None else now
+        batch = []
+
+        with self._lock:
+            if not self._heap or self._heap[0][0] > now:
+                return batch
+
+            while self._heap and self._heap[0][0] <= now + self.tick:
+                entry = heapq.heappop(self._heap)
+                self._seen.discard(entry[1])
+                batch.append(entry)
+
+        return batch
+
+    def fire(self, batch):
+        """
+        Sends one tick's predictions as a single bulk command. When a light has more than one
+        prediction in the tick, the latest wins.
+        """
+        keys = self.item_ids.keys_for({light_id for _, _, _, light_id in batch})
+        now = time.time()
+        targets = {}
+        due_times = {}
+
+        for due_at, prediction_id, status, light_id in batch:
+            key = keys.get(light_id)
+
+            if key is None or now - due_at > self.max_lateness:
+                log.error(f"[ERROR]: Skipping scheduled prediction {prediction_id} for light {light_id}")
+                self.skipped += 1
+                continue
+
+            # The batch is in due order, so a later prediction replaces an earlier one
+            targets[key] = {"on": status}
+            due_times[key] = due_at
+
+        if not targets:
+            return []
+
+        results = self.set_lights(targets)
+        fired_at = time.time()
+
+        self.fired += len(targets)
+        if self.metrics is not None:
+            for due_at in due_times.values():
+                self.metrics.observe("schedule", max(0.0, fired_at - due_at))
+
+        log.debug(f"[INFO]: Fired {len(targets)} scheduled light changes in {len(results)} requests")
+        return results
+
+    def _run(self):
+        next_reload = 0
+
+        while not self._stopped.is_set():
+            self._wake.clear()
+            now = time.time()
+
+            if now >= next_reload:
+                try:
+                    self.reload()
+                except Exception as err:
+                    log.error(f"[ERROR]: Error reloading scheduled predictions: {err}")
+                next_reload = now + self.reload_interval
+
+            batch = self.due(now)
+            if batch:
+                try:
+                    self.fire(batch)
+                except Exception as err:
+                    log.error(f"[ERROR]: Error firing {len(batch)} scheduled predictions: {err}")
+
+            with self._lock:
+                next_due = self._heap[0][0] if self._heap else next_reload
+
+            self._wake.wait(max(0.0, min(next_due, next_reload) - time.time()))
@@ -0,0 +1,157 @@
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+from .state import LightState
+
+log = logging.getLogger('modules')
+
+
+class StartupCache():
+    """
+    The last active bridge and light snapshot, kept in a small JSON file so a restart can start
+    monitoring straight away instead of waiting on the database and the bridge.
+
+    The file holds the bridge's access token, so it's only readable by its owner. It's written
+    to a temporary file and moved into place, so a crash mid-save leaves the previous cache.
+
+    Parameters
+    ----------
+    `path <string>`
+    The cache file
+
+    `save_interval <float>`
+    Minimum seconds between saves. The monitor saves after every change, but the cache only
+    needs to be roughly current. A save that comes too soon is held and written once the
+    interval is up, so the last change before things go quiet still reaches the file.
+    """
+    def __init__(self, path, save_interval=30):
+        self.path = path
+        self.save_interval = save_interval
+        self._saved_at = None
+        self._pending = None
+        self._timer = None
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+
+    def load(self):
+        """
+        Reads the cache.
+
+        Returns
+        ----------
+        `cache <tuple>`
+        (bridge, lights), where bridge is (ip, access_token) or `None` and lights is a snapshot
+        in the form {uniqueid: LightState}. (None, {}) if there's no usable cache.
+        """
+        try:
+            with open(self.path) as cache_file:
+                data = json.load(cache_file)
+
+            bridge = data.get("bridge")
+            lights = {}
+
+            for record in data.get("lights", []):
+                if record.get("xy") is not None:
+                    record["xy"] = tuple(record["xy"])
+                for field in ("effect", "colormode", "alert"):
+                    if isinstance(record.get(field), str):
+                        record[field] = sys.intern(record[field])
+                light = LightState(**record)
+                lights[light.uniqueid] = light
+
+        except FileNotFoundError:
+            return None, {}
+        except (OSError, ValueError, TypeError, AttributeError) as err:
+            log.error(f"[ERROR]: Ignoring unreadable startup cache {self.path}: {err}")
+            return None, {}
+
+        return (tuple(bridge) if bridge else None), lights
+
+    def save(self, bridge, lights, force=False):
+        """
+        Writes the bridge and light snapshot, at most once every `save_interval` seconds. A
+        save within the interval replaces any save already held, and is written by a
+        background timer when the interval is up.
+
+        Parameters
+        ----------
+        `bridge <BridgeClient>`
+        The active bridge, or `None` to keep only the lights
+
+        `lights <dictionary>`
+        A snapshot in the form {uniqueid: LightState}
+
+        `force <boolean>`
+        Save now even if the last save was less than `save_interval` seconds ago
+
+        Returns
+        ----------
+        `saved <boolean>`
+        Whether the cache was written now
+        """
+        with self._lock:
+            now = time.monotonic()
+            wait = 0 if force or self._saved_at is None else self._saved_at + self.save_interval - now
+
+            if wait > 0:
+                self._pending = (bridge, lights)
+                if self._timer is None:
+                    self._timer = threading.Timer(wait, self.flush)
+                    self._timer.daemon = True
+                    self._timer.start()
+                return False
+
+            self._cancel()
+            self._saved_at = now
+
+        return self._write(bridge, lights)
+
+    def flush(self):
+        """
+        Writes a held save straight away, e.g. on shutdown.
+
+        Returns
+        ----------
+        `saved <boolean>`
+        Whether there was a held save and it was written
+        """
+        with self._lock:
+            pending = self._pending
+            self._cancel()
+
+            if pending is None:
+                return False
+
+            self._saved_at = time.monotonic()
+
+        return self._write(*pending)
+
+    def _cancel(self):
+        # Drops the held save and its timer. Called with the lock held
+        self._pending = None
+        timer, self._timer = self._timer, None
+        if timer is not None and timer is not threading.current_thread():
+            timer.cancel()
+
+    def _write(self, bridge, lights):
+        data = {
+            "bridge": [bridge.ip, bridge.access_token] if bridge is not None else None,
+            "lights": [light.as_dict() for light in lights.values()],
+        }
+        temporary = f"{self.path}.tmp"
+
+        try:
+            with self._write_lock:
+                descriptor = os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+                with os.fdopen(descriptor, "w") as cache_file:
+                    json.dump(data, cache_file, separators=(",", ":"))
+                os.replace(temporary, self.path)
+        except (OSError, TypeError, ValueError) as err:
+            log.error(f"[ERROR]: Couldn't save startup cache {self.path}: {err}")
+            return False
+
+        return True
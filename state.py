@@ -0,0 +1,240 @@
+import sys
+
+# State fields kept for every light. Anything else the bridge reports (capabilities, config,
+# swupdate, etc) is dropped when a response is converted.
+STATE_FIELDS = ("on", "reachable", "bri", "hue", "sat", "ct", "xy", "effect", "colormode", "alert")
+
+# Short strings that repeat across every light are interned so each snapshot shares one copy
+_INTERNED_FIELDS = ("effect", "colormode", "alert")
+
+
+class LightState():
+    """
+    The parts of a light that the monitor diffs and saves, without the rest of the bridge JSON
+
+    Attributes
+    ----------
+    `key <string>`
+    The bridge light key, e.g. "3"
+
+    `uniqueid <string>`
+    The light's uniqueid, usually a MAC address
+
+    `name <string>`
+    The light's name
+
+    The remaining attributes are the `STATE_FIELDS` from the light's "state" object. `xy` is
+    stored as a tuple.
+    """
+    __slots__ = ("key", "uniqueid", "name") + STATE_FIELDS
+
+    def __init__(self, key, uniqueid, name, on=None, reachable=None, bri=None, hue=None, sat=None, ct=None,
+                 xy=None, effect=None, colormode=None, alert=None):
+        self.key = key
+        self.uniqueid = uniqueid
+        self.name = name
+        self.on = on
+        self.reachable = reachable
+        self.bri = bri
+        self.hue = hue
+        self.sat = sat
+        self.ct = ct
+        self.xy = xy
+        self.effect = effect
+        self.colormode = colormode
+        self.alert = alert
+
+    @classmethod
+    def from_bridge(cls, key, light):
+        """
+        Converts one light from the bridge response.
+
+        Parameters
+        ----------
+        `key <string>`
+        The bridge light key
+
+        `light <dictionary>`
+        The light's data, as returned under its key by `/api/<token>/lights`
+        """
+        state = light.get("state", {})
+        xy = state.get("xy")
+
+        light_state = cls(key, light.get("uniqueid"), light.get("name"), state.get("on"), state.get("reachable"),
+                          state.get("bri"), state.get("hue"), state.get("sat"), state.get("ct"),
+                          tuple(xy) if xy is not None else None)
+
+        for field in _INTERNED_FIELDS:
+            value = state.get(field)
+            setattr(light_state, field, sys.intern(value) if isinstance(value, str) else value)
+
+        return light_state
+
+    def get(self, field):
+        return getattr(self, field)
+
+    def as_dict(self):
+        return {field: getattr(self, field) for field in self.__slots__}
+
+    def __eq__(self, other):
+        if not isinstance(other, LightState):
+            return NotImplemented
+        return all(getattr(self, field) == getattr(other, field) for field in self.__slots__)
+
+    def __repr__(self):
+        return f"<LightState {self.key} {self.name} on={self.on} reachable={self.reachable} bri={self.bri}>"
+
+
+def snapshot(lights):
+    """
+    Converts a bridge light object into a compact snapshot.
+
+    Parameters
+    ----------
+    `lights <dictionary>`
+    The bridge light object in the form {1: {data}, 2: {data}, etc...}
+
+    Returns
+    ----------
+    `snapshot <dictionary>`
+    An object in the form {uniqueid: LightState}. Lights without a uniqueid are skipped.
+    """
+    from_bridge = LightState.from_bridge
+    result = {}
+
+    for key, light in lights.items():
+        unique_id = light.get("uniqueid")
+        if unique_id is not None:
+            result[unique_id] = from_bridge(key, light)
+
+    return result
+
+
+# Sensor state and config fields kept for every sensor: motion, switches, temperature, light
+# level and their battery and reachability
+SENSOR_FIELDS = ("presence", "buttonevent", "temperature", "lightlevel", "dark", "daylight", "lastupdated",
+                 "on", "reachable", "battery")
+
+_SENSOR_CONFIG_FIELDS = ("on", "reachable", "battery")
+
+
+class SensorState():
+    """
+    The parts of a sensor that the monitor diffs, like `LightState` for lights
+
+    Attributes
+    ----------
+    `key <string>`
+    The bridge sensor key
+
+    `uniqueid <string>`
+    The sensor's uniqueid. Virtual sensors (daylight, generic flags) don't have one, so they
+    get "sensor-<key>"
+
+    `name <string>`
+    The sensor's name
+
+    `type <string>`
+    The bridge sensor type, e.g. "ZLLPresence" or "ZLLSwitch"
+
+    The remaining attributes are the `SENSOR_FIELDS`, from the sensor's "state" and "config"
+    objects. `lastupdated` changes on every button press even when `buttonevent` doesn't.
+    """
+    __slots__ = ("key", "uniqueid", "name", "type") + SENSOR_FIELDS
+
+    @classmethod
+    def from_bridge(cls, key, sensor):
+        state = sensor.get("state", {})
+        config = sensor.get("config", {})
+        sensor_state = cls()
+        sensor_state.key = key
+        sensor_state.uniqueid = sensor.get("uniqueid") or f"sensor-{key}"
+        sensor_state.name = sensor.get("name")
+        sensor_state.type = sensor.get("type")
+
+        for field in SENSOR_FIELDS:
+            source = config if field in _SENSOR_CONFIG_FIELDS else state
+            setattr(sensor_state, field, source.get(field))
+
+        return sensor_state
+
+    def get(self, field):
+        return getattr(self, field)
+
+    def __repr__(self):
+        return f"<SensorState {self.key} {self.name} {self.type}>"
+
+
+GROUP_FIELDS = ("all_on", "any_on", "lights")
+
+
+class GroupState():
+    """
+    The parts of a group (room, zone, etc) that the monitor diffs
+
+    Attributes
+    ----------
+    `key <string>`
+    The bridge group key
+
+    `uniqueid <string>`
+    Groups don't have one, so it's "group-<key>"
+
+    `name <string>`
+    The group's name
+
+    `type <string>`
+    The bridge group type, e.g. "Room" or "Zone"
+
+    `all_on <boolean>`, `any_on <boolean>`
+    From the group's "state" object
+
+    `lights <tuple>`
+    The group's light keys
+    """
+    __slots__ = ("key", "uniqueid", "name", "type") + GROUP_FIELDS
+
+    @classmethod
+    def from_bridge(cls, key, group):
+        state = group.get("state", {})
+        group_state = cls()
+        group_state.key = key
+        group_state.uniqueid = f"group-{key}"
+        group_state.name = group.get("name")
+        group_state.type = group.get("type")
+        group_state.all_on = state.get("all_on")
+        group_state.any_on = state.get("any_on")
+        group_state.lights = tuple(group.get("lights", ()))
+        return group_state
+
+    def get(self, field):
+        return getattr(self, field)
+
+    def __repr__(self):
+        return f"<GroupState {self.key} {self.name} any_on={self.any_on}>"
+
+
+def resource_snapshot(resources, record_class):
+    """
+    Converts a bridge sensor or group object into a compact snapshot.
+
+    Parameters
+    ----------
+    `resources <dictionary>`
+    The bridge object in the form {1: {data}, 2: {data}, etc...}
+
+    `record_class <class>`
+    `SensorState` or `GroupState`
+
+    Returns
+    ----------
+    `snapshot <dictionary>`
+    An object in the form {uniqueid: record}
+    """
+    result = {}
+
+    for key, resource in resources.items():
+        record = record_class.from_bridge(key, resource)
+        result[record.uniqueid] = record
+
+    return result
@@ -0,0 +1,141 @@
+import logging
+import threading
+import time
+
+from .db import save_brain_status_hue_bridge
+
+log = logging.getLogger('modules')
+
+# Statuses that can flip back and forth on a flaky network
+FLAPPING_STATUSES = ("Connected", "Not Found")
+
+
+class BrainStatusTracker():
+    """
+    Writes the hue bridge status to `eranaAPI_brain_ability` only when it actually changes.
+
+    With `debounce` set, a move between the flapping statuses ("Connected" and "Not Found") is
+    only written once the new status has been reported for `debounce` seconds. Any other
+    status is written straight away.
+
+    Parameters
+    ----------
+    `conn <database connection>`
+    The connection to the main Postgres database
+
+    `debounce <float>`
+    Seconds a flapping status has to hold before it's written. 0 writes every transition.
+
+    `background <boolean>`
+    Write statuses on a background thread, so `set` never waits on the database. If statuses
+    change faster than they're written, only the latest one is written.
+
+    `retry_interval <float>`
+    Seconds the background thread waits before trying a failed write again. Without the
+    background thread a failed write is tried again on the next `set`.
+    """
+    def __init__(self, conn, debounce=0, background=False, retry_interval=5):
+        self.conn = conn
+        self.debounce = debounce
+        self.background = background
+        self.retry_interval = retry_interval
+        self.written = None
+        self.writes = 0
+
+        self._pending = None
+        self._pending_since = None
+        self._lock = threading.Lock()
+
+        self._queued = None
+        self._ready = threading.Event()
+        self._thread = None
+
+    def set(self, status):
+        """
+        Reports the current status, writing it if it's a real transition.
+
+        Returns
+        ----------
+        `written <boolean>`
+        Whether the status was written to the database
+        """
+        with self._lock:
+            if status == self.written:
+                self._pending = None
+                return False
+
+            flapping = status in FLAPPING_STATUSES and self.written in FLAPPING_STATUSES
+
+            if self.debounce > 0 and flapping:
+                now = time.monotonic()
+                if status != self._pending:
+                    self._pending = status
+                    self._pending_since = now
+                    return False
+                if now - self._pending_since < self.debounce:
+                    return False
+
+            return self._write(status)
+
+    def flush(self):
+        """
+        Writes a status that is still waiting out the debounce.
+        """
+        with self._lock:
+            if self._pending is not None and self._pending != self.written:
+                return self._write(self._pending)
+            return False
+
+    def _write(self, status):
+        self._pending = None
+
+        if self.background:
+            # Counted as written so repeats aren't queued again; a failed write clears it
+            self._queued = status
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._write_queued, name="hue-brain-status", daemon=True)
+                self._thread.start()
+            self._ready.set()
+        elif save_brain_status_hue_bridge(self.conn, status) is None:
+            # Not recorded as written, so the next `set` tries again
+            return False
+        else:
+            self.writes += 1
+
+        log.debug("[INFO]: Hue bridge brain status %s -> %s", self.written, status)
+        self.written = status
+        return True
+
+    def _write_queued(self):
+        while True:
+            self._ready.wait()
+
+            with self._lock:
+                self._ready.clear()
+                status, self._queued = self._queued, None
+
+            if status is None:
+                continue
+
+            try:
+                saved = save_brain_status_hue_bridge(self.conn, status)
+            except Exception as err:
+                log.error(f"[ERROR]: Error writing Hue bridge brain status {status}: {err}")
+                saved = None
+
+            if saved is not None:
+                with self._lock:
+                    self.writes += 1
+                    if self._queued is None:
+                        self.written = status
+                continue
+
+            with self._lock:
+                if self.written == status:
+                    self.written = None
+                # A newer status replaces the failed one rather than queueing behind it
+                if self._queued is None:
+                    self._queued = status
+                    self._ready.set()
+
+            time.sleep(self.retry_interval)
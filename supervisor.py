@@ -0,0 +1,341 @@
+import asyncio
+import concurrent.futures
+import datetime
+import logging
+import random
+
+from .breaker import CircuitBreaker, CircuitOpen
+from .commands import LightCommander
+from .connection import BridgeClient, create_session
+from .db import fetch_phillips_active_bridges
+from .events import AdaptivePoller, BridgeEventStream
+from .metrics import MonitorMetrics
+from .monitor_log import SampledLogger
+from .resources import ResourceMonitor, record_light_changes
+from .state import snapshot
+from .tracking import load_bridge_health, load_monitored_resources, load_poll_intervals, load_tracking
+from .writer import ActionWriter
+
+log = logging.getLogger('modules')
+monitor_log = SampledLogger()
+
+
+class BridgeMonitor():
+    """
+    Watches one bridge from inside the supervisor's event loop. Failures only back off this
+    bridge; the others keep going.
+
+    Like `PhillipsHueBridgeLight`, each poll is one request fanned out to the lights and any
+    other monitored resources, and requests go through a `CircuitBreaker` so an unreachable
+    bridge is probed one request at a time instead of polled.
+
+    Parameters
+    ----------
+    `bridge_id <int>`
+    The bridge's `eranaAPI_item` id
+
+    `client <BridgeClient>`
+    Client for the bridge
+
+    `writer <ActionWriter>`
+    Where changed lights are saved
+
+    `executor <Executor>`
+    Runs the blocking HTTP calls
+
+    `mode <string>`
+    `"stream"`, `"poll"` or `"auto"`, as in `PhillipsHueBridgeLight.run`
+
+    `max_backoff <float>`
+    Upper bound on the seconds to wait after repeated failures
+
+    `metrics <MonitorMetrics>`
+    Where polls, changes, errors and fetch latencies are counted. Shared by all the bridges
+
+    `breaker <CircuitBreaker>`
+    This bridge's circuit breaker. A new one is made if not given
+
+    `resources <tuple>`
+    The monitored resources, e.g. ("lights", "sensors")
+
+    `poll_intervals <dictionary>`
+    Keyword arguments for the `AdaptivePoller`
+    """
+    def __init__(self, bridge_id, client, writer, executor, mode="auto", max_backoff=60, stream_scheme="https", stream_retry=60,
+                 metrics=None, breaker=None, resources=("lights",), poll_intervals=None):
+        self.bridge_id = bridge_id
+        self.client = client
+        self.writer = writer
+        self.executor = executor
+        self.mode = mode
+        self.max_backoff = max_backoff
+        self.stream_scheme = stream_scheme
+        self.stream_retry = stream_retry
+        self.metrics = metrics if metrics is not None else MonitorMetrics()
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+
+        self.poller = AdaptivePoller(**(poll_intervals or {}))
+        self.tracked_fields, self.thresholds = load_tracking()
+        self.resources = ResourceMonitor({"lights": self._process_lights})
+        for resource in resources:
+            if resource != "lights":
+                self.resources.watch(resource)
+        self.failures = 0
+        self._stream = None
+
+        # Light commands for this bridge, resolved against its own snapshot and paced under its
+        # own rate limits
+        self.commands = LightCommander(lambda: self.client, lambda: self.state or {})
+
+    @property
+    def state(self):
+        return self.resources.snapshots.get("lights")
+
+    def __repr__(self):
+        return f"<BridgeMonitor {self.bridge_id} {self.client.ip}>"
+
+    async def _call(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def check_for_changes(self, resources=None):
+        """
+        Fetches this bridge's monitored resources once and queues actions for any light
+        changes. Sends nothing while the circuit is open.
+
+        Parameters
+        ----------
+        `resources <iterable>`
+        Only fetch these, e.g. the ones a stream event touched. All of them if `None`
+
+        Returns
+        ----------
+        `changed <boolean>`
+        Whether anything changed
+        """
+        if not self.breaker.allow():
+            self.metrics.inc("short_circuited")
+            return False
+
+        try:
+            with self.metrics.time("fetch"):
+                state = await self._call(self.resources.fetch, self.client, resources)
+        except Exception:
+            self.breaker.failure()
+            self.metrics.inc("errors")
+            raise
+
+        self.breaker.success()
+        return self.resources.dispatch(state, datetime.datetime.now(), resources)
+
+    def _process_lights(self, lights, fetched_at=None):
+        # An empty response means the fetch failed, not that every light was removed
+        if not lights:
+            return False
+
+        self.metrics.inc("polls")
+
+        # The first fetch is the baseline, same as run()
+        if self.state is None:
+            self.resources.snapshots["lights"] = snapshot(lights)
+            return False
+
+        changes = record_light_changes(self.state, lights, self.writer, self.tracked_fields, self.thresholds, fetched_at, self.metrics)
+
+        if not changes:
+            return False
+
+        # Removed lights leave the snapshot too, even though they don't get an action
+        self.resources.snapshots["lights"] = changes.state
+        changed = len(changes.changed) + len(changes.added)
+
+        if not changed:
+            return False
+
+        self.metrics.inc("changes", changed)
+        return True
+
+    async def poll(self, duration=None):
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+
+        while duration is None or loop.time() - started < duration:
+            changed = await self.check_for_changes()
+            self.failures = 0
+            await asyncio.sleep(self.poller.next_interval(changed))
+
+    async def follow_stream(self):
+        # Outages are probed by polling; a stream can't be opened one request at a time
+        if self.breaker.state != CircuitBreaker.CLOSED:
+            raise CircuitOpen(f"Bridge {self.bridge_id} is failing, polling until it recovers")
+
+        self._stream = BridgeEventStream(self.client.ip, self.client.access_token, scheme=self.stream_scheme)
+        events = self._stream.changes(self.resources.resource_types())
+
+        try:
+            await self.check_for_changes()
+
+            while True:
+                keys = await self._call(next, events, None)
+                if keys is None:
+                    return
+                await self.check_for_changes({resource for resource, _ in keys})
+                self.failures = 0
+        finally:
+            # Unblocks the executor thread waiting on the stream if we were cancelled
+            self._stream.close()
+
+    async def run(self):
+        while True:
+            try:
+                if self.mode != "poll":
+                    try:
+                        await self.follow_stream()
+                    except asyncio.CancelledError:
+                        raise
+                    except Exception as err:
+                        monitor_log.warning("[WARNING]: Event stream unavailable for bridge %s: %s", self.bridge_id, err, key=("stream", self.bridge_id))
+
+                if self.mode == "poll":
+                    await self.poll()
+                elif self.mode == "auto":
+                    await self.poll(duration=self.stream_retry)
+                else:
+                    await asyncio.sleep(self.poller.next_interval(False))
+            except asyncio.CancelledError:
+                raise
+            except Exception as err:
+                self.failures += 1
+                delay = min(self.max_backoff, 2 ** self.failures) * random.uniform(0.5, 1.0)
+                monitor_log.error("[ERROR]: Bridge %s at %s failed %d times, retrying in %.1fs: %s", self.bridge_id, self.client.ip, self.failures, delay, err, key=("failed", self.bridge_id))
+                await asyncio.sleep(delay)
+
+
+class BridgeSupervisor():
+    """
+    Monitors every active bridge concurrently, one coroutine per bridge, sharing a keep-alive
+    HTTP session, a thread pool for the blocking requests, one `ActionWriter` and one
+    `MonitorMetrics`. `PhillipsHueBridgeLight.run` hands over to it when there's more than one
+    active bridge, passing its journaled writer and metrics.
+
+    The bridge list is re-read every `refresh_interval` seconds; monitors are started for new
+    bridges and cancelled for ones that went away or changed IP or token. If the list can't be
+    read the running monitors are left alone.
+
+    Request timeouts, breaker settings, poll intervals and monitored resources come from
+    config.yml, as for the single bridge monitor.
+
+    Parameters
+    ----------
+    `conn <database connection>`
+    The connection to the main Postgres database
+
+    `writer <ActionWriter>`
+    Where changed lights are saved. A new one is made if not given
+
+    `metrics <MonitorMetrics>`
+    Shared by every bridge monitor. The writer's metrics if not given
+
+    `mode <string>`
+    `"stream"`, `"poll"` or `"auto"`, as in `PhillipsHueBridgeLight.run`
+
+    `refresh_interval <float>`
+    Seconds between reads of the bridge list
+
+    `max_workers <int>`
+    Threads for blocking HTTP calls. Each streaming bridge keeps one busy.
+
+    `stream_scheme <string>`
+    The bridge serves its event stream over `https` only. The fake bridge uses `http`.
+    """
+    def __init__(self, conn, writer=None, mode="auto", refresh_interval=300, max_workers=32, stream_scheme="https", metrics=None):
+        self.conn = conn
+        self.writer = writer if writer is not None else ActionWriter(conn)
+        self.metrics = metrics if metrics is not None else self.writer.metrics
+        self.mode = mode
+        self.stream_scheme = stream_scheme
+        self.refresh_interval = refresh_interval
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="hue-bridge")
+        self.session = create_session(pool_connections=max_workers, pool_maxsize=2)
+
+        self.timeout, self.breaker_settings = load_bridge_health()
+        self.poll_intervals = load_poll_intervals()
+        self.resources = load_monitored_resources()
+
+        self.monitors = {}
+        self._tasks = {}
+
+    def _sync_bridges(self, rows):
+        wanted = {bridge_id: (access_token, ip) for bridge_id, access_token, ip in rows if access_token and ip}
+
+        for bridge_id in list(self._tasks):
+            monitor = self.monitors[bridge_id]
+            if wanted.get(bridge_id) != (monitor.client.access_token, monitor.client.ip):
+                log.debug(f"[INFO]: Stopping monitor for bridge {bridge_id}")
+                self._tasks.pop(bridge_id).cancel()
+                del self.monitors[bridge_id]
+
+        for bridge_id, (access_token, ip) in wanted.items():
+            if bridge_id in self._tasks:
+                continue
+
+            client = BridgeClient(ip, access_token, timeout=self.timeout or 5, session=self.session)
+            monitor = BridgeMonitor(bridge_id, client, self.writer, self.executor, mode=self.mode, stream_scheme=self.stream_scheme,
+                                    metrics=self.metrics, breaker=CircuitBreaker(**self.breaker_settings),
+                                    resources=self.resources, poll_intervals=self.poll_intervals)
+            self.monitors[bridge_id] = monitor
+            self._tasks[bridge_id] = asyncio.get_running_loop().create_task(monitor.run(), name=f"hue-bridge-{bridge_id}")
+            log.debug(f"[INFO]: Started monitor for bridge {bridge_id} at {ip}")
+
+    async def run(self):
+        """
+        Runs until cancelled.
+        """
+        loop = asyncio.get_running_loop()
+
+        try:
+            while True:
+                try:
+                    rows = await loop.run_in_executor(self.executor, fetch_phillips_active_bridges, self.conn)
+                except Exception as err:
+                    # An empty list would stop every monitor; keep them running until it can be read
+                    log.error(f"[ERROR]: Couldn't read the active bridges, keeping {len(self._tasks)} monitors running: {err}")
+                else:
+                    self._sync_bridges(rows)
+                await asyncio.sleep(self.refresh_interval)
+        finally:
+            for task in self._tasks.values():
+                task.cancel()
+            await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+            self._tasks = {}
+            self.monitors = {}
+
+    def apply(self, targets):
+        """
+        Sets many lights across the bridges, sending each light to the bridge whose snapshot
+        has it, like `LightCommander.apply`. Blocks, so call it from outside the event loop.
+
+        Parameters
+        ----------
+        `targets <dictionary>`
+        An object in the form {uniqueid or name: state}, as for `LightCommander.plan`
+
+        Returns
+        ----------
+        `results <array>`
+        An object per request sent in the form {"path": ..., "body": ..., "ok": bool, "latency": seconds}
+        """
+        remaining = dict(targets)
+        results = []
+
+        for monitor in list(self.monitors.values()):
+            keys = monitor.commands.resolve(monitor.state or {}, remaining)
+            if keys:
+                results.extend(monitor.commands.apply({identifier: remaining.pop(identifier) for identifier in keys}))
+
+        for identifier in remaining:
+            log.error(f"[ERROR]: Light {identifier} isn't on any active bridge, skipping it")
+
+        return results
+
+    def run_forever(self):
+        asyncio.run(self.run())
@@ -0,0 +1,1173 @@
+"""
+Tests for the Phillips Hue Bridge module. The monitor tests run against a `FakeHueBridge` and
+the benchmark's `StubDatabase`, so none of them need a bridge or Postgres.
+
+Run with `python -m unittest <package>.tests` from the directory above this module.
+"""
+import datetime
+import os
+import random
+import socket
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import psycopg2
+
+from .benchmark import StubDatabase
+from .db import ConnectionPool, PoolExhausted
+from .breaker import CircuitBreaker, CircuitOpen
+from .commands import LightCommander
+from .diff import diff_lights
+from . import discovery
+from .discovery import BridgeDiscovery, probe_ssdp
+from .events import AdaptivePoller
+from .fake_bridge import FakeHueBridge, synthetic_lights, synthetic_sensors
+from .item_cache import ItemIdCache
+from .journal import ActionJournal
+from .resources import ResourceMonitor, record_light_changes
+from .scheduler import ScheduleExecutor
+from .state import snapshot
+from .startup_cache import StartupCache
+from .status import BrainStatusTracker
+from .tracking import decode_values, encode_values, load_tracking
+from .writer import ActionWriter
+
+
+def _wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return condition()
+
+
+def _actions(count, start=0):
+    event_time = datetime.datetime(2024, 1, 1, 12, 0, 0)
+    return [(event_time + datetime.timedelta(seconds=i), float(i), i % 2 == 0, True, str(i), None)
+            for i in range(start, start + count)]
+
+
+class FakeClock():
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class _FailingDatabase(StubDatabase):
+    # Fails the `fail_on`th action insert and every one after it until `recover` is called
+    def __init__(self, bridge, fail_on):
+        super().__init__(bridge)
+        self.fail_on = fail_on
+        self.attempts = 0
+
+    def recover(self):
+        self.fail_on = None
+
+    def answer(self, sql, args, rows):
+        if sql.lstrip().startswith("INSERT INTO \"eranaAPI_action\""):
+            self.attempts += 1
+            if self.fail_on is not None and self.attempts >= self.fail_on:
+                raise RuntimeError("database unavailable")
+        return super().answer(sql, args, rows)
+
+
+class _OutageDatabase(StubDatabase):
+    # Fails every statement containing `match` while `down` is set
+    def __init__(self, bridge, match):
+        super().__init__(bridge)
+        self.match = match
+        self.down = False
+        self.attempts = 0
+
+    def answer(self, sql, args, rows):
+        if self.match in sql:
+            self.attempts += 1
+            if self.down:
+                raise RuntimeError("database unavailable")
+        return super().answer(sql, args, rows)
+
+
+class _RejectingDatabase(StubDatabase):
+    # Rejects every insert holding an action for one of the `bad` item ids, as a foreign key would
+    def __init__(self, bridge, bad):
+        super().__init__(bridge)
+        self.bad = set(bad)
+
+    def answer(self, sql, args, rows):
+        if sql.lstrip().startswith("INSERT INTO \"eranaAPI_action\"") and any(row[4] in self.bad for row in rows):
+            raise psycopg2.IntegrityError("violates foreign key constraint")
+        return super().answer(sql, args, rows)
+
+
+class _ItemIds():
+    # Resolves every key to itself as an int, like the stub database's light items
+    def __init__(self):
+        self.invalidated = []
+
+    def resolve(self, keys):
+        return {key: int(key) for key in keys}
+
+    def invalidate(self, key=None):
+        self.invalidated.append(key)
+
+
+class DiffLightsTest(unittest.TestCase):
+    def setUp(self):
+        self.lights = synthetic_lights(5)
+        self.old = snapshot(self.lights)
+
+    def _changed(self, key, **state):
+        self.lights[key]["state"].update(state)
+        return snapshot(self.lights)
+
+    def test_no_changes(self):
+        changes = diff_lights(self.old, snapshot(self.lights))
+
+        self.assertFalse(changes)
+        self.assertEqual(len(changes), 0)
+
+    def test_changed_light(self):
+        on = self.lights["2"]["state"]["on"]
+        changes = diff_lights(self.old, self._changed("2", on=not on))
+
+        self.assertEqual(len(changes.changed), 1)
+        self.assertEqual(changes.changed[0]["id"], "2")
+        self.assertEqual(changes.changed[0]["changed"], ["on"])
+        self.assertEqual(changes.changed[0]["on"], not on)
+
+    def test_added_and_removed_lights(self):
+        new = dict(self.old)
+        removed = new.pop(next(iter(new)))
+        added = snapshot(synthetic_lights(6))
+        added_id = next(unique_id for unique_id in added if unique_id not in self.old)
+        new[added_id] = added[added_id]
+
+        changes = diff_lights(self.old, new)
+
+        self.assertEqual([record["id"] for record in changes.removed], [removed.key])
+        self.assertEqual([record["id"] for record in changes.added], [added[added_id].key])
+        self.assertEqual(changes.changed, [])
+
+    def test_threshold_holds_small_moves_until_they_add_up(self):
+        bri = self.lights["1"]["state"]["bri"]
+        bri = bri - 6 if bri > 6 else bri + 6
+        step = 3 if bri > self.lights["1"]["state"]["bri"] else -3
+
+        first = diff_lights(self.old, self._changed("1", bri=self.lights["1"]["state"]["bri"] + step), thresholds={"bri": 5})
+        self.assertFalse(first)
+
+        second = diff_lights(first.state, self._changed("1", bri=bri), thresholds={"bri": 5})
+        self.assertEqual([record["id"] for record in second.changed], ["1"])
+
+
+class RecordLightChangesTest(unittest.TestCase):
+    def setUp(self):
+        self.lights = synthetic_lights(3)
+        self.old = snapshot(self.lights)
+        self.added = []
+        self.writer = type("Writer", (), {"add": lambda writer, actions: self.added.extend(actions)})()
+
+    def test_empty_response_is_not_a_change(self):
+        self.assertIsNone(record_light_changes(self.old, {}, self.writer, ("on", "reachable", "bri")))
+        self.assertEqual(self.added, [])
+
+    def test_queues_an_encoded_action_per_changed_light(self):
+        fetched_at = datetime.datetime(2024, 1, 1, 20, 0, 0)
+        self.lights["2"]["state"].update(on=not self.lights["2"]["state"]["on"], bri=17)
+
+        changes = record_light_changes(self.old, self.lights, self.writer, ("on", "reachable", "bri"), fetched_at=fetched_at)
+
+        self.assertEqual(len(changes.changed), 1)
+        self.assertEqual(self.added, [(fetched_at, 0.0, self.lights["2"]["state"]["on"], self.lights["2"]["state"]["reachable"],
+                                       self.lights["2"]["name"], "b17")])
+
+    def test_removed_light_gets_no_action(self):
+        del self.lights["3"]
+
+        changes = record_light_changes(self.old, self.lights, self.writer, ("on", "reachable", "bri"))
+
+        self.assertEqual(len(changes.removed), 1)
+        self.assertEqual(len(changes.state), 2)
+        self.assertEqual(self.added, [])
+
+
+def _groups():
+    return {
+        "1": {"name": "Kitchen", "type": "Room", "lights": ["1", "2"], "state": {"all_on": False, "any_on": True}},
+        "2": {"name": "Upstairs", "type": "Zone", "lights": ["3"], "state": {"all_on": False, "any_on": False}},
+    }
+
+
+class ResourceHandlerTest(unittest.TestCase):
+    def setUp(self):
+        self.sensors = synthetic_sensors(3)
+        self.groups = _groups()
+        self.monitor = ResourceMonitor()
+        self.seen = []
+        listener = lambda resource, changes, fetched_at: self.seen.append((resource, changes, fetched_at))
+        self.monitor.watch("sensors", listener)
+        self.monitor.watch("groups", listener)
+
+        # The first response is the baseline
+        self.assertFalse(self.monitor.dispatch({"sensors": self.sensors, "groups": self.groups}))
+        self.assertEqual(self.seen, [])
+
+    def test_sensor_change(self):
+        self.sensors["2"]["state"]["presence"] = not self.sensors["2"]["state"]["presence"]
+        fetched_at = datetime.datetime(2024, 1, 1, 12, 0, 0)
+
+        self.assertTrue(self.monitor.dispatch({"sensors": self.sensors, "groups": self.groups}, fetched_at))
+
+        resource, changes, seen_at = self.seen[0]
+        self.assertEqual((resource, seen_at), ("sensors", fetched_at))
+        self.assertEqual([(record["id"], record["changed"]) for record in changes.changed], [("2", ["presence"])])
+
+    def test_button_press_with_the_same_event_counts(self):
+        self.sensors["1"]["state"]["lastupdated"] = "2020-07-01T10:00:05"
+
+        self.assertTrue(self.monitor.dispatch({"sensors": self.sensors, "groups": self.groups}))
+        self.assertEqual(self.seen[0][1].changed[0]["changed"], ["lastupdated"])
+
+    def test_group_state_and_membership(self):
+        self.groups["2"]["state"]["any_on"] = True
+        self.groups["1"]["lights"].append("3")
+
+        self.assertTrue(self.monitor.dispatch({"sensors": self.sensors, "groups": self.groups}))
+
+        resource, changes, _ = self.seen[0]
+        self.assertEqual(resource, "groups")
+        self.assertEqual(sorted((record["id"], tuple(record["changed"])) for record in changes.changed),
+                         [("1", ("lights",)), ("2", ("any_on",))])
+
+    def test_empty_response_keeps_the_snapshot(self):
+        self.assertFalse(self.monitor.dispatch({"groups": self.groups}))
+
+        self.sensors["3"]["config"]["reachable"] = False
+        self.assertTrue(self.monitor.dispatch({"sensors": self.sensors, "groups": self.groups}))
+        self.assertEqual([record["id"] for record in self.seen[0][1].changed], ["3"])
+
+    def test_dispatch_only_touches_the_given_resources(self):
+        self.sensors["1"]["config"]["battery"] = 1
+        self.groups["1"]["state"]["all_on"] = True
+
+        self.assertTrue(self.monitor.dispatch({"sensors": self.sensors, "groups": self.groups}, resources=("groups",)))
+        self.assertEqual([resource for resource, _, _ in self.seen], ["groups"])
+
+    def test_failing_listener_does_not_stop_the_others(self):
+        handler = self.monitor.handlers["groups"]
+        handler.listeners.insert(0, lambda resource, changes, fetched_at: 1 / 0)
+        self.groups["1"]["state"]["all_on"] = True
+
+        self.assertTrue(self.monitor.dispatch({"sensors": self.sensors, "groups": self.groups}))
+        self.assertEqual([resource for resource, _, _ in self.seen], ["groups"])
+
+
+class ItemIdCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.bridge = FakeHueBridge(light_count=3)
+        self.db = StubDatabase(self.bridge)
+        self.clock = FakeClock()
+        self.cache = ItemIdCache(self.db, miss_ttl=60, clock=self.clock)
+        self.light = self.bridge.lights["2"]
+
+    def test_preloads_once_under_uniqueid_and_name(self):
+        found = self.cache.resolve([self.light["uniqueid"], self.light["name"]])
+
+        self.assertEqual(found, {self.light["uniqueid"]: 2, self.light["name"]: 2})
+        self.assertEqual(self.db.statements, 1)
+
+        self.cache.get(self.light["name"])
+        self.assertEqual(self.db.statements, 1)
+
+    def test_new_item_is_fetched_on_a_miss(self):
+        self.cache.preload()
+        self.db.items.append((4, "00:17:88:01:00:00:00:04-0b", "Hall"))
+
+        self.assertEqual(self.cache.resolve(["Hall", self.light["name"]]), {"Hall": 4, self.light["name"]: 2})
+        self.assertEqual(self.db.statements, 2)
+        self.assertEqual(self.cache.get("00:17:88:01:00:00:00:04-0b"), 4)
+        self.assertEqual(self.db.statements, 2)
+
+    def test_misses_are_cached_until_the_ttl(self):
+        self.cache.preload()
+
+        self.assertEqual(self.cache.resolve(["Unknown"]), {})
+        self.assertEqual(self.cache.resolve(["Unknown"]), {})
+        self.assertEqual(self.db.statements, 2)
+
+        self.clock.now += 61
+        self.db.items.append((4, None, "Unknown"))
+        self.assertEqual(self.cache.get("Unknown"), 4)
+        self.assertEqual(self.db.statements, 3)
+
+    def test_invalidate_forgets_a_miss(self):
+        self.cache.preload()
+        self.cache.get("Unknown")
+        self.db.items.append((4, None, "Unknown"))
+
+        self.cache.invalidate("Unknown")
+        self.assertEqual(self.cache.get("Unknown"), 4)
+
+    def test_invalidate_drops_every_alias(self):
+        self.cache.preload()
+        self.cache.invalidate(self.light["name"])
+
+        self.assertEqual(self.cache.stats()["size"], 4)
+        self.assertEqual(self.cache.get(self.light["uniqueid"]), 2)
+        self.assertEqual(self.db.statements, 2)
+
+    def test_keys_for(self):
+        self.assertEqual(self.cache.keys_for([2, 9]), {2: self.light["uniqueid"]})
+
+        self.db.items.append((9, None, "Porch"))
+        self.assertEqual(self.cache.keys_for([9]), {9: "Porch"})
+
+
+class TrackingTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.path = os.path.join(self.directory.name, "config.yml")
+
+    def _config(self, text):
+        with open(self.path, "w") as config_file:
+            config_file.write(text)
+        return load_tracking(self.path)
+
+    def test_values_round_trip(self):
+        record = {"on": True, "reachable": True, "bri": 120, "ct": 366, "xy": (0.4573, 0.41), "colormode": "xy", "hue": None}
+        value = encode_values(record, ("on", "reachable", "bri", "ct", "xy", "colormode", "hue"))
+
+        self.assertEqual(value, "b120;c366;x0.4573,0.41;mxy")
+        self.assertEqual(decode_values(value), {"bri": 120, "ct": 366, "xy": (0.4573, 0.41), "colormode": "xy"})
+
+    def test_no_extra_fields_encode_to_none(self):
+        self.assertIsNone(encode_values({"on": True, "reachable": False, "bri": None}, ("on", "reachable", "bri")))
+        self.assertEqual(decode_values(None), {})
+
+    def test_load_tracking(self):
+        fields, thresholds = self._config("tracked_fields: bri on sparkle ct bri\nfield_thresholds: bri=5 ct=ten hue=500\n")
+
+        self.assertEqual(fields, ("on", "reachable", "bri", "ct"))
+        self.assertEqual(thresholds, {"bri": 5.0})
+
+    def test_missing_config_tracks_on_and_reachable(self):
+        self.assertEqual(load_tracking(os.path.join(self.directory.name, "missing.yml")), (("on", "reachable"), {}))
+
+
+class _Bridge():
+    def __init__(self, ip, access_token):
+        self.ip = ip
+        self.access_token = access_token
+
+
+class StartupCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.path = os.path.join(self.directory.name, "startup_cache.json")
+        self.cache = StartupCache(self.path, save_interval=60)
+        self.addCleanup(self.cache.flush)
+        self.lights = snapshot(synthetic_lights(3))
+
+    def _as_dicts(self, lights):
+        return {uniqueid: light.as_dict() for uniqueid, light in lights.items()}
+
+    def test_round_trip(self):
+        self.assertTrue(self.cache.save(_Bridge("192.0.2.10", "token"), self.lights))
+
+        bridge, lights = StartupCache(self.path).load()
+        self.assertEqual(bridge, ("192.0.2.10", "token"))
+        self.assertEqual(self._as_dicts(lights), self._as_dicts(self.lights))
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o600)
+
+    def test_save_within_the_interval_is_held_until_flushed(self):
+        self.cache.save(_Bridge("192.0.2.10", "token"), self.lights)
+        self.assertFalse(self.cache.save(_Bridge("192.0.2.11", "token"), {}))
+        self.assertFalse(self.cache.save(_Bridge("192.0.2.12", "token"), {}))
+        self.assertEqual(self.cache.load()[0], ("192.0.2.10", "token"))
+
+        self.assertTrue(self.cache.flush())
+        self.assertEqual(self.cache.load(), (("192.0.2.12", "token"), {}))
+        self.assertFalse(self.cache.flush())
+
+    def test_forced_save_skips_the_interval(self):
+        self.cache.save(None, self.lights)
+        self.assertTrue(self.cache.save(None, {}, force=True))
+        self.assertEqual(self.cache.load(), (None, {}))
+
+    def test_missing_or_unreadable_cache(self):
+        self.assertEqual(self.cache.load(), (None, {}))
+
+        with open(self.path, "w") as cache_file:
+            cache_file.write("{not json")
+        self.assertEqual(self.cache.load(), (None, {}))
+
+
+class ActionJournalTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "actions.journal")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_read_returns_appended_actions(self):
+        journal = ActionJournal(self.path, capacity=4)
+        actions = _actions(10)
+        journal.append(actions)
+
+        self.assertEqual(journal.pending(), 10)
+        self.assertEqual(journal.read(), actions)
+        self.assertEqual(journal.read(3), actions[:3])
+        journal.close()
+
+    def test_replays_only_uncommitted_actions_after_restart(self):
+        journal = ActionJournal(self.path)
+        actions = _actions(5)
+        journal.append(actions)
+        journal.commit(2)
+        journal.close()
+
+        journal = ActionJournal(self.path)
+        self.assertEqual(journal.read(), actions[2:])
+        journal.close()
+
+    def test_starts_over_once_everything_is_committed(self):
+        journal = ActionJournal(self.path)
+        generation = journal.generation
+        journal.append(_actions(3))
+        journal.commit(3)
+
+        self.assertEqual(journal.pending(), 0)
+        self.assertEqual(journal.generation, generation + 1)
+        journal.close()
+
+        # The old records are still in the file, but belong to the previous generation
+        journal = ActionJournal(self.path)
+        self.assertEqual(journal.read(), [])
+        journal.close()
+
+
+class ActionWriterReplayTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.journal = ActionJournal(os.path.join(self.directory.name, "actions.journal"))
+        self.db = _FailingDatabase(FakeHueBridge(light_count=1), fail_on=2)
+        self.writer = ActionWriter(self.db, item_ids=_ItemIds(), max_batch=10, journal=self.journal)
+
+    def tearDown(self):
+        self.journal.close()
+        self.directory.cleanup()
+
+    def test_failed_chunk_and_the_rest_stay_in_the_journal(self):
+        self.journal.append(_actions(25))
+
+        self.assertEqual(self.writer.flush(), 0)
+        self.assertEqual(len(self.db.actions), 10)
+        self.assertEqual(self.journal.pending(), 15)
+        self.assertEqual(self.journal.read(1)[0][4], "10")
+
+    def test_replay_after_recovery_saves_each_action_once(self):
+        self.journal.append(_actions(25))
+        self.writer.flush()
+
+        self.db.recover()
+        self.writer._retry_at = 0
+        self.assertEqual(self.writer.flush(), 15)
+
+        self.assertEqual(self.journal.pending(), 0)
+        self.assertEqual(sorted(row[4] for row in self.db.actions), list(range(25)))
+
+
+class ActionWriterBufferTest(unittest.TestCase):
+    def setUp(self):
+        self.db = _FailingDatabase(FakeHueBridge(light_count=1), fail_on=2)
+        self.writer = ActionWriter(self.db, item_ids=_ItemIds(), max_batch=10, max_pending=30)
+        # Filled directly so the background thread doesn't race the flushes below
+        self.writer._pending.extend(_actions(25))
+
+    def test_failed_chunk_and_the_rest_go_back_to_the_buffer(self):
+        self.assertEqual(self.writer.flush(), 0)
+        self.assertEqual(len(self.db.actions), 10)
+        self.assertEqual(self.writer.pending(), 15)
+        self.assertEqual(self.writer._pending[0][4], "10")
+
+    def test_retry_saves_each_action_once_in_order(self):
+        self.writer.flush()
+        self.writer._pending.extend(_actions(5, start=25))
+
+        self.db.recover()
+        self.writer._retry_at = 0
+        self.assertEqual(self.writer.flush(), 20)
+
+        self.assertEqual(self.writer.pending(), 0)
+        self.assertEqual([row[4] for row in self.db.actions], list(range(30)))
+
+    def test_requeue_drops_the_oldest_when_full(self):
+        batch = list(self.writer._pending)
+        self.writer._pending.clear()
+        self.writer._pending.extend(_actions(20, start=25))
+        self.writer._requeue(batch[10:])
+
+        self.assertEqual(self.writer.pending(), 30)
+        self.assertEqual(self.writer.dropped, 5)
+        self.assertEqual(self.writer._pending[0][4], "15")
+
+
+class ActionWriterRejectTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.journal = ActionJournal(os.path.join(self.directory.name, "actions.journal"))
+        self.db = _RejectingDatabase(FakeHueBridge(light_count=1), bad=(3, 12))
+        self.item_ids = _ItemIds()
+        self.writer = ActionWriter(self.db, item_ids=self.item_ids, max_batch=10, journal=self.journal)
+
+    def tearDown(self):
+        self.journal.close()
+        self.directory.cleanup()
+
+    def test_rejected_rows_are_skipped_and_the_journal_drains(self):
+        self.journal.append(_actions(25))
+
+        self.assertEqual(self.writer.flush(), 23)
+        self.assertEqual(self.journal.pending(), 0)
+        self.assertEqual(sorted(row[4] for row in self.db.actions), [i for i in range(25) if i not in (3, 12)])
+        self.assertEqual(self.writer.rejected, 2)
+        self.assertEqual(sorted(self.item_ids.invalidated), ["12", "3"])
+
+
+class _PooledConnection():
+    # Fails its health check once `healthy` is cleared
+    def __init__(self):
+        self.closed = 0
+        self.healthy = True
+        self.rollbacks = 0
+
+    def cursor(self):
+        connection = self
+
+        class Cursor():
+            def execute(self, sql, args=None):
+                if not connection.healthy:
+                    raise psycopg2.OperationalError("server closed the connection unexpectedly")
+
+            def close(self):
+                pass
+
+        return Cursor()
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def close(self):
+        self.closed = 1
+
+
+class ConnectionPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.opened = []
+        self.pool = ConnectionPool(self._open, maxconn=2, health_check_interval=0, timeout=0.1)
+
+    def _open(self):
+        self.opened.append(_PooledConnection())
+        return self.opened[-1]
+
+    def test_reuses_idle_connections(self):
+        with self.pool.connection() as first:
+            pass
+        with self.pool.connection() as second:
+            pass
+
+        self.assertIs(first, second)
+        self.assertEqual(len(self.opened), 1)
+
+    def test_waits_for_a_free_connection(self):
+        with self.pool.connection(), self.pool.connection():
+            with self.assertRaises(PoolExhausted):
+                self.pool.getconn()
+
+        with self.pool.connection():
+            pass
+        self.assertEqual(len(self.opened), 2)
+
+    def test_broken_connection_is_replaced(self):
+        with self.assertRaises(psycopg2.OperationalError):
+            with self.pool.connection() as conn:
+                raise psycopg2.OperationalError("connection reset")
+
+        self.assertTrue(conn.closed)
+        with self.pool.connection() as replacement:
+            self.assertIsNot(replacement, conn)
+
+    def test_connection_failing_its_health_check_is_replaced(self):
+        with self.pool.connection() as conn:
+            pass
+        conn.healthy = False
+
+        with self.pool.connection() as replacement:
+            self.assertIsNot(replacement, conn)
+        self.assertTrue(conn.closed)
+        self.assertEqual(self.pool.reconnects, 1)
+
+    def test_closed_pool_refuses_connections(self):
+        with self.pool.connection() as conn:
+            pass
+        self.pool.close()
+
+        self.assertTrue(conn.closed)
+        with self.assertRaises(PoolExhausted):
+            self.pool.getconn()
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.changes = []
+        self.breaker = CircuitBreaker(failure_threshold=3, reset_timeout=2, max_reset_timeout=8, backoff=2, jitter=0,
+                                      on_change=lambda old, new: self.changes.append((old, new)),
+                                      clock=self.clock, rng=random.Random(0))
+
+    def _fail(self, count):
+        for _ in range(count):
+            self.assertTrue(self.breaker.allow())
+            self.breaker.failure()
+
+    def test_opens_after_threshold(self):
+        self._fail(2)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+        self._fail(1)
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(self.breaker.allow())
+        self.assertEqual(self.breaker.rejected, 1)
+        self.assertEqual(self.changes, [(CircuitBreaker.CLOSED, CircuitBreaker.OPEN)])
+
+    def test_success_resets_the_failure_count(self):
+        self._fail(2)
+        self.breaker.success()
+        self._fail(2)
+
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_half_open_lets_one_probe_through(self):
+        self._fail(3)
+        self.clock.now = 2
+
+        self.assertTrue(self.breaker.allow())
+        self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertFalse(self.breaker.allow())
+
+        self.breaker.success()
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.assertEqual(self.changes[-2:], [(CircuitBreaker.OPEN, CircuitBreaker.HALF_OPEN),
+                                             (CircuitBreaker.HALF_OPEN, CircuitBreaker.CLOSED)])
+
+    def test_failed_probe_backs_off_up_to_the_maximum(self):
+        self._fail(3)
+
+        for period in (4, 8, 8):
+            self.clock.now += self.breaker.retry_in()
+            self.assertTrue(self.breaker.allow())
+            self.breaker.failure()
+
+            self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+            self.assertEqual(self.breaker.retry_in(), period)
+
+    def test_call_raises_without_calling_while_open(self):
+        calls = []
+        self._fail(3)
+
+        with self.assertRaises(CircuitOpen):
+            self.breaker.call(calls.append, 1)
+        self.assertEqual(calls, [])
+
+    def test_outage_counts_from_the_first_open(self):
+        self._fail(3)
+        self.clock.now = 5
+        self.assertEqual(self.breaker.outage(), 5)
+
+        self.breaker.reset()
+        self.assertEqual(self.breaker.outage(), 0)
+
+
+class AdaptivePollerTest(unittest.TestCase):
+    def test_backs_off_when_idle_and_speeds_up_on_change(self):
+        poller = AdaptivePoller(min_interval=0.5, max_interval=2, backoff=2)
+
+        self.assertEqual([poller.next_interval(False) for _ in range(4)], [1, 2, 2, 2])
+        self.assertEqual(poller.next_interval(True), 0.5)
+
+
+class BrainStatusTrackerTest(unittest.TestCase):
+    def setUp(self):
+        self.db = _OutageDatabase(FakeHueBridge(light_count=1), "eranaAPI_brain_ability")
+
+    def test_writes_only_transitions(self):
+        status = BrainStatusTracker(self.db)
+
+        self.assertTrue(status.set("Connected"))
+        self.assertFalse(status.set("Connected"))
+        self.assertTrue(status.set("Not Found"))
+        self.assertEqual((status.writes, self.db.attempts), (2, 2))
+
+    def test_debounces_flapping_statuses(self):
+        status = BrainStatusTracker(self.db, debounce=0.05)
+        status.set("Connected")
+
+        self.assertFalse(status.set("Not Found"))
+        time.sleep(0.06)
+        self.assertTrue(status.set("Not Found"))
+        self.assertEqual(status.written, "Not Found")
+
+    def test_failed_write_is_tried_again_on_the_next_set(self):
+        status = BrainStatusTracker(self.db)
+        self.db.down = True
+
+        self.assertFalse(status.set("Connected"))
+        self.assertIsNone(status.written)
+
+        self.db.down = False
+        self.assertTrue(status.set("Connected"))
+        self.assertFalse(status.set("Connected"))
+        self.assertEqual((status.writes, self.db.attempts), (1, 2))
+
+    def test_background_write_is_retried_after_a_failure(self):
+        status = BrainStatusTracker(self.db, background=True, retry_interval=0.01)
+        self.db.down = True
+        status.set("Connected")
+
+        self.assertTrue(_wait_until(lambda: self.db.attempts >= 2))
+        self.db.down = False
+        self.assertTrue(_wait_until(lambda: status.writes == 1))
+
+        self.assertEqual(status.written, "Connected")
+        self.assertFalse(status.set("Connected"))
+
+
+class MonitorTest(unittest.TestCase):
+    """
+    Runs the monitor against a fake bridge in both modes. Following the stream should save a
+    change without polling for it; polling should find it on the next poll.
+    """
+    def setUp(self):
+        # Imported here since it needs the shared db utils; the other tests don't
+        from .main import PhillipsHueBridgeLight
+
+        self.directory = tempfile.TemporaryDirectory()
+        self.bridge = FakeHueBridge(light_count=5).start()
+        self.db = StubDatabase(self.bridge)
+        self.light_control = PhillipsHueBridgeLight(self.db, journal_path=os.path.join(self.directory.name, "actions.journal"),
+                                                    cache_path=os.path.join(self.directory.name, "startup_cache.json"))
+        self.light_control.stream_scheme = "http"
+        self.light_control.item_ids.preload()
+        self.light_control.state = snapshot(self.light_control.get_lights(self.light_control.bridge_connect()))
+
+    def tearDown(self):
+        self.light_control.pipeline.stop()
+        self.light_control.writer.stop()
+        self.light_control.journal.close()
+        self.light_control.startup_cache.flush()
+        self.light_control.connections.invalidate("test finished")
+        self.bridge.stop()
+        self.directory.cleanup()
+
+    def _toggle(self, key):
+        self.bridge.set_light_state(key, on=not self.bridge.lights[key]["state"]["on"])
+
+    def _saved(self, key):
+        self.light_control.writer.flush()
+        return any(row[4] == int(key) for row in self.db.actions)
+
+    def _light_fetches(self):
+        return sum(count for request, count in self.bridge.requests.items()
+                   if request.startswith("GET") and request.rstrip("/").endswith(("/lights", self.bridge.access_token)))
+
+    def test_removed_light_leaves_the_state(self):
+        with self.bridge.lock:
+            removed = self.bridge.lights.pop("4")["uniqueid"]
+
+        self.assertTrue(any(light.uniqueid == removed for light in self.light_control.state.values()))
+        self.assertFalse(self.light_control._check_for_changes())
+
+        self.assertFalse(any(light.uniqueid == removed for light in self.light_control.state.values()))
+        self.light_control.writer.flush()
+        self.assertEqual(self.db.actions, [])
+
+    def test_stream_saves_pushed_changes_without_polling(self):
+        stream = threading.Thread(target=self.light_control._follow_event_stream, daemon=True)
+        stream.start()
+
+        # The stream fetches once on connect to catch up
+        self.assertTrue(_wait_until(lambda: self._light_fetches() >= 1))
+        self.assertTrue(_wait_until(lambda: self.bridge._subscribers))
+        fetches = self._light_fetches()
+
+        self._toggle("3")
+        self.assertTrue(_wait_until(lambda: self._saved("3")))
+        self.bridge.close_streams()
+        stream.join(5)
+
+        self.assertFalse(stream.is_alive())
+        # One fetch for the one pushed change, nothing in between
+        self.assertEqual(self._light_fetches() - fetches, 1)
+
+    def test_poll_finds_changes_and_backs_off_when_idle(self):
+        poller = AdaptivePoller(min_interval=0.05, max_interval=0.4, backoff=2)
+        timer = threading.Timer(0.3, self._toggle, args=("2",))
+        timer.start()
+
+        try:
+            self.light_control._poll_for_changes(poller, duration=1.5)
+        finally:
+            timer.cancel()
+
+        self.light_control.pipeline.drain()
+        self.assertTrue(_wait_until(lambda: self._saved("2")))
+        # Backing off to 0.4s keeps 1.5s of mostly idle polling well under one poll per 0.05s
+        self.assertLess(self.light_control.metrics.counters["polls"], 15)
+
+
+
+class DatabaseOutageTest(unittest.TestCase):
+    """
+    With Postgres down and no cached bridge client there's no bridge to ask. That mustn't be
+    taken for the bridge failing.
+    """
+    def setUp(self):
+        from .main import PhillipsHueBridgeLight
+
+        self.directory = tempfile.TemporaryDirectory()
+        self.db = _OutageDatabase(FakeHueBridge(light_count=1), "")
+        self.db.down = True
+        self.light_control = PhillipsHueBridgeLight(self.db, journal_path=os.path.join(self.directory.name, "actions.journal"),
+                                                    cache_path=os.path.join(self.directory.name, "startup_cache.json"))
+
+    def tearDown(self):
+        self.light_control.writer.stop()
+        self.light_control.journal.close()
+        self.light_control.startup_cache.flush()
+        self.directory.cleanup()
+
+    def test_missing_bridge_is_not_a_bridge_failure(self):
+        for _ in range(5):
+            self.assertFalse(self.light_control._check_for_changes())
+
+        self.assertEqual(self.light_control.breaker.state, CircuitBreaker.CLOSED)
+        self.assertEqual(self.light_control.breaker.failures, 0)
+        self.assertEqual(self.light_control.metrics.counters["errors"], 0)
+        self.assertIsNone(self.light_control.status.written)
+        self.assertFalse(self.light_control.discovery.running())
+
+
+class DailyStatusTest(unittest.TestCase):
+    """
+    The daily save only writes lights that differ from their last saved action.
+    """
+    def setUp(self):
+        from .main import PhillipsHueBridgeLight
+
+        self.directory = tempfile.TemporaryDirectory()
+        self.bridge = FakeHueBridge(light_count=3)
+        self.db = StubDatabase(self.bridge)
+        self.light_control = PhillipsHueBridgeLight(self.db, journal_path=os.path.join(self.directory.name, "actions.journal"),
+                                                    cache_path=os.path.join(self.directory.name, "startup_cache.json"))
+        self.light_control.state = snapshot(self.bridge.lights)
+
+    def tearDown(self):
+        self.light_control.writer.stop()
+        self.light_control.journal.close()
+        self.light_control.startup_cache.flush()
+        self.directory.cleanup()
+
+    def _light(self, key):
+        return next(light for light in self.light_control.state.values() if light.key == key)
+
+    def test_first_save_writes_every_light(self):
+        self.assertEqual(self.light_control.get_all_lights_status(), 3)
+        self.assertEqual(len(self.db.actions), 3)
+
+    def test_unchanged_lights_are_not_written_again(self):
+        self.light_control.get_all_lights_status()
+
+        self.assertEqual(self.light_control.get_all_lights_status(), 0)
+        self.assertEqual(len(self.db.actions), 3)
+
+    def test_only_changed_lights_are_written(self):
+        self.light_control.get_all_lights_status()
+        self._light("2").on = not self._light("2").on
+        self._light("3").bri = 1 if self._light("3").bri != 1 else 2
+
+        self.assertEqual(self.light_control.get_all_lights_status(), 2)
+        self.assertEqual(sorted(row[4] for row in self.db.actions[3:]), [2, 3])
+
+
+class _BridgeListDatabase(StubDatabase):
+    # Reports `bridges` as the active bridge rows, after `delay` seconds per statement
+    def __init__(self, bridge, delay=0):
+        super().__init__(bridge)
+        self.delay = delay
+        self.bridges = []
+
+    def answer(self, sql, args, rows):
+        time.sleep(self.delay)
+        if "SELECT id, access_token, ip_address" in sql:
+            return list(self.bridges)
+        return super().answer(sql, args, rows)
+
+
+class BridgeHandOverTest(unittest.TestCase):
+    """
+    `run` starts on the cached bridge without waiting for the database, and hands over to the
+    supervisor once a second active bridge shows up.
+    """
+    def setUp(self):
+        from .main import PhillipsHueBridgeLight
+
+        self.directory = tempfile.TemporaryDirectory()
+        self.bridge = FakeHueBridge(light_count=3).start()
+        self.db = _BridgeListDatabase(self.bridge, delay=0.5)
+        self.light_control = PhillipsHueBridgeLight(self.db, journal_path=os.path.join(self.directory.name, "actions.journal"),
+                                                    cache_path=os.path.join(self.directory.name, "startup_cache.json"))
+        self.light_control.connections.seed(self.bridge.ip, self.bridge.access_token)
+        self.light_control.state = snapshot(self.bridge.lights)
+        self.light_control.stream_scheme = "http"
+        self.light_control.bridge_check_interval = 0.1
+
+        self.handed_over = threading.Event()
+        self.light_control.run_supervisor = lambda mode: self.handed_over.set()
+
+    def tearDown(self):
+        self.light_control.pipeline.stop()
+        self.light_control.writer.stop()
+        self.light_control.journal.close()
+        self.light_control.startup_cache.flush()
+        self.bridge.stop()
+        self.directory.cleanup()
+
+    def _run(self, mode):
+        started = time.monotonic()
+        run = threading.Thread(target=self.light_control.run, args=(mode,), daemon=True)
+        run.start()
+
+        self.assertTrue(_wait_until(lambda: self.bridge.requests))
+        self.assertLess(time.monotonic() - started, self.db.delay)
+        self.assertFalse(self.handed_over.is_set())
+
+        self.db.bridges = [(1, self.bridge.access_token, self.bridge.ip), (2, "other-token", "192.0.2.1")]
+        self.assertTrue(self.handed_over.wait(5))
+        run.join(5)
+        self.assertFalse(run.is_alive())
+
+    def test_poll_mode_hands_over(self):
+        self._run("poll")
+
+    def test_stream_mode_hands_over(self):
+        self._run("stream")
+
+
+class _TransactionDatabase(StubDatabase):
+    # Keeps statements in the open transaction until commit. Bridge inserts fail while `fail` is set
+    def __init__(self, bridge):
+        super().__init__(bridge)
+        self.fail = False
+        self.open = []
+        self.committed = []
+
+    def commit(self):
+        self.committed.append(self.open)
+        self.open = []
+
+    def rollback(self):
+        self.open = []
+
+    def answer(self, sql, args, rows):
+        statement = sql.split()[0]
+        if self.fail and statement == "INSERT":
+            raise RuntimeError("duplicate key")
+        self.open.append(statement)
+        return super().answer(sql, args, rows)
+
+
+class BridgeDiscoveryTest(unittest.TestCase):
+    def setUp(self):
+        self.db = _TransactionDatabase(FakeHueBridge(light_count=1))
+        self.discovery = BridgeDiscovery(self.db, status=BrainStatusTracker(self.db))
+
+    def test_save_bridge_replaces_the_row_in_one_transaction(self):
+        self.discovery._save_bridge("192.0.2.10", "token", "001788FFFE000001")
+
+        self.assertEqual(self.db.committed, [["DELETE", "INSERT"]])
+
+    def test_failed_insert_keeps_the_old_row(self):
+        self.db.fail = True
+
+        with self.assertRaises(RuntimeError):
+            self.discovery._save_bridge("192.0.2.10", "token", "001788FFFE000001")
+        self.assertEqual(self.db.committed, [])
+        self.assertEqual(self.db.open, [])
+
+
+class ProbeSsdpTest(unittest.TestCase):
+    def setUp(self):
+        # Stands in for the multicast group, so the probe's search arrives here
+        self.responder = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.responder.bind(("127.0.0.1", 0))
+        patcher = mock.patch.object(discovery, "SSDP_GROUP", self.responder.getsockname())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.responder.close)
+
+    def _answer(self, *replies):
+        def respond():
+            search, address = self.responder.recvfrom(9000)
+            self.assertTrue(search.startswith(b"M-SEARCH"))
+            for reply in replies:
+                self.responder.sendto(reply, address)
+
+        thread = threading.Thread(target=respond, daemon=True)
+        thread.start()
+        return thread
+
+    def test_finds_the_bridge_id(self):
+        self._answer(b"HTTP/1.1 200 OK\r\nST: upnp:rootdevice\r\n\r\n",
+                     b"HTTP/1.1 200 OK\r\nST: upnp:rootdevice\r\nhue-bridgeid: 001788fffe000001\r\n\r\n")
+
+        self.assertEqual(probe_ssdp(2), ("127.0.0.1", "001788FFFE000001"))
+
+    def test_gives_up_after_the_timeout(self):
+        self._answer(b"HTTP/1.1 200 OK\r\nST: upnp:rootdevice\r\n\r\n")
+
+        started = time.monotonic()
+        self.assertIsNone(probe_ssdp(0.3))
+        self.assertLess(time.monotonic() - started, 1)
+
+
+class ScheduleExecutorTest(unittest.TestCase):
+    def setUp(self):
+        self.bridge = FakeHueBridge(light_count=3)
+        self.sent = []
+        self.executor = ScheduleExecutor(None, self._set_lights, ItemIdCache(StubDatabase(self.bridge)), tick=1.0, max_lateness=300)
+        self.now = time.time()
+
+    def _set_lights(self, targets):
+        self.sent.append(targets)
+        return [{"ok": True}] * len(targets)
+
+    def _uniqueid(self, key):
+        return self.bridge.lights[key]["uniqueid"]
+
+    def test_due_pops_everything_within_a_tick(self):
+        self.executor.add([(1, self.now - 1, 1, 1), (2, self.now + 0.5, 0, 2), (3, self.now + 5, 1, 3)])
+
+        self.assertEqual([entry[1] for entry in self.executor.due(self.now)], [1, 2])
+        self.assertEqual(len(self.executor), 1)
+        self.assertEqual(self.executor.due(self.now), [])
+
+    def test_add_skips_repeats_and_stale_predictions(self):
+        self.executor.add([(1, self.now + 10, 1, 1), (2, self.now - 600, 1, 2)])
+        self.executor.add([(1, self.now + 10, 1, 1)])
+
+        self.assertEqual(len(self.executor), 1)
+        self.assertEqual(self.executor.last_id, 2)
+
+    def test_fire_sends_the_latest_state_per_light(self):
+        self.executor.fire([(self.now - 1, 1, False, 1), (self.now, 2, True, 1), (self.now, 3, False, 2)])
+
+        self.assertEqual(self.sent, [{self._uniqueid("1"): {"on": True}, self._uniqueid("2"): {"on": False}}])
+        self.assertEqual(self.executor.fired, 2)
+
+    def test_fire_counts_only_what_was_sent(self):
+        self.executor.fire([(self.now, 1, True, 1), (self.now, 2, True, 99), (self.now - 600, 3, True, 2)])
+
+        self.assertEqual(self.sent, [{self._uniqueid("1"): {"on": True}}])
+        self.assertEqual(self.executor.fired, 1)
+        self.assertEqual(self.executor.skipped, 2)
+
+
+class LightCommanderPlanTest(unittest.TestCase):
+    def setUp(self):
+        self.lights = snapshot(synthetic_lights(6))
+        self.uniqueids = {light.key: uniqueid for uniqueid, light in self.lights.items()}
+        self.commander = LightCommander(None, None, min_group_size=3)
+
+    def _targets(self, keys, state):
+        return {self.uniqueids[key]: state for key in keys}
+
+    def test_group_covers_lights_with_the_same_state(self):
+        groups = {"1": frozenset({"1", "2", "3"}), "0": frozenset(self.uniqueids)}
+        targets = self._targets(("1", "2", "3", "4"), {"on": True})
+
+        self.assertEqual(self.commander.plan(targets, self.lights, groups),
+                         [("groups/1/action", {"on": True}), ("lights/4/state", {"on": True})])
+
+    def test_every_light_uses_group_zero(self):
+        groups = {"1": frozenset({"1", "2", "3"}), "0": frozenset(self.uniqueids)}
+        targets = self._targets(self.uniqueids, False)
+
+        self.assertEqual(self.commander.plan(targets, self.lights, groups), [("groups/0/action", {"on": False})])
+
+    def test_small_groups_and_mixed_states_go_light_by_light(self):
+        groups = {"1": frozenset({"1", "2"}), "2": frozenset({"3", "4", "5"})}
+        targets = self._targets(("1", "2", "3", "4"), {"on": True})
+        targets[self.uniqueids["5"]] = {"on": True, "bri": 10}
+
+        self.assertEqual(self.commander.plan(targets, self.lights, groups),
+                         [("lights/1/state", {"on": True}), ("lights/2/state", {"on": True}),
+                          ("lights/3/state", {"on": True}), ("lights/4/state", {"on": True}),
+                          ("lights/5/state", {"on": True, "bri": 10})])
+
+    def test_names_resolve_and_unknown_lights_are_skipped(self):
+        targets = {"Light 2": True, "Nowhere": True}
+
+        self.assertEqual(self.commander.plan(targets, self.lights, {}), [("lights/2/state", {"on": True})])
+
+
+class _RecordingClient():
+    def __init__(self, ip):
+        self.ip = ip
+        self.access_token = "fake-hue-token"
+        self.sent = []
+
+    def get(self, path=""):
+        return {}
+
+    def put(self, path, body):
+        self.sent.append((path, body))
+
+
+class SupervisorCommandTest(unittest.TestCase):
+    """
+    With several bridges, each light command goes to the bridge that has the light.
+    """
+    def setUp(self):
+        from .supervisor import BridgeMonitor, BridgeSupervisor
+
+        self.supervisor = BridgeSupervisor(StubDatabase(FakeHueBridge(light_count=1)))
+        self.addCleanup(self.supervisor.executor.shutdown)
+
+        lights = synthetic_lights(4)
+        self.bridge_lights = [{"1": lights["1"], "2": lights["2"]}, {"1": lights["3"], "2": lights["4"]}]
+        for bridge_id, bridge_lights in enumerate(self.bridge_lights, 1):
+            monitor = BridgeMonitor(bridge_id, _RecordingClient(f"192.0.2.{bridge_id}"), self.supervisor.writer, None)
+            monitor.resources.snapshots["lights"] = snapshot(bridge_lights)
+            self.supervisor.monitors[bridge_id] = monitor
+
+    def test_lights_go_to_their_own_bridge(self):
+        results = self.supervisor.apply({self.bridge_lights[0]["2"]["uniqueid"]: {"on": True},
+                                         self.bridge_lights[1]["1"]["name"]: {"on": False},
+                                         "missing": {"on": True}})
+
+        self.assertEqual(len(results), 2)
+        self.assertEqual(self.supervisor.monitors[1].client.sent, [("lights/2/state", {"on": True})])
+        self.assertEqual(self.supervisor.monitors[2].client.sent, [("lights/1/state", {"on": False})])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,213 @@
+import logging
+import os
+
+from .state import STATE_FIELDS
+
+log = logging.getLogger('modules')
+
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "config.yml")
+
+# Saved in their own action columns; every other tracked field goes in the encoded value
+ACTION_FIELDS = ("on", "reachable")
+
+# One letter per field in the encoded value, e.g. "b120;c366;x0.4573,0.41"
+FIELD_CODES = {"bri": "b", "hue": "h", "sat": "s", "ct": "c", "xy": "x", "effect": "e", "colormode": "m", "alert": "a"}
+_CODE_FIELDS = {code: field for field, code in FIELD_CODES.items()}
+
+
+def read_config(path=None):
+    """
+    Reads the module's flat `key: value` config file.
+
+    Returns
+    ----------
+    `config <dictionary>`
+    Every key with its value as a string, trailing commas removed. Empty if the file can't be read
+    """
+    config = {}
+
+    try:
+        with open(path or CONFIG_PATH) as config_file:
+            for line in config_file:
+                key, separator, value = line.partition(":")
+                if separator and not line.startswith((" ", "#")):
+                    config[key.strip()] = value.strip().rstrip(",")
+    except OSError as err:
+        log.error(f"[ERROR]: Couldn't read {path or CONFIG_PATH}: {err}")
+
+    return config
+
+
+def load_tracking(path=None):
+    """
+    Reads which light fields the monitor records, and how much each has to move to count, from
+    `tracked_fields` and `field_thresholds` in config.yml:
+
+        tracked_fields: on reachable bri ct hue
+        field_thresholds: bri=5 ct=10 hue=500
+
+    Returns
+    ----------
+    `tracking <tuple>`
+    (fields, thresholds). Fields always start with `ACTION_FIELDS`. Thresholds are in the form
+    {field: minimum change}; fields without one count any change.
+    """
+    config = read_config(path)
+    fields = list(ACTION_FIELDS)
+
+    for field in config.get("tracked_fields", "").replace(",", " ").split():
+        if field not in STATE_FIELDS:
+            log.error(f"[ERROR]: Unknown tracked light field {field} in config.yml, ignoring it")
+        elif field not in fields:
+            fields.append(field)
+
+    thresholds = {}
+
+    for entry in config.get("field_thresholds", "").replace(",", " ").split():
+        field, _, threshold = entry.partition("=")
+        try:
+            thresholds[field] = float(threshold)
+        except ValueError:
+            log.error(f"[ERROR]: Bad threshold {entry} in config.yml, ignoring it")
+
+    return tuple(fields), {field: threshold for field, threshold in thresholds.items() if field in fields}
+
+
+def load_monitored_resources(path=None):
+    """
+    Reads which bridge resources the monitor watches from `monitored_resources` in config.yml,
+    e.g. "lights sensors groups". Lights are always watched.
+
+    Returns
+    ----------
+    `resources <tuple>`
+    """
+    resources = ["lights"]
+
+    for resource in read_config(path).get("monitored_resources", "").replace(",", " ").split():
+        if resource not in ("lights", "sensors", "groups"):
+            log.error(f"[ERROR]: Unknown monitored resource {resource} in config.yml, ignoring it")
+        elif resource not in resources:
+            resources.append(resource)
+
+    return tuple(resources)
+
+
+def load_settings(key, names, path=None):
+    """
+    Reads a line of numeric `name=value` settings from config.yml, e.g.
+    `poll_intervals: min=0.5 max=10`.
+
+    Parameters
+    ----------
+    `key <string>`
+    The config key
+
+    `names <dictionary>`
+    An object in the form {name in config.yml: keyword argument}
+
+    Returns
+    ----------
+    `settings <dictionary>`
+    Keyword arguments, only for the settings that are set
+    """
+    settings = {}
+
+    for entry in read_config(path).get(key, "").replace(",", " ").split():
+        name, _, value = entry.partition("=")
+        try:
+            settings[names[name]] = float(value)
+        except (KeyError, ValueError):
+            log.error(f"[ERROR]: Bad {key} setting {entry} in config.yml, ignoring it")
+
+    return settings
+
+
+def load_poll_intervals(path=None):
+    """
+    Reads the monitor's poll intervals from `poll_intervals` in config.yml:
+
+        poll_intervals: min=0.5 active=2 max=10
+
+    `min` is the wait right after a change, `active` the longest wait in the busiest hour of
+    the day and `max` the longest wait in the quietest. See `AdaptivePoller`.
+
+    Returns
+    ----------
+    `intervals <dictionary>`
+    Keyword arguments for `AdaptivePoller`, only for the intervals that are set
+    """
+    return load_settings("poll_intervals", {"min": "min_interval", "active": "active_interval", "max": "max_interval"}, path)
+
+
+def load_bridge_health(path=None):
+    """
+    Reads how the monitor treats a failing bridge from `bridge_health` in config.yml:
+
+        bridge_health: timeout=3 failures=3 probe=2 max_probe=30
+
+    `timeout` is the seconds each bridge request may take, `failures` how many in a row open
+    the circuit, `probe` the seconds before the first probe and `max_probe` the most seconds
+    between probes, which bounds how long a recovery goes unnoticed. See `CircuitBreaker`.
+
+    Returns
+    ----------
+    `health <tuple>`
+    (timeout, breaker settings), where timeout is `None` if it isn't set and the settings are
+    keyword arguments for `CircuitBreaker`
+    """
+    settings = load_settings("bridge_health", {"timeout": "timeout", "failures": "failure_threshold",
+                                               "probe": "reset_timeout", "max_probe": "max_reset_timeout"}, path)
+    return settings.pop("timeout", None), settings
+
+
+def _encode(value):
+    if isinstance(value, tuple):
+        return ",".join(_encode(part) for part in value)
+    if isinstance(value, float):
+        return f"{value:.4g}"
+    return str(value)
+
+
+def encode_values(light, fields):
+    """
+    Packs a change record's tracked fields, apart from `ACTION_FIELDS`, into a short string.
+
+    Parameters
+    ----------
+    `light <dictionary>`
+    A change record from `diff_lights`
+
+    `fields <tuple>`
+    The tracked fields
+
+    Returns
+    ----------
+    `value <string>`
+    e.g. "b120;c366;x0.4573,0.41", or `None` if no extra fields are tracked or all are empty
+    """
+    parts = [FIELD_CODES[field] + _encode(light[field]) for field in fields
+             if field in FIELD_CODES and light.get(field) is not None]
+    return ";".join(parts) or None
+
+
+def _decode(field, text):
+    if field == "xy":
+        return tuple(float(part) for part in text.split(","))
+    if field in ("effect", "colormode", "alert"):
+        return text
+    return int(text)
+
+
+def decode_values(value):
+    """
+    Unpacks a string from `encode_values`.
+
+    Returns
+    ----------
+    `values <dictionary>`
+    An object in the form {"bri": 120, "ct": 366, "xy": (0.4573, 0.41), etc...}
+    """
+    if not value:
+        return {}
+    return {_CODE_FIELDS[part[0]]: _decode(_CODE_FIELDS[part[0]], part[1:]) for part in value.split(";")}
@@ -0,0 +1,249 @@
+import collections
+import logging
+import threading
+import time
+
+from psycopg2 import DataError, IntegrityError
+
+from .db import create_actions, create_actions_row_by_row
+from .item_cache import ItemIdCache
+from .metrics import MonitorMetrics
+from .monitor_log import SampledLogger
+
+log = logging.getLogger('modules')
+monitor_log = SampledLogger()
+
+
+class ActionWriter():
+    """
+    A bounded write-behind buffer for light actions. The monitor hands it the actions for
+    each tick and carries on; a background thread resolves the item ids through the
+    `ItemIdCache` and saves everything buffered with one multi-row insert, whenever
+    `max_batch` actions are waiting or `flush_interval` seconds have passed.
+
+    If the database falls so far behind that `max_pending` actions are waiting, the oldest
+    are dropped rather than blocking the monitor. Rows the database rejects outright, e.g.
+    for a light item that was deleted, are logged and skipped, and their item ids are looked
+    up again. With a journal the buffer is the
+    `ActionJournal` instead: nothing is dropped, and actions captured during a database
+    outage or before a restart are replayed in bulk once inserts succeed again.
+
+    Parameters
+    ----------
+    `conn <database connection>`
+    The connection to the main Postgres database
+
+    `item_ids <ItemIdCache>`
+    Cache for the uniqueid/name to item id lookups. A new one is made if not given
+
+    `max_batch <int>`
+    Number of buffered actions that triggers a flush
+
+    `flush_interval <float>`
+    Seconds between flushes when the buffer isn't full
+
+    `max_pending <int>`
+    Upper bound on buffered actions
+
+    `metrics <MonitorMetrics>`
+    Where the lookup and insert latencies are recorded. A new one is made if not given
+
+    `journal <ActionJournal>`
+    Optional, buffers actions on disk instead of in memory. A backlog is replayed one
+    `max_batch` chunk at a time, in order, and committed after each chunk, so a failure never
+    leaves saved actions in the journal to be inserted twice
+    """
+    def __init__(self, conn, item_ids=None, max_batch=200, flush_interval=1.0, max_pending=10000, metrics=None, journal=None):
+        self.conn = conn
+        self.item_ids = item_ids if item_ids is not None else ItemIdCache(conn)
+        self.metrics = metrics if metrics is not None else MonitorMetrics()
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.journal = journal
+        self.dropped = 0
+        self.rejected = 0
+
+        self._pending = collections.deque(maxlen=max_pending)
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._failures = 0
+        self._retry_at = 0
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, name="hue-action-writer", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stops the background thread after a final flush.
+        """
+        self._stopped.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def add(self, actions):
+        """
+        Buffers actions for the next flush. Never waits on the database.
+
+        Parameters
+        ----------
+        `actions <array>`
+        Actions in the form (event_time, has_value, is_on, is_reachable, unique_id, value),
+        where `unique_id` is the value looked up in `eranaAPI_item` and `value` the encoded
+        extra fields from `tracking.encode_values`, or `None`
+        """
+        if self.journal is not None:
+            self.journal.append(actions)
+            full = self.journal.pending() >= self.max_batch
+        else:
+            with self._lock:
+                overflow = len(self._pending) + len(actions) - self._pending.maxlen
+                if overflow > 0:
+                    self.dropped += overflow
+                    monitor_log.error("[ERROR]: Action buffer full, dropping the %d oldest light actions", overflow)
+                self._pending.extend(actions)
+                full = len(self._pending) >= self.max_batch
+
+        self.start()
+        if full:
+            self._wake.set()
+
+    def pending(self):
+        if self.journal is not None:
+            return self.journal.pending()
+        return len(self._pending)
+
+    def _save(self, batch):
+        # Raises if the database is unavailable, so the caller can keep the batch
+        with self.metrics.time("lookup"):
+            item_ids = self.item_ids.resolve({action[4] for action in batch})
+        rows = []
+
+        for event_time, has_value, is_on, is_reachable, unique_id, value in batch:
+            item_id = item_ids.get(unique_id)
+            if item_id is None:
+                monitor_log.error("[ERROR]: Light %s does not exist in the current db, skipping action at %s", unique_id, event_time, key=("missing", unique_id))
+                continue
+            rows.append((event_time, has_value, is_on, is_reachable, item_id, value))
+
+        if not rows:
+            return 0
+
+        try:
+            with self.metrics.time("insert"):
+                create_actions(self.conn, rows)
+        except (IntegrityError, DataError):
+            # Retrying wouldn't help, e.g. a light item was deleted and its cached id is stale.
+            # Save the rest of the batch and set the rejected rows aside, so they don't hold up
+            # everything queued behind them
+            saved, rejected = create_actions_row_by_row(self.conn, rows)
+            self._reject(rejected, item_ids)
+            return saved
+
+        monitor_log.debug("[INFO]: Saved %d light actions", len(rows))
+        return len(rows)
+
+    def _reject(self, rejected, item_ids):
+        # The next lookup of a rejected light asks the database again
+        rejected_ids = {row[4] for row in rejected}
+        for key, item_id in item_ids.items():
+            if item_id in rejected_ids:
+                self.item_ids.invalidate(key)
+
+        self.rejected += len(rejected)
+        self.metrics.inc("rejected", len(rejected))
+        monitor_log.error("[ERROR]: The database rejected %d light actions, skipped them", len(rejected))
+
+    def _save_chunks(self, actions):
+        # Saves actions in max_batch chunks, in order. If a chunk fails, it and every chunk
+        # after it go back to the front of the buffer for the next flush
+        saved = 0
+
+        for i in range(0, len(actions), self.max_batch):
+            try:
+                saved += self._save(actions[i:i + self.max_batch])
+            except Exception:
+                self._requeue(actions[i:])
+                raise
+
+        return saved
+
+    def _requeue(self, actions):
+        with self._lock:
+            # Newer actions arrived while these were being saved; if they don't all fit, the
+            # oldest are dropped, same as in `add`
+            overflow = len(self._pending) + len(actions) - self._pending.maxlen
+            if overflow > 0:
+                self.dropped += overflow
+                monitor_log.error("[ERROR]: Action buffer full, dropping the %d oldest light actions", overflow)
+                actions = actions[overflow:]
+            self._pending.extendleft(reversed(actions))
+
+    def _replay_journal(self):
+        # Drains the journal one chunk at a time, checkpointing after each chunk. Chunks are
+        # saved in order, so the first failure leaves it and everything after it in the
+        # journal and nothing that was saved gets replayed.
+        saved = 0
+
+        while True:
+            batch = self.journal.read(self.max_batch)
+            if not batch:
+                return saved
+
+            saved += self._save(batch)
+            self.journal.commit(len(batch))
+
+    def flush(self):
+        """
+        Saves everything buffered right now. With a journal, that includes anything left over
+        from database outages or earlier runs.
+
+        Returns
+        ----------
+        `count <int>`
+        The number of actions inserted
+        """
+        with self._flush_lock:
+            if time.monotonic() < self._retry_at:
+                return 0
+
+            if self.journal is not None:
+                batch = None
+            else:
+                with self._lock:
+                    batch = list(self._pending)
+                    self._pending.clear()
+
+                if not batch:
+                    return 0
+
+            try:
+                if batch is None:
+                    saved = self._replay_journal()
+                else:
+                    saved = self._save_chunks(batch)
+                self._failures = 0
+                self._retry_at = 0
+                return saved
+            except Exception as err:
+                self.metrics.inc("errors")
+                self._failures += 1
+                self._retry_at = time.monotonic() + min(60, self.flush_interval * 2 ** self._failures)
+                monitor_log.error("[ERROR]: Saving %d light actions failed: %s", self.pending(), err)
+                return 0
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+        self.flush()